@@ -0,0 +1,110 @@
+""" FURUTA PENDULUM
+
+Public API of the package, the submodules are only imported when one of their
+names is used (PEP 562), so that `import src` or `from src import Input_HNN`
+does not import the plotting (matplotlib, seaborn) or the training code.
+The submodules can still be imported directly, for example `from src.models import *`
+or `from src.train import train` (train() is not part of the API since it has the
+name of its submodule).
+"""
+
+import importlib
+
+# public name : submodule that defines it
+_LAZY_NAMES = {
+    # dynamics
+    "furuta_H": "dynamics",
+    "hamiltonian_fn_furuta": "dynamics",
+    "furuta_dH": "dynamics",
+    "dynamics_fn_furuta": "dynamics",
+    "NFECounter": "dynamics",
+    "U_FUNC": "dynamics",
+    "G_FUNC": "dynamics",
+    "sample_excitation": "dynamics",
+    # models
+    "hamiltonian_gradient": "models",
+    "MLP": "models",
+    "Expanding_ResNet": "models",
+    "Interp_ResNet": "models",
+    "Expanding_ResNet_wide": "models",
+    "simple_HNN": "models",
+    "Autoencoder": "models",
+    "Input_HNN": "models",
+    "Dissipation_Net": "models",
+    # trajectories
+    "get_trajectory_furuta": "trajectories",
+    "multiple_trajectories_furuta": "trajectories",
+    "rk4_step": "trajectories",
+    "rk4_rollout": "trajectories",
+    "dopri5_solve": "trajectories",
+    "energy_furuta": "trajectories",
+    "get_energy_furuta": "trajectories",
+    # data
+    "TrajectoryDataset_furuta": "data",
+    "HardExampleSampler": "data",
+    "data_loader_furuta": "data",
+    "load_data_device": "data",
+    "normalization_stats": "data",
+    "unpack_batch": "data",
+    "TrajectoryDataset_system": "data",
+    "data_loader_system": "data",
+    "split_loaders": "data",
+    # systems
+    "PortHamiltonianSystem": "systems",
+    "SYSTEMS": "systems",
+    "register_system": "systems",
+    "make_system": "systems",
+    "available_systems": "systems",
+    "load_system_data": "systems",
+    # training
+    "trajectory_loss": "train_helpers",
+    "L2_loss": "train_helpers",
+    "AdaptiveHorizon": "train_helpers",
+    "MultilevelScheduler": "train_helpers",
+    "SystemSpec": "engine",
+    "TrainingEngine": "engine",
+    "Callback": "engine",
+    "ConstantHorizon": "engine",
+    "ScheduledHorizon": "engine",
+    # evaluation
+    "rollout_and_score": "evaluation",
+    "Validator": "evaluation",
+    "evaluate_long_horizon": "evaluation",
+    "check_regression": "evaluation",
+    "furuta_energy_fn": "evaluation",
+    # utils
+    "set_device": "utils",
+    "set_furuta_params": "utils",
+    "set_all_seeds": "utils",
+    "count_parameters": "utils",
+    "save_stats": "utils",
+    "read_dict": "utils",
+    "PhaseTimer": "utils",
+    # recorded data, control, serving and export
+    "ingest_furuta_logs": "ingest",
+    "load_logs_device": "ingest",
+    "SamplingMPC": "control",
+    "InferenceServer": "serving",
+    "load_checkpoint": "serving",
+    "export_model": "export",
+    "load_exported": "export",
+    "RK4Stepper": "export",
+    # plots (imports matplotlib)
+    "plot_furuta_hat_nom": "plots",
+    "train_test_loss_plot": "plots",
+    "training_plot": "plots",
+}
+
+__all__ = sorted(_LAZY_NAMES)
+
+
+def __getattr__(name):
+    if name not in _LAZY_NAMES:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module("." + _LAZY_NAMES[name], __name__), name)
+    globals()[name] = value  # __getattr__ is not called again for this name
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
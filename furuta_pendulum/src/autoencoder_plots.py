@@ -6,6 +6,7 @@ from torchdiffeq import odeint as odeint
 
 from .trajectories import *
 from .dynamics import *
+from .data import unpack_batch
 
 
 def print_ae_train(x_hat, x, n, horizon):
@@ -64,7 +65,7 @@ def plot_distribution(train_loader, save=False, path=""):
     """
     Plot distributions of the trajectories
     """
-    x, y = next(iter(train_loader))
+    x, y, _ = unpack_batch(next(iter(train_loader)))
 
     print("Standard deviation of each coordinate: ", (1 / x.std(dim=(0, 1))) * 10)
 
@@ -136,7 +137,7 @@ def plot_furuta_ae_twoplots(
     Outputs:
       None
     """
-    x_nom, t_eval = next(iter(data_loader_tt))
+    x_nom, t_eval, _ = unpack_batch(next(iter(data_loader_tt)))
     # predicted trajectory
 
     t_eval = t_eval[0, :max_timestep]
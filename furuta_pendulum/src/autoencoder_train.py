@@ -4,7 +4,6 @@ from torchdiffeq import odeint
 
 import time as time
 
-from .autoencoder_plots import *
 from .trajectories import *
 from .dynamics import *
 from .train import *
@@ -52,9 +51,8 @@ def train_only_ae(
 
         autoencoder.eval()
 
-        for x, t_eval in iter(
-            train_loader
-        ):  # x is [batch_size,time_steps, (q1,p1,q2,p1)]
+        for batch in train_loader:  # x is [batch_size,time_steps, (q1,p1,q2,p1)]
+            x, t_eval, _ = unpack_batch(batch)
 
             t_eval = t_eval[0, :horizon]
 
@@ -66,6 +64,9 @@ def train_only_ae(
 
             if not step % 50:
                 n = 0
+                # matplotlib is only imported when a plot is made
+                from .autoencoder_plots import print_ae_train
+
                 print_ae_train(x_hat, x, n, horizon)
 
             train_loss_batch.backward()
@@ -144,6 +145,8 @@ def ae_train_step(
 
     if not step % 10:
         n = 0
+        from .autoencoder_plots import print_ae_train_all
+
         print_ae_train_all(t_eval, train_x_hat, x_hat, x, n, horizon)
 
     train_loss = train_loss + train_loss_batch.item()
@@ -212,6 +215,8 @@ def ae_test_step(
         if not step % 10:
             n = 0
             print("test:")
+            from .autoencoder_plots import print_ae_train_all
+
             print_ae_train_all(t_eval, test_x_hat, x_hat, x, n, horizon)
 
         test_loss = test_loss + test_loss_batch.item()
@@ -288,7 +293,8 @@ def train_ae(
             )
 
         # x is [batch_size,time_steps,(q1,p1,q2,p1)]
-        for x, t_eval in iter(train_loader):
+        for batch in train_loader:
+            x, t_eval, _ = unpack_batch(batch)
             train_loss = ae_train_step(
                 train_loss,
                 step,
@@ -310,7 +316,8 @@ def train_ae(
 
         if test_loader:
             if not (step % 10):  # run validation every 10 steps
-                for x, t_eval in iter(test_loader):
+                for batch in test_loader:
+                    x, t_eval, _ = unpack_batch(batch)
                     test_loss = ae_test_step(
                         test_loss,
                         step,
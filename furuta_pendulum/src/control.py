@@ -0,0 +1,220 @@
+import time
+
+import torch
+
+from .dynamics import U_FUNC
+from .trajectories import rk4_step
+
+""" MODEL PREDICTIVE CONTROL """
+
+
+class SamplingMPC:
+    """
+    Description:
+        Sampling based model predictive controller using a trained Input_HNN as the
+        prediction model. At every call of solve(), num_samples candidate input
+        sequences are rolled out in parallel (one batch through H_net and G_net) and
+        the input sequence is updated with either:
+            - 'mppi' : model predictive path integral, average of the sampled sequences
+                       weighted by exp(-cost/temperature)
+            - 'cem' : cross entropy method, mean and std of the num_elites best sequences
+        Optimization iterations are repeated until max_iterations or latency_budget is
+        reached. The solution is shifted by one step and reused as the initial guess of
+        the next call (warm start).
+    Inputs:
+        - model (nn.Module) : trained Input_HNN, its u_func is temporarily replaced by
+                              the candidate sequences during solve()
+        - Ts (float) : sampling time of the controller (and of the input sequences)
+        - horizon (int) : number of steps of the prediction horizon
+        - num_samples (int) : number of candidate input sequences per iteration
+        - method (string) : 'mppi' or 'cem'
+        - x_ref (tensor) : target state (q1,p1,q2,p2), in the coordinates of the model
+        - Q (tensor) : weights of the state error (q1,p1,q2,p2)
+        - R (float) : weight of the input
+        - Q_terminal (tensor or None) : weights of the terminal state error, Q if None
+        - angle_dims (tuple) : coordinates that are angles, their error is 2*(1-cos(error))
+                               so that a full turn costs nothing
+        - u_min, u_max (float) : input bounds
+        - noise_std (float) : std of the sampled input perturbations
+        - temperature (float) : temperature of the MPPI weights
+        - num_elites (int) : number of elite sequences for CEM
+        - max_iterations (int) : maximum number of optimization iterations per solve
+        - latency_budget (float or None) : time in seconds after which no new
+                                           iteration is started (for example Ts)
+    Methods:
+        - solve(x, t) : returns the first input of the optimized sequence and info
+        - reset() : forget the warm start
+        - latency_stats() : statistics of the solve times
+
+    Example use :
+        mpc = SamplingMPC(model, Ts=0.005, horizon=50, num_samples=256,
+                          x_ref=torch.tensor([0.0, 0.0, torch.pi, 0.0]),
+                          latency_budget=0.005)
+        u, info = mpc.solve(x, t)
+    """
+
+    def __init__(
+        self,
+        model,
+        Ts=0.005,
+        horizon=50,
+        num_samples=256,
+        method="mppi",
+        x_ref=torch.tensor([0.0, 0.0, 0.0, 0.0]),
+        Q=torch.tensor([1.0, 0.1, 1.0, 0.1]),
+        R=0.01,
+        Q_terminal=None,
+        angle_dims=(0, 2),
+        u_min=-1.0,
+        u_max=1.0,
+        noise_std=0.5,
+        temperature=1.0,
+        num_elites=32,
+        max_iterations=3,
+        latency_budget=None,
+    ):
+        if method not in ("mppi", "cem"):
+            raise ValueError("method must be 'mppi' or 'cem'")
+
+        self.model = model
+        self.Ts = Ts
+        self.horizon = horizon
+        self.num_samples = num_samples
+        self.method = method
+        self.x_ref = x_ref
+        self.Q = Q
+        self.R = R
+        self.Q_terminal = Q if Q_terminal is None else Q_terminal
+        self.angle_dims = list(angle_dims)
+        self.u_min = u_min
+        self.u_max = u_max
+        self.noise_std = noise_std
+        self.temperature = temperature
+        self.num_elites = num_elites
+        self.max_iterations = max_iterations
+        self.latency_budget = latency_budget
+
+        self.latencies = []  # solve time of every call of solve()
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the previous solution (no warm start at the next solve())
+        """
+        self.u_mean = None
+        self.u_std = None
+
+    def _state_cost(self, x, Q):
+        """
+        Weighted state error [num_samples], angles compared with 2*(1-cos(error))
+        """
+        err = x - self.x_ref.to(x.device)
+        sq = err.pow(2)
+        sq[:, self.angle_dims] = 2 * (1 - torch.cos(err[:, self.angle_dims]))
+        return (sq * Q.to(x.device)).sum(dim=-1)
+
+    def rollout_cost(self, x0, u_seq, t0=0.0):
+        """
+        Description:
+            Rolls out all candidate input sequences in one batch and accumulates
+            their cost step by step (the predicted trajectories are not stored)
+        Inputs:
+            - x0 (tensor) : initial state [(q1,p1,q2,p2)] or [1, (q1,p1,q2,p2)]
+            - u_seq (tensor) : candidate input sequences [num_samples, horizon]
+            - t0 (float) : time of x0
+        Outputs:
+            - cost (tensor) : cost of each sequence [num_samples]
+        """
+        num_samples = u_seq.shape[0]
+        x = x0.reshape(1, -1)[:, :4].expand(num_samples, 4)
+
+        u_func = self.model.u_func
+        self.model.u_func = U_FUNC(
+            utype="sequence", params={"u_seq": u_seq, "t0": t0, "Ts": self.Ts}
+        )
+        try:
+            cost = self.R * u_seq.pow(2).sum(dim=-1)
+            for k in range(self.horizon):
+                t = torch.tensor(t0 + k * self.Ts, device=x.device, dtype=x.dtype)
+                x = rk4_step(self.model, t, x, self.Ts)
+                Q = self.Q_terminal if k == self.horizon - 1 else self.Q
+                cost = cost + self._state_cost(x, Q)
+        finally:
+            self.model.u_func = u_func
+        return cost
+
+    def solve(self, x, t=0.0):
+        """
+        Description:
+            Optimizes the input sequence from state x and returns its first input
+        Inputs:
+            - x (tensor) : current state, in the coordinates of the model
+            - t (float) : current time
+        Outputs:
+            - u (tensor) : input to apply now (scalar tensor)
+            - info (dict) : lowest cost among the sampled sequences, number of
+                            iterations and solve time in seconds
+        """
+        t_start = time.perf_counter()
+        device = x.device
+
+        # warm start : shift the previous solution by one step
+        if self.u_mean is None:
+            u_mean = torch.zeros(self.horizon, device=device)
+            u_std = torch.full((self.horizon,), self.noise_std, device=device)
+        else:
+            u_mean = torch.cat((self.u_mean[1:], self.u_mean[-1:]))
+            u_std = torch.cat((self.u_std[1:], self.u_std[-1:]))
+            if self.method == "cem":
+                # keep exploring, the std of the previous solution may have collapsed
+                u_std = u_std.clamp(min=0.1 * self.noise_std)
+
+        iterations = 0
+        best_cost = float("inf")
+        with torch.no_grad():
+            while iterations < self.max_iterations:
+                noise = torch.randn(self.num_samples, self.horizon, device=device)
+                u_seq = (u_mean + u_std * noise).clamp(self.u_min, self.u_max)
+                u_seq[0] = u_mean  # always evaluate the current solution
+                cost = self.rollout_cost(x, u_seq, t)
+
+                if self.method == "mppi":
+                    weights = torch.softmax(-(cost - cost.min()) / self.temperature, 0)
+                    u_mean = (weights.unsqueeze(dim=1) * u_seq).sum(dim=0)
+                else:
+                    elites = u_seq[torch.topk(cost, self.num_elites, largest=False)[1]]
+                    u_mean = elites.mean(dim=0)
+                    u_std = elites.std(dim=0)
+
+                best_cost = min(best_cost, cost.min().item())
+                iterations += 1
+
+                # stop if one more iteration would exceed the latency budget
+                elapsed = time.perf_counter() - t_start
+                if self.latency_budget is not None:
+                    if elapsed * (iterations + 1) / iterations > self.latency_budget:
+                        break
+
+        self.u_mean = u_mean
+        self.u_std = u_std
+
+        solve_time = time.perf_counter() - t_start
+        self.latencies.append(solve_time)
+        info = {"cost": best_cost, "iterations": iterations, "solve_time": solve_time}
+        return u_mean[0].clamp(self.u_min, self.u_max), info
+
+    def latency_stats(self):
+        """
+        Returns the mean, p50, p99 and max solve time in seconds over all the calls
+        of solve() so far
+        """
+        if not self.latencies:
+            return {}
+        latencies = torch.tensor(self.latencies)
+        return {
+            "mean": latencies.mean().item(),
+            "p50": torch.quantile(latencies, 0.5).item(),
+            "p99": torch.quantile(latencies, 0.99).item(),
+            "max": latencies.max().item(),
+            "num_solves": len(self.latencies),
+        }
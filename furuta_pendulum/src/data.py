@@ -1,10 +1,7 @@
-from torch.utils.data import Dataset, DataLoader, random_split
+from torch.utils.data import Dataset, DataLoader, Sampler, Subset, random_split
 import torch
 
-from .models import *
-from .dynamics import *
-from .data import *
-from .trajectories import *
+from .trajectories import get_energy_furuta, multiple_trajectories_furuta
 
 
 class TrajectoryDataset_furuta(Dataset):
@@ -19,30 +16,92 @@ class TrajectoryDataset_furuta(Dataset):
         - q2 (tensor) : generalized position q1
         - p2 (tensor) : generalized momentum p2
         - t_eval (tensor) : time at which the coordinates were evaluated
-        - derivatives (tensor) : derivatives evaluated at each time step
+        - derivatives (tensor or None) : derivatives evaluated at each time step
         - coord_type (string) : coordinate system, either "hamiltonian" or "newtonian"
+        - return_index (bool) : if True, __getitem__ also returns the index of the
+                                trajectory (see unpack_batch())
+        - energy (tensor or None) : energy evaluated at each time step
+        - energy_derivatives_fn (callable or None) : returns (energy, derivatives), only
+                                called the first time they are needed (see
+                                energy_derivatives()), in place of energy and derivatives
+        - rescale_stats (tuple or None) : (minimums, denom) [num_trajectories, 1, 4] of
+                                min_max_rescale_trajectories() if the trajectories were
+                                rescaled, see inverse_rescale()
     """
 
-    def __init__(self, q1, p1, q2, p2, t_eval, derivatives, coord_type="hamiltonian"):
+    def __init__(
+        self,
+        q1,
+        p1,
+        q2,
+        p2,
+        t_eval,
+        derivatives=None,
+        coord_type="hamiltonian",
+        return_index=False,
+        energy=None,
+        energy_derivatives_fn=None,
+        rescale_stats=None,
+    ):
         self.t_eval = t_eval
+        self.rescale_stats = rescale_stats
         self.coord_type = coord_type
+        self.return_index = return_index
         self.q1 = q1  # [num_trajectories, time_steps]
         self.p1 = p1  # [num_trajectories, time_steps]
         self.q2 = q2  # [num_trajectories, time_steps]
         self.p2 = p2  # [num_trajectories, time_steps]
 
-        if len(derivatives.shape) == 3:
-            # [num_trajectories, time_steps, (dq1/dt,dp1/dt,dq2/dt,dp2/dt)]
-            self.dq1dt = derivatives[:, :, 0]
-            self.dq2dt = derivatives[:, :, 2]
-        else:
+        self._energy = energy
+        self._derivatives = derivatives
+        self._energy_derivatives_fn = energy_derivatives_fn
+        self._dq1dt = None
+        self._dq2dt = None
+
+    def energy_derivatives(self):
+        """
+        Energy [num_trajectories, time_steps] and derivatives [num_trajectories,
+        time_steps, (dq1/dt,dp1/dt,dq2/dt,dp2/dt)], computed on the first call and
+        cached with the dataset
+        """
+        if self._energy_derivatives_fn is not None:
+            self._energy, self._derivatives = self._energy_derivatives_fn()
+            self._energy_derivatives_fn = None
+        return self._energy, self._derivatives
+
+    def _velocities(self):
+        if self._dq1dt is None:
+            _, derivatives = self.energy_derivatives()
+            if derivatives is None:
+                raise ValueError("the 'newtonian' coordinates need the derivatives")
             # [num_trajectories, time_steps, (dq1/dt,dp1/dt,dq2/dt,dp2/dt)]
-            self.dq1dt = derivatives[:, 0]
-            self.dq2dt = derivatives[:, 2]
+            # or [num_trajectories, (dq1/dt,dp1/dt,dq2/dt,dp2/dt)]
+            self._dq1dt = derivatives[..., 0]
+            self._dq2dt = derivatives[..., 2]
+        return self._dq1dt, self._dq2dt
+
+    @property
+    def dq1dt(self):
+        return self._velocities()[0]
+
+    @property
+    def dq2dt(self):
+        return self._velocities()[1]
 
     def __len__(self):
         return len(self.q1)
 
+    def inverse_rescale(self, x, idx):
+        """
+        Undoes the min max rescaling of load_data_device(min_max_rescale=True) for
+        the trajectories idx, x is [len(idx), time_steps, (q1,p1,q2,p2)]
+        (for plots in the original scale)
+        """
+        if self.rescale_stats is None:
+            return x
+        minimums, denom = self.rescale_stats
+        return min_max_inverse(x, minimums[idx], denom[idx])
+
     def __getitem__(self, idx):
 
         if self.coord_type == "hamiltonian":
@@ -65,9 +124,176 @@ class TrajectoryDataset_furuta(Dataset):
 
         t_eval = self.t_eval
 
+        if self.return_index:
+            return x, t_eval, idx
         return x, t_eval
 
 
+def min_max_rescale_trajectories(q1, p1, q2, p2, rescale_dims=[1, 1, 1, 1]):
+    """
+    Description:
+        Min max scaling of every trajectory to [0, 1], one reduction for the
+        four coordinates
+    Inputs:
+        - q1, p1, q2, p2 (tensors) : generalized coordinates [num_trajectories, time_steps]
+        - rescale_dims (list) : which of (q1,p1,q2,p2) are rescaled
+    Outputs:
+        - q1, p1, q2, p2 (tensors) : rescaled coordinates
+        - minimums, denom (tensors) : [num_trajectories, 1, 4] statistics to invert
+                                      the scaling, see min_max_inverse()
+    """
+    x = torch.stack((q1, p1, q2, p2), dim=-1)
+    minimums, maximums = torch.aminmax(x, dim=1, keepdim=True)
+    denom = maximums - minimums
+    keep = ~torch.tensor(rescale_dims, dtype=torch.bool, device=x.device)
+    minimums[..., keep] = 0
+    denom[..., keep] = 1
+    denom[denom == 0] = 1  # constant coordinate
+    x = (x - minimums) / denom
+    q1, p1, q2, p2 = x.unbind(dim=-1)
+    return q1, p1, q2, p2, minimums, denom
+
+
+def min_max_inverse(x, minimums, denom):
+    """
+    Inverse of min_max_rescale_trajectories(), x is [..., (q1,p1,q2,p2)]
+    """
+    return x * denom + minimums
+
+
+def normalization_stats(dataset, horizon, rescale_dims=[1, 1, 1, 1]):
+    """
+    Description:
+        Maximum, minimum and (max - min) of each coordinate over all the
+        trajectories of a dataset (or of a split made by random_split) and their
+        first horizon time steps, used to rescale the loss (see L2_loss()).
+        Computed in one pass the first time a horizon is asked for and cached
+        with the dataset.
+    Inputs:
+        - dataset (TrajectoryDataset_furuta or Subset) : dataset, for example train_loader.dataset
+        - horizon (int) : number of time steps
+        - rescale_dims (list) : which of (q1,p1,q2,p2) (or of the state_dim coordinates of
+                                a TrajectoryDataset_system) are rescaled, denom is 1 for the others
+    Outputs:
+        - maximums, minimums, denom (tensors) : [1, 1, (q1,p1,q2,p2)], [1, 1, (q1,dq1dt,q2,dq2dt)]
+                                                with newtonian coordinates or [1, 1, state_dim]
+    """
+    cache = dataset.__dict__.setdefault("_normalization_stats", {})
+    key = (horizon, tuple(bool(dim) for dim in rescale_dims))
+    if key not in cache:
+        base, indices = dataset, slice(None)
+        if isinstance(dataset, Subset):
+            base, indices = dataset.dataset, torch.as_tensor(dataset.indices)
+        if hasattr(base, "trajectories"):  # TrajectoryDataset_system
+            coords = base.trajectories.unbind(dim=-1)
+        elif base.coord_type == "newtonian":
+            # same coordinates as the batches, (q1,dq1dt,q2,dq2dt)
+            coords = (base.q1, base.dq1dt, base.q2, base.dq2dt)
+        else:
+            coords = (base.q1, base.p1, base.q2, base.p2)
+        minimums, maximums = [], []
+        for coord in coords:
+            minimum, maximum = torch.aminmax(coord[indices, :horizon])
+            minimums.append(minimum)
+            maximums.append(maximum)
+        minimums = torch.stack(minimums).reshape(1, 1, len(coords))
+        maximums = torch.stack(maximums).reshape(1, 1, len(coords))
+        denom = maximums - minimums
+        keep = ~torch.tensor(key[1], dtype=torch.bool, device=denom.device)
+        denom[..., keep] = 1
+        denom[denom == 0] = 1  # constant coordinate
+        cache[key] = (maximums, minimums, denom)
+    return cache[key]
+
+
+def unpack_batch(batch):
+    """
+    Description:
+        Splits a batch from a data loader into (x, t_eval, idx), idx is None
+        if the dataset does not return the trajectory indices
+    Inputs:
+        - batch (list) : [x, t_eval] or [x, t_eval, idx]
+    Outputs:
+        - x (tensor) : trajectories [batch_size, time_steps, (q1,p1,q2,p2)]
+        - t_eval (tensor) : time steps [batch_size, time_steps]
+        - idx (tensor or None) : index of each trajectory in the full dataset
+    """
+    if len(batch) == 3:
+        return batch[0], batch[1], batch[2]
+    return batch[0], batch[1], None
+
+
+class HardExampleSampler(Sampler):
+    """
+    Description:
+        Sampler that draws the trajectories with a probability that increases with
+        their prediction error (hard example mining). The per trajectory errors
+        are kept in an error index (exponential moving average), updated during
+        training with update(), and the sampling weights are recomputed at the
+        start of every epoch. Also gives per trajectory horizons: trajectories
+        with a small error are trained on a shorter horizon.
+    Inputs:
+        - indices (list or tensor) : indices in the full dataset of the trajectories
+                                     that can be sampled (train_dataset.indices)
+        - num_trajectories (int) : size of the full dataset
+        - power (float) : weights are proportional to error**power
+        - uniform_mix (float) : proportion of the weights that is uniform, so that
+                                easy trajectories are still sampled
+        - momentum (float) : momentum of the moving average of the errors
+        - min_horizon_fraction (float) : shortest per trajectory horizon, as a fraction
+                                         of the current horizon
+    """
+
+    def __init__(
+        self,
+        indices,
+        num_trajectories,
+        power=1.0,
+        uniform_mix=0.2,
+        momentum=0.5,
+        min_horizon_fraction=0.25,
+    ):
+        self.indices = torch.as_tensor(indices, dtype=torch.long)
+        self.errors = torch.ones(num_trajectories)  # error index
+        self.power = power
+        self.uniform_mix = uniform_mix
+        self.momentum = momentum
+        self.min_horizon_fraction = min_horizon_fraction
+
+    def __len__(self):
+        return len(self.indices)
+
+    def weights(self):
+        """
+        Sampling probability of each position of indices
+        """
+        e = self.errors[self.indices].pow(self.power)
+        return (1 - self.uniform_mix) * e / e.sum() + self.uniform_mix / len(e)
+
+    def __iter__(self):
+        positions = torch.multinomial(self.weights(), len(self), replacement=True)
+        return iter(positions.tolist())
+
+    def update(self, idx, errors):
+        """
+        Update the error index with the errors [batch_size] of trajectories idx
+        """
+        idx = torch.as_tensor(idx, dtype=torch.long).cpu()
+        errors = errors.detach().float().cpu()
+        self.errors[idx] = self.momentum * self.errors[idx] + (1 - self.momentum) * errors
+
+    def sample_horizons(self, idx, horizon):
+        """
+        Per trajectory horizons [batch_size], between min_horizon_fraction*horizon
+        for the easiest trajectories and horizon for the hardest one
+        """
+        idx = torch.as_tensor(idx, dtype=torch.long).cpu()
+        difficulty = self.errors[idx] / self.errors[self.indices].max()
+        fraction = self.min_horizon_fraction + (1 - self.min_horizon_fraction) * difficulty
+        horizons = torch.ceil(fraction * horizon).long()
+        return horizons.clamp(min=1, max=horizon)
+
+
 def data_loader_furuta(
     q1,
     p1,
@@ -80,17 +306,54 @@ def data_loader_furuta(
     shuffle=True,
     proportion=0.5,
     coord_type="hamiltonian",
+    hard_mining=False,
+    return_index=False,
+    energy_derivatives_fn=None,
+    rescale_stats=None,
 ):
     """
     Description:
-        Creates train and test data loaders when given the trajectories
+        Creates train and test data loaders when given the trajectories,
+        with return_index the batches also contain the trajectory indices
+        (needed with one input per trajectory, see U_FUNC.select()).
+        energy and derivatives can be None and given lazily by
+        energy_derivatives_fn, see TrajectoryDataset_furuta
 
     See the load_data_device() docstring for more info
     """
     # split  into train and test
     full_dataset = TrajectoryDataset_furuta(
-        q1, p1, q2, p2, t_eval, derivatives, coord_type=coord_type
+        q1,
+        p1,
+        q2,
+        p2,
+        t_eval,
+        derivatives,
+        coord_type=coord_type,
+        return_index=hard_mining or return_index,
+        energy=energy,
+        energy_derivatives_fn=energy_derivatives_fn,
+        rescale_stats=rescale_stats,
     )
+    return split_loaders(full_dataset, batch_size, shuffle, proportion, hard_mining)
+
+
+def split_loaders(full_dataset, batch_size, shuffle=True, proportion=0.5, hard_mining=False):
+    """
+    Description:
+        Random train / test split of a dataset and their data loaders, the train
+        loader samples with a HardExampleSampler if hard_mining (the dataset must
+        then return the trajectory indices)
+    Inputs:
+        - full_dataset (Dataset) : all the trajectories
+        - batch_size (int) : batch size of both loaders
+        - shuffle (bool) : shuffle the trajectories
+        - proportion (float or None) : proportion of the train split, no split
+                                       (test_loader is None) if None
+        - hard_mining (bool) : hard example mining, see HardExampleSampler
+    Outputs:
+        - train_loader, test_loader (DataLoader)
+    """
     if proportion:
 
         train_size = int(proportion * len(full_dataset))
@@ -105,11 +368,66 @@ def data_loader_furuta(
         test_loader = None
 
     # create the dataloader object from the custom dataset
-    train_loader = DataLoader(train_dataset, batch_size, shuffle)
+    if hard_mining:
+        if proportion:
+            indices = train_dataset.indices
+        else:
+            indices = range(len(full_dataset))
+        sampler = HardExampleSampler(indices, len(full_dataset))
+        train_loader = DataLoader(train_dataset, batch_size, sampler=sampler)
+    else:
+        train_loader = DataLoader(train_dataset, batch_size, shuffle)
 
     return train_loader, test_loader
 
 
+class TrajectoryDataset_system(Dataset):
+    """
+    Description:
+        Dataset of the trajectories of any system (see PortHamiltonianSystem),
+        the batches have the layout of TrajectoryDataset_furuta
+    Inputs:
+        - trajectories (tensor) : states [num_trajectories, time_steps, state_dim]
+        - t_eval (tensor) : time at which the states were evaluated [time_steps]
+        - return_index (bool) : if True, __getitem__ also returns the index of the
+                                trajectory (see unpack_batch())
+    """
+
+    def __init__(self, trajectories, t_eval, return_index=False):
+        self.trajectories = trajectories
+        self.t_eval = t_eval
+        self.return_index = return_index
+        self.coord_type = "hamiltonian"
+
+    def __len__(self):
+        return len(self.trajectories)
+
+    def __getitem__(self, idx):
+        if self.return_index:
+            return self.trajectories[idx], self.t_eval, idx
+        return self.trajectories[idx], self.t_eval
+
+
+def data_loader_system(
+    trajectories,
+    t_eval,
+    batch_size,
+    shuffle=True,
+    proportion=0.5,
+    hard_mining=False,
+    return_index=False,
+):
+    """
+    Description:
+        Train and test data loaders of the trajectories [num_trajectories,
+        time_steps, state_dim] of any system, see data_loader_furuta()
+    """
+    full_dataset = TrajectoryDataset_system(
+        trajectories, t_eval, return_index=hard_mining or return_index
+    )
+    return split_loaders(full_dataset, batch_size, shuffle, proportion, hard_mining)
+
+
 def load_data_device(
     device,
     init_method,
@@ -133,6 +451,11 @@ def load_data_device(
     Lp=0.5,
     min_max_rescale=False,
     rescale_dims=[1, 1, 1, 1],
+    hard_mining=False,
+    method="rk4",
+    rtol=1e-7,
+    atol=1e-9,
+    backend="torch",
 ):
     """
     Description:
@@ -144,7 +467,9 @@ def load_data_device(
         - init_method (string) : how to generate the random initial conditions 
                                 (see get_init_state()'s docstring)
         - w_rescale (list): list containing how the coordinates were rescaled
-        - u_func (class) : class which containes the input function
+        - u_func (class) : class which containes the input function, with one input
+                           per trajectory (for example sample_excitation()) the loaders
+                           also return the trajectory indices, see U_FUNC.select()
         - g_func (class) : class which containes the input matrix
         - time_steps (int) : number of desired time steps
                             (simulate the furta for a number time_steps of time steps)
@@ -158,17 +483,26 @@ def load_data_device(
         - C_q1 (float) : coefficient of friction related to p1 ( and q1)
         - C_q2 (float) : coefficient of friction related to p2 ( and q2)
         - g, Jr, Lr, Mp, Lp (Float) : furuta pendulum parameters
-        - min_max_rescale (bool) : perform min max scaling on training and testing set
-        - rescale_dims (list or bool) : which coordinates have been rescaled 
+        - min_max_rescale (bool) : perform min max scaling of every trajectory (see
+                                   min_max_rescale_trajectories()), the dataset keeps the
+                                   statistics to invert it (inverse_rescale())
+        - rescale_dims (list or bool) : which coordinates have been rescaled, in the
+                                        order (q1,p1,q2,p2)
                                     example : w = [1,1,1,1]
                                               w = [1,1,1,0]
+        - hard_mining (bool) : sample the training trajectories with HardExampleSampler
+                               and train each one on its own horizon
+        - method (string) : integrator of the ground truth, 'rk4' or 'dopri5'
+        - rtol, atol (float) : tolerances of 'dopri5' (see get_trajectory_furuta())
+        - backend (string) : 'torch' or 'numpy' (autograd free simulation, see
+                             multiple_trajectories_furuta())
 
     Outputs:
         train_loader (data loader object) : train loader
         test_loader (data loader object) : test loader
     """
     # create trajectories
-    q1, p1, q2, p2, energy, derivatives, t_eval = multiple_trajectories_furuta(
+    q1, p1, q2, p2, _, _, t_eval = multiple_trajectories_furuta(
         "cpu",
         init_method,
         time_steps,
@@ -185,33 +519,47 @@ def load_data_device(
         Lr,
         Mp,
         Lp,
+        method=method,
+        rtol=rtol,
+        atol=atol,
+        backend=backend,
+        energ_deriv=False,
     )
 
+    # energy and derivatives are only used by the "newtonian" coordinates, they are
+    # computed from the unscaled trajectories the first time they are needed
+    trajectories = (q1, p1, q2, p2)
+
+    def energy_derivatives_fn():
+        energy, derivatives = get_energy_furuta(
+            "cpu",
+            time_steps,
+            Ts,
+            u_func,
+            g_func,
+            *trajectories,
+            C_q1,
+            C_q2,
+            g,
+            Jr,
+            Lr,
+            Mp,
+            Lp,
+        )
+        return energy.detach().to(device), derivatives.detach().to(device)
+
     q1 = (q1 * w_rescale[0]).detach().to(device)
     p1 = (p1 * w_rescale[1]).detach().to(device)
     q2 = (q2 * w_rescale[2]).detach().to(device)
     p2 = (p2 * w_rescale[3]).detach().to(device)
 
+    rescale_stats = None
     if min_max_rescale:
-        if rescale_dims[0]:
-            q1 = (q1 - q1.amin(dim=(1)).unsqueeze(dim=1)) / (
-                (q1.amax(dim=(1)) - q1.amin(dim=(1))).abs().unsqueeze(dim=1)
-            )
-        if rescale_dims[1]:
-            q2 = (q2 - q2.amin(dim=(1)).unsqueeze(dim=1)) / (
-                (q2.amax(dim=(1)) - q2.amin(dim=(1))).abs().unsqueeze(dim=1)
-            )
-        if rescale_dims[2]:
-            p1 = (p1 - p1.amin(dim=(1)).unsqueeze(dim=1)) / (
-                (p1.amax(dim=(1)) - p1.amin(dim=(1))).abs().unsqueeze(dim=1)
-            )
-        if rescale_dims[3]:
-            p2 = (p2 - p2.amin(dim=(1)).unsqueeze(dim=1)) / (
-                (p2.amax(dim=(1)) - p2.amin(dim=(1))).abs().unsqueeze(dim=1)
-            )
-
-    energy = energy.detach().to(device)
-    derivatives = derivatives.detach().to(device)
+        q1, p1, q2, p2, minimums, denom = min_max_rescale_trajectories(
+            q1, p1, q2, p2, rescale_dims
+        )
+        rescale_stats = (minimums, denom)
+
     t_eval = t_eval.detach().to(device)
 
     # dataloader to load data in batches
@@ -220,12 +568,16 @@ def load_data_device(
         p1,
         q2,
         p2,
-        energy,
-        derivatives,
+        None,
+        None,
         t_eval,
         batch_size=batch_size,
         shuffle=shuffle,
         proportion=proportion,
         coord_type=coord_type,
+        hard_mining=hard_mining,
+        return_index=u_func is not None and u_func.per_trajectory(),
+        energy_derivatives_fn=energy_derivatives_fn,
+        rescale_stats=rescale_stats,
     )
     return train_loader, test_loader
@@ -1,5 +1,8 @@
+import copy
+
 import torch
-from torchdiffeq import odeint as odeint
+
+from .dynamics_numpy import furuta_constants
 
 
 def furuta_H(q1, p1, q2, p2, g, Jr, Lr, Mp, Lp):
@@ -69,6 +72,38 @@ def hamiltonian_fn_furuta(coords, g, Jr, Lr, Mp, Lp):
     return H
 
 
+def furuta_dH(coords, g, Jr, Lr, Mp, Lp):
+    """
+    Description:
+        Closed form gradient of furuta_H() w.r.t. the generalized coordinates,
+        same values as autograd on hamiltonian_fn_furuta() without building a graph
+        (see furuta_dH_numpy() for the derivation)
+
+    Inputs:
+        - coords (tensor): generalized coordinates [..., (q1,p1,q2,p2)]
+        - g, Jr, Lr, Mp, Lp (floats): furuta pendulum parameters
+
+    Outputs:
+        - dHdq1, dHdp1, dHdq2, dHdp2 (tensors): gradient, each [..., 1]
+    """
+    C1, C2, C3, C4, C5 = furuta_constants(g, Jr, Lr, Mp, Lp)
+    q1, p1, q2, p2 = torch.chunk(coords, 4, dim=-1)
+    s = torch.sin(q1)
+    c = torch.cos(q1)
+
+    # H = 0.5 * N / D + C5 * (cos(q1) + 1)
+    N = p1**2 * (C1 + C2 * s**2) + C4 * p2**2 - 2 * p1 * p2 * C3 * c
+    D = C1 * C4 + C4 * C2 * s**2 - C3**2 * c**2
+    dN = 2 * C2 * s * c * p1**2 + 2 * p1 * p2 * C3 * s
+    dD = 2 * s * c * (C4 * C2 + C3**2)
+
+    dHdq1 = 0.5 * (dN * D - N * dD) / D**2 - C5 * s
+    dHdp1 = (p1 * (C1 + C2 * s**2) - p2 * C3 * c) / D
+    dHdq2 = torch.zeros_like(q2)
+    dHdp2 = (C4 * p2 - p1 * C3 * c) / D
+    return dHdq1, dHdp1, dHdq2, dHdp2
+
+
 def coord_derivatives_furuta(t, coords, C_q1, C_q2, g, Jr, Lr, Mp, Lp, u_func, g_func):
     """
     Description:
@@ -95,19 +130,23 @@ def coord_derivatives_furuta(t, coords, C_q1, C_q2, g, Jr, Lr, Mp, Lp, u_func, g
     dHdq1, dHdp1, dHdq2, dHdp2 = torch.chunk(dcoords[0], 4, dim=-1)
 
     # evaluate input scalar u and matrix G
-    U = u_func.forward(t)
+    # u is a scalar or one input per trajectory [batch_size], as a column it
+    # broadcasts against the columns of G [batch_size, 4]
+    U = u_func.forward(t).reshape(-1, 1)
     G = g_func.forward(coords)
 
     # symplectic gradient / derivatives of the generalized coordinates w.r.t time
-    dq1dt = dHdp1 + (U * G[:, 0]).unsqueeze(dim=1)
-    dp1dt = -dHdq1 - C_q1 * dHdp1 + (U * G[:, 1]).unsqueeze(dim=1)
-    dq2dt = dHdp2 + (U * G[:, 2]).unsqueeze(dim=1)
-    dp2dt = -dHdq2 - C_q2 * dHdp2 + (U * G[:, 3]).unsqueeze(dim=1)
+    dq1dt = dHdp1 + U * G[:, 0:1]
+    dp1dt = -dHdq1 - C_q1 * dHdp1 + U * G[:, 1:2]
+    dq2dt = dHdp2 + U * G[:, 2:3]
+    dp2dt = -dHdq2 - C_q2 * dHdp2 + U * G[:, 3:4]
 
     return dq1dt, dp1dt, dq2dt, dp2dt
 
 
-def dynamics_fn_furuta(t, coords, C_q1, C_q2, g, Jr, Lr, Mp, Lp, u_func, g_func):
+def dynamics_fn_furuta(
+    t, coords, C_q1, C_q2, g, Jr, Lr, Mp, Lp, u_func, g_func, nfe_counter=None
+):
     """
     Description:
         Function that returns the gradient (in form of a function) of a Hamiltonian function
@@ -120,6 +159,7 @@ def dynamics_fn_furuta(t, coords, C_q1, C_q2, g, Jr, Lr, Mp, Lp, u_func, g_func)
         - g, Jr, Lr, Mp, Lp (floats): furuta pendulum parameters
         - u_func (function): input scalar function
         - g_func (function): input matrix function
+        - nfe_counter (NFECounter or None): counts the evaluations of the dynamics
 
     Outputs:
         - S (tensor): Symplectic gradient / derivatives of the generalized coordinates w.r.t time
@@ -133,9 +173,53 @@ def dynamics_fn_furuta(t, coords, C_q1, C_q2, g, Jr, Lr, Mp, Lp, u_func, g_func)
     )
 
     S = torch.hstack((dq1dt, dp1dt, dq2dt, dp2dt))
+    if nfe_counter is not None:
+        nfe_counter.forward(S)
     return S
 
 
+class NFECounter:
+    """
+    Description:
+        Counts the number of function evaluations (NFE) of a vector field (a model
+        or the ground truth dynamics):
+            - forward : number of evaluations of the vector field
+            - backward : number of evaluations through which a gradient was
+                         propagated (backward pass through odeint, for example)
+        Together with the time spent in the rollout (see PhaseTimer) it gives the
+        cost of one evaluation, which is what changes with the integrator and Ts.
+    Methods:
+        - forward(output) : count one evaluation whose result is output
+        - reset() : set the counts to zero
+        - read() : dict with the forward and backward counts
+
+    Example use :
+        model.nfe_counter.reset()
+        x_hat = odeint(model, x0, t_eval, method="rk4", options=dict(step_size=Ts))
+        loss.backward()
+        model.nfe_counter.read()  # {"forward": 4*(len(t_eval)-1), "backward": ...}
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.forward_count = 0
+        self.backward_count = 0
+
+    def _count_backward(self, grad):
+        self.backward_count += 1
+
+    def forward(self, output):
+        self.forward_count += 1
+        if output.requires_grad:
+            output.register_hook(self._count_backward)
+        return output
+
+    def read(self):
+        return {"forward": self.forward_count, "backward": self.backward_count}
+
+
 """ Input functions """
 
 
@@ -207,6 +291,202 @@ def step_fun(t, t1=0.05, scale=0.1):
     return f
 
 
+def sequence_fun(t, u_seq, t0=0.0, Ts=0.005):
+    """
+    Description:
+        Open loop input sequence held constant during each sampling period
+        (zero order hold) evaluated at t
+    Inputs:
+        - t (tensor) : time (scalar) or time steps [time_steps] at which it is evaluated
+        - u_seq (tensor) : input sequence [sequence_length] or one sequence per
+                           trajectory [batch_size, sequence_length]
+        - t0 (float) : time of the first element of u_seq
+        - Ts (float) : sampling time of u_seq
+    Outputs:
+        - (tensor) : input at t, [batch_size] or [batch_size, time_steps] if one
+                     sequence per trajectory is given
+    """
+    t = torch.as_tensor(t, device=u_seq.device)
+    # small tolerance so that t = t0 + k*Ts returns u_seq[k] despite rounding
+    idx = torch.floor((t - t0) / Ts + 1e-6).long().clamp(0, u_seq.shape[-1] - 1)
+    return u_seq[..., idx]
+
+
+def _recorded_position(t, t_rec=None, t0=0.0, Ts=None):
+    """
+    Index k of the sample before t (t_rec[k] <= t < t_rec[k+1]) and time of the
+    samples, with a binary search if the grid t_rec is not uniform
+    """
+    if t_rec is None:
+        # small tolerance so that t = t0 + k*Ts returns sample k despite rounding
+        k = torch.floor((t - t0) / Ts + 1e-6).long()
+        times = lambda i: t0 + i * Ts
+    else:
+        t_flat = t.reshape(-1).contiguous()
+        k = torch.searchsorted(t_rec, t_flat, right=True).reshape(t.shape) - 1
+        times = lambda i: t_rec[i]
+    return k, times
+
+
+def recorded_fun(t, u_rec, t_rec=None, t0=0.0, Ts=None, interp="linear"):
+    """
+    Description:
+        Recorded (tabulated) input interpolated at t. The same time t is used for
+        all the trajectories so one gather gives the input of the whole batch.
+        Before the first and after the last sample the input is held constant.
+    Inputs:
+        - t (tensor) : time (scalar) or time steps [time_steps] at which it is evaluated
+        - u_rec (tensor) : recorded input [num_samples] or one recording per
+                           trajectory [batch_size, num_samples]
+        - t_rec (tensor or None) : increasing times of the samples [num_samples],
+                                   can be non uniform
+        - t0, Ts (float) : time of the first sample and sampling time, only used
+                           if t_rec is None (uniform grid)
+        - interp (string) : 'zoh' (zero order hold), 'linear' or 'cubic'
+                            (cubic Hermite, slopes from finite differences)
+    Outputs:
+        - (tensor) : input at t, [batch_size] or [batch_size, time_steps] if one
+                     recording per trajectory is given
+    """
+    t = torch.as_tensor(t, device=u_rec.device, dtype=u_rec.dtype)
+    n = u_rec.shape[-1]
+    k, times = _recorded_position(t, t_rec, t0, Ts)
+
+    if interp == "zoh" or n == 1:
+        return u_rec[..., k.clamp(0, n - 1)]
+
+    k = k.clamp(0, n - 2)
+    t_k = times(k)
+    t_k1 = times(k + 1)
+    # fraction of the interval, clamped to hold the end values outside the recording
+    s = ((t - t_k) / (t_k1 - t_k)).clamp(0, 1)
+    u_k = u_rec[..., k]
+    u_k1 = u_rec[..., k + 1]
+
+    if interp == "linear":
+        return u_k + s * (u_k1 - u_k)
+    if interp != "cubic":
+        raise ValueError("interp must be 'zoh', 'linear' or 'cubic'")
+
+    # slopes at t_k and t_k1 (one sided at the ends of the recording)
+    k_prev = (k - 1).clamp(min=0)
+    k_next = (k + 2).clamp(max=n - 1)
+    m_k = (u_k1 - u_rec[..., k_prev]) / (t_k1 - times(k_prev))
+    m_k1 = (u_rec[..., k_next] - u_k) / (times(k_next) - t_k)
+    h = t_k1 - t_k
+    s2 = s**2
+    s3 = s**3
+    return (
+        (2 * s3 - 3 * s2 + 1) * u_k
+        + (s3 - 2 * s2 + s) * h * m_k
+        + (-2 * s3 + 3 * s2) * u_k1
+        + (s3 - s2) * h * m_k1
+    )
+
+
+def excitation_fun(t, params):
+    """
+    Description:
+        Excitation with its own parameters for every trajectory (see
+        sample_excitation()), evaluated for the whole batch at once. Each trajectory
+        is a chirp, a multisine or a step, the three families are computed for all
+        the trajectories and the family of each trajectory is selected.
+    Inputs:
+        - t (tensor) : time (scalar) or time steps [time_steps] at which it is evaluated
+        - params (dict) : per trajectory parameters
+                          'family' [batch_size] : 0 chirp, 1 multisine, 2 step
+                          'chirp_f0', 'chirp_f1', 'chirp_T' [batch_size]
+                          'multisine_amp', 'multisine_freq', 'multisine_phase'
+                          [batch_size, num_components]
+                          'step_time' [batch_size]
+                          'amplitude' [batch_size]
+    Outputs:
+        - (tensor) : input at t, [batch_size] or [batch_size, time_steps]
+    """
+    amplitude = params["amplitude"]
+    t = torch.as_tensor(t, device=amplitude.device, dtype=amplitude.dtype)
+    t_row = t.reshape(1, -1)  # [1, time_steps], broadcasts against [batch_size, 1]
+    column = lambda name: params[name].unsqueeze(dim=1)
+
+    c = (column("chirp_f1") - column("chirp_f0")) / column("chirp_T")
+    chirp = torch.sin(2 * torch.pi * (c * t_row**2 / 2 + column("chirp_f0") * t_row))
+
+    # [batch_size, num_components, time_steps] summed over the components
+    multisine = (
+        params["multisine_amp"].unsqueeze(dim=2)
+        * torch.sin(
+            2 * torch.pi * params["multisine_freq"].unsqueeze(dim=2) * t_row.unsqueeze(dim=1)
+            + params["multisine_phase"].unsqueeze(dim=2)
+        )
+    ).sum(dim=1)
+
+    step = (t_row >= column("step_time")).to(t.dtype)
+
+    family = column("family")
+    u = torch.where(family == 0, chirp, torch.where(family == 1, multisine, step))
+    u = u * column("amplitude")
+    return u.reshape(amplitude.shape + t.shape)
+
+
+def sample_excitation(
+    num_trajectories,
+    families=("chirp", "multisine", "step"),
+    amplitude=(0.5, 1.0),
+    chirp_f0=(0.1, 2.0),
+    chirp_f1=(5.0, 20.0),
+    chirp_T=(1.0, 2.0),
+    multisine_components=4,
+    multisine_freq=(0.5, 10.0),
+    step_time=(0.0, 1.0),
+    device="cpu",
+    generator=None,
+):
+    """
+    Description:
+        Samples uniformly the parameters of a different excitation for every
+        trajectory (family, chirp frequencies, multisine amplitudes, frequencies
+        and phases, step times) with a few batched draws.
+    Inputs:
+        - num_trajectories (int) : number of trajectories
+        - families (tuple) : families among 'chirp', 'multisine' and 'step', each
+                             trajectory gets one of them with equal probability
+        - amplitude (tuple) : (min, max) amplitude of the input
+        - chirp_f0, chirp_f1 (tuple) : (min, max) start and end frequencies of the chirps
+        - chirp_T (tuple) : (min, max) time at which the chirps reach chirp_f1
+        - multisine_components (int) : number of sines of the multisines
+        - multisine_freq (tuple) : (min, max) frequency of the sines, their amplitudes
+                                   are uniform and normalized to sum to 1
+        - step_time (tuple) : (min, max) time of the steps
+        - device (string) : device of the parameters
+        - generator (torch.Generator or None) : random generator, for reproducible datasets
+    Outputs:
+        - u_func (U_FUNC) : input function with utype 'excitation', u_func.forward(t)
+                            has shape [num_trajectories]
+    """
+    codes = {"chirp": 0, "multisine": 1, "step": 2}
+    family_codes = torch.tensor([codes[family] for family in families])
+    uniform = lambda bounds, *shape: bounds[0] + (bounds[1] - bounds[0]) * torch.rand(
+        (num_trajectories,) + shape, generator=generator
+    )
+
+    multisine_amp = torch.rand(num_trajectories, multisine_components, generator=generator)
+    params = {
+        "family": family_codes[
+            torch.randint(len(families), (num_trajectories,), generator=generator)
+        ],
+        "amplitude": uniform(amplitude),
+        "chirp_f0": uniform(chirp_f0),
+        "chirp_f1": uniform(chirp_f1),
+        "chirp_T": uniform(chirp_T),
+        "multisine_amp": multisine_amp / multisine_amp.sum(dim=1, keepdim=True),
+        "multisine_freq": uniform(multisine_freq, multisine_components),
+        "multisine_phase": uniform((0.0, 2 * torch.pi), multisine_components),
+        "step_time": uniform(step_time),
+    }
+    params = {key: value.to(device) for key, value in params.items()}
+    return U_FUNC(utype="excitation", params=params)
+
+
 class U_FUNC:
     """
     Description:
@@ -218,10 +498,27 @@ class U_FUNC:
                                     'tanh'
                                     'multisine'
                                     'step'
+                                    'sequence' : open loop sequence params["u_seq"]
+                                                 ([sequence_length] or [batch_size,
+                                                 sequence_length]) starting at params["t0"]
+                                                 with sampling time params["Ts"], see sequence_fun()
+                                    'recorded' : recorded input params["u_rec"] ([num_samples]
+                                                 or [batch_size, num_samples]) at the times
+                                                 params["t_rec"] (or params["t0"] + k*params["Ts"])
+                                                 interpolated with params["interp"] ('zoh',
+                                                 'linear' or 'cubic'), see recorded_fun()
+                                    'excitation' : different chirp, multisine or step for
+                                                   every trajectory, see sample_excitation()
                                     None
+        - params (dict or None) : parameters of the input function, they replace the
+                                  default ones (copied, the dict is not modified)
     Methods:
         - forward(self, t) : use time t to evalute the chosen
                             input function at time t
+        - select(idx) : input function of the trajectories idx of a batch, the
+                        'sequence', 'recorded' and 'excitation' inputs of the
+                        other trajectories are dropped
+        - per_trajectory() : True if every trajectory has its own input
 
     Example use : 
         # instantiate the class
@@ -235,14 +532,16 @@ class U_FUNC:
         evaluation = input_function.forward(t) 
     """
 
-    def __init__(self, utype=None, params={}):
+    default_params = {"T": 1.5, "f0": 1, "f1": 10, "scale": 1}
+
+    def __init__(self, utype=None, params=None):
         super(U_FUNC).__init__()
         self.utype = utype
-        self.params = params  # dict containing parameters for the input function
-        self.params["T"] = 1.5
-        self.params["f0"] = 1
-        self.params["f1"] = 10
-        self.params["scale"] = 1
+        # dict containing parameters for the input function, a new dict for every
+        # instance so that changing the params of one input does not change the others
+        self.params = dict(self.default_params)
+        if params is not None:
+            self.params.update(params)
 
     def forward(self, t):
         """time dependent input"""
@@ -262,11 +561,70 @@ class U_FUNC:
             u = multi_sine(t, scale=self.params["scale"])
         elif self.utype == "step":
             u = step_fun(t, t1=0.5)
+        elif self.utype == "sequence":
+            u = sequence_fun(
+                t,
+                self.params["u_seq"],
+                t0=self.params.get("t0", 0.0),
+                Ts=self.params["Ts"],
+            )
+        elif self.utype == "recorded":
+            u = recorded_fun(
+                t,
+                self.params["u_rec"],
+                t_rec=self.params.get("t_rec"),
+                t0=self.params.get("t0", 0.0),
+                Ts=self.params.get("Ts"),
+                interp=self.params.get("interp", "linear"),
+            )
+        elif self.utype == "excitation":
+            u = excitation_fun(t, self.params)
         elif self.utype is None:
             u = torch.zeros(t.shape, device=t.device)
         u.requires_grad = False
         return u
 
+    # parameters holding one row per trajectory, with their number of dimensions
+    batched_params = {
+        "u_seq": 2,
+        "u_rec": 2,
+        "family": 1,
+        "amplitude": 1,
+        "chirp_f0": 1,
+        "chirp_f1": 1,
+        "chirp_T": 1,
+        "multisine_amp": 2,
+        "multisine_freq": 2,
+        "multisine_phase": 2,
+        "step_time": 1,
+    }
+
+    def _batched_keys(self):
+        return [
+            key
+            for key, ndim in self.batched_params.items()
+            if torch.is_tensor(self.params.get(key)) and self.params[key].dim() == ndim
+        ]
+
+    def per_trajectory(self):
+        return len(self._batched_keys()) > 0
+
+    def select(self, idx):
+        """
+        Input function restricted to the trajectories idx (for example the
+        indices returned by the data loader, see unpack_batch()). Signals shared
+        by all the trajectories are returned unchanged.
+        """
+        keys = self._batched_keys()
+        if not keys:
+            return self
+        params = dict(self.params)
+        for key in keys:
+            params[key] = params[key][idx.to(params[key].device)]
+        u_func = copy.copy(self)
+        u_func.params = params
+        return u_func
+
 
 class G_FUNC:
     """
@@ -287,10 +645,10 @@ class G_FUNC:
         evaluation = g_function.forward(coords) # coords contains (q1,p1,q2,p2)
     """
 
-    def __init__(self, gtype=None, params={}):
+    def __init__(self, gtype=None, params=None):
         super(G_FUNC).__init__()
         self.gtype = gtype
-        self.params = params  # dict containing parameters
+        self.params = dict(params or {})  # dict containing parameters
 
     def forward(self, coords):
         """state dependent input"""
@@ -0,0 +1,123 @@
+import numpy as np
+import torch
+
+""" NUMPY GROUND TRUTH
+
+Autograd free simulation of the furuta pendulum used to generate datasets : the
+derivatives of furuta_H() are written in closed form and all the trajectories are
+integrated at once with the same fixed step rk4 (3/8 rule) as odeint(method="rk4"),
+so there is no graph or dispatcher overhead.
+See multiple_trajectories_furuta(backend="numpy")
+"""
+
+
+def furuta_constants(g, Jr, Lr, Mp, Lp):
+    """
+    Constants C1, .., C5 of furuta_H()
+    """
+    Jp = (1 / 12) * Mp * Lp**2
+    C1 = Jr + Mp * Lr**2
+    C2 = (1 / 4) * Mp * Lp**2
+    C3 = (-1 / 2) * Mp * Lp * Lr
+    C4 = Jp + C2
+    C5 = (1 / 2) * Mp * g * Lp
+    return C1, C2, C3, C4, C5
+
+
+def furuta_dH_numpy(x, constants):
+    """
+    Description:
+        Closed form gradient of furuta_H() w.r.t. the generalized coordinates
+    Inputs:
+        - x (ndarray) : generalized coordinates [..., (q1,p1,q2,p2)]
+        - constants (tuple) : C1, .., C5 from furuta_constants()
+    Outputs:
+        - dHdq1, dHdp1, dHdq2, dHdp2 (ndarray) : gradient, each with shape x.shape[:-1]
+    """
+    C1, C2, C3, C4, C5 = constants
+    q1, p1, p2 = x[..., 0], x[..., 1], x[..., 3]
+    s = np.sin(q1)
+    c = np.cos(q1)
+
+    # H = 0.5 * N / D + C5 * (cos(q1) + 1)
+    N = p1**2 * (C1 + C2 * s**2) + C4 * p2**2 - 2 * p1 * p2 * C3 * c
+    D = C1 * C4 + C4 * C2 * s**2 - C3**2 * c**2
+    dN = 2 * C2 * s * c * p1**2 + 2 * p1 * p2 * C3 * s
+    dD = 2 * s * c * (C4 * C2 + C3**2)
+
+    dHdq1 = 0.5 * (dN * D - N * dD) / D**2 - C5 * s
+    dHdp1 = (p1 * (C1 + C2 * s**2) - p2 * C3 * c) / D
+    dHdq2 = np.zeros_like(q1)
+    dHdp2 = (C4 * p2 - p1 * C3 * c) / D
+    return dHdq1, dHdp1, dHdq2, dHdp2
+
+
+def furuta_dynamics_numpy(x, U_G, C_q1, C_q2, constants):
+    """
+    Description:
+        Same vector field as dynamics_fn_furuta() without autograd
+    Inputs:
+        - x (ndarray) : generalized coordinates [num_trajectories, (q1,p1,q2,p2)]
+        - U_G (ndarray) : input times input matrix u(t)*G [num_trajectories or 1, 4]
+        - C_q1, C_q2 (float) : friction coefficients
+        - constants (tuple) : C1, .., C5 from furuta_constants()
+    Outputs:
+        - dxdt (ndarray) : derivatives [num_trajectories, (q1,p1,q2,p2)]
+    """
+    dHdq1, dHdp1, dHdq2, dHdp2 = furuta_dH_numpy(x, constants)
+    dxdt = np.stack(
+        (dHdp1, -dHdq1 - C_q1 * dHdp1, dHdp2, -dHdq2 - C_q2 * dHdp2), axis=-1
+    )
+    return dxdt + U_G
+
+
+def tabulate_input(u_func, g_func, times):
+    """
+    Description:
+        Evaluates u_func once at all the given times and multiplies it by the
+        input matrix. The input matrices of G_FUNC do not depend on the state,
+        so G is evaluated once.
+    Inputs:
+        - u_func (U_FUNC) : input function
+        - g_func (G_FUNC) : input matrix
+        - times (ndarray) : times at which u is needed [num_times]
+    Outputs:
+        - U_G (ndarray) : u(t)*G [num_times, num_trajectories or 1, 4]
+    """
+    t = torch.tensor(times, dtype=torch.float32)
+    U = u_func.forward(t).detach().cpu().double().numpy()
+    G = g_func.forward(torch.zeros(1, 4)).detach().cpu().double().numpy()
+    G = G.reshape(-1)[:4]
+
+    if U.ndim == 1:
+        U = U[:, None]  # same input for every trajectory
+    else:
+        # one input per trajectory (U_FUNC 'sequence'), [num_times, num_trajectories]
+        U = U.T
+    return U[..., None] * G
+
+
+def rk4_numpy(f, x0, Ts, steps, U_G):
+    """
+    Description:
+        Fixed step rk4 (3/8 rule, the scheme of odeint(method="rk4")) on all the
+        trajectories at once
+    Inputs:
+        - f (callable) : vector field f(x, U_G)
+        - x0 (ndarray) : initial states [num_trajectories, dim]
+        - Ts (float) : step size
+        - steps (int) : number of steps
+        - U_G (ndarray) : input at the stage times t + Ts*(0, 1/3, 2/3, 1) of every
+                          step [steps, 4, num_trajectories or 1, dim]
+    Outputs:
+        - x (ndarray) : trajectory [steps + 1, num_trajectories, dim]
+    """
+    x = np.empty((steps + 1,) + x0.shape)
+    x[0] = x0
+    for k in range(steps):
+        k1 = f(x[k], U_G[k, 0])
+        k2 = f(x[k] + Ts * k1 / 3, U_G[k, 1])
+        k3 = f(x[k] + Ts * (k2 - k1 / 3), U_G[k, 2])
+        k4 = f(x[k] + Ts * (k1 - k2 + k3), U_G[k, 3])
+        x[k + 1] = x[k] + Ts * (k1 + 3 * (k2 + k3) + k4) / 8
+    return x
@@ -0,0 +1,454 @@
+import time
+
+import torch
+from torchdiffeq import odeint
+
+from .utils import PhaseTimer
+
+""" TRAINING ENGINE
+
+System agnostic training loop used by the simple pendulum (Training) and the
+furuta pendulum (train()) pipelines, this file is the same in both packages.
+The system is described by a SystemSpec, and the integrator, the loss, the
+horizon curriculum, the validation and the callbacks are given to the engine,
+so that a feature of the loop (gradient clipping, learning rate schedule,
+alternating H_net/G_net updates, hard example mining, growth of multilevel
+models, profiling) is written once for every system.
+"""
+
+
+class SystemSpec:
+    """
+    Description:
+        Description of the system seen by the training engine
+    Inputs:
+        - name (string) : name of the system
+        - state_dim (int) : dimension of the state, the first state_dim columns of
+                            the batches are the states (extra columns such as the
+                            input are ignored)
+        - coordinates (tuple or None) : names of the state coordinates
+        - unpack_batch (callable or None) : batch of the data loader ->
+                            (x [batch_size, time_steps, >= state_dim],
+                            t_eval [batch_size, time_steps], idx or None), batches
+                            (x, t_eval) or (x, t_eval, idx) if None
+    """
+
+    def __init__(self, name, state_dim, coordinates=None, unpack_batch=None):
+        self.name = name
+        self.state_dim = state_dim
+        self.coordinates = coordinates
+        self._unpack_batch = unpack_batch
+
+    def unpack(self, batch):
+        if self._unpack_batch is not None:
+            return self._unpack_batch(batch)
+        if len(batch) == 3:
+            return batch[0], batch[1], batch[2]
+        return batch[0], batch[1], None
+
+
+def odeint_rk4(model, x0, t_eval, Ts):
+    """
+    Default integrator of the engine : fixed step rk4 of torchdiffeq,
+    returns the rollout [time_steps, batch_size, state_dim]
+    """
+    return odeint(model, x0, t_eval, method="rk4", options=dict(step_size=Ts))
+
+
+class ConstantHorizon:
+    """
+    Curriculum with a single horizon, same methods as AdaptiveHorizon
+    """
+
+    finished = False
+
+    def __init__(self, horizon):
+        self.horizon = horizon
+
+    def select(self, step):
+        return int(step == 0), self.horizon
+
+    def observe(self, step, train_loss, test_loss=None):
+        return False
+
+
+class ScheduledHorizon:
+    """
+    Curriculum that trains switch_steps[i] epochs with horizon_list[i] (same
+    schedule as select_horizon_list()), same methods as AdaptiveHorizon
+    """
+
+    finished = False
+
+    def __init__(self, horizon_list, switch_steps):
+        assert len(horizon_list) == len(
+            switch_steps
+        ), " horizon_list and switch_steps must have same length"
+        self.horizon_list = horizon_list
+        self.switch_steps = switch_steps
+        self.horizon = None
+
+    def select(self, step):
+        stage, end = 0, self.switch_steps[0]
+        while step >= end and stage < len(self.horizon_list) - 1:
+            stage += 1
+            end += self.switch_steps[stage]
+        horizon = self.horizon_list[stage]
+        updated = int(horizon != self.horizon)
+        if updated:
+            print("horizon length :", horizon)
+        self.horizon = horizon
+        return updated, horizon
+
+    def observe(self, step, train_loss, test_loss=None):
+        return False
+
+
+class Callback:
+    """
+    Base class of the engine callbacks, every hook is optional :
+        - on_epoch_start(engine, step)
+        - on_batch_end(engine, step, i_batch, x_nom, x_hat, t_eval) : x_nom is
+          [batch_size, horizon, state_dim] and x_hat [horizon, batch_size, state_dim]
+        - on_after_backward(engine) : gradients before clipping
+        - on_before_optim(engine) : gradients after clipping
+        - on_epoch_end(engine, step, epoch) : epoch is a dict with train_loss,
+          test_loss (None without validation), train_time and test_time
+    engine.logs can be used to save statistics
+    """
+
+    def on_epoch_start(self, engine, step):
+        pass
+
+    def on_batch_end(self, engine, step, i_batch, x_nom, x_hat, t_eval):
+        pass
+
+    def on_after_backward(self, engine):
+        pass
+
+    def on_before_optim(self, engine):
+        pass
+
+    def on_epoch_end(self, engine, step, epoch):
+        pass
+
+
+class ProgressPrinter(Callback):
+    """
+    Prints the losses and the times of every epoch
+    """
+
+    def on_epoch_end(self, engine, step, epoch):
+        if epoch["test_loss"] is None:
+            print(
+                "epoch {:4d} | train time {:.2f} | train loss {:8e} ".format(
+                    step, epoch["train_time"], epoch["train_loss"]
+                )
+            )
+        else:
+            print(
+                "epoch {:4d} | train time {:.2f} | train loss {:8e} | test loss {:8e} | test time {:.2f}  ".format(
+                    step,
+                    epoch["train_time"],
+                    epoch["train_loss"],
+                    epoch["test_loss"],
+                    epoch["test_time"],
+                )
+            )
+
+
+def _horizon_mask(horizons, max_horizon, device=None):
+    steps = torch.arange(max_horizon, device=device).unsqueeze(dim=1)
+    return steps < horizons.to(device).unsqueeze(dim=0)
+
+
+def _per_sample_error(x_nom, x_hat, mask=None):
+    # mean squared error of each trajectory, x_nom and x_hat [time_steps, batch_size, dim]
+    with torch.no_grad():
+        sq = (x_nom - x_hat).pow(2).sum(dim=-1)
+        if mask is None:
+            return sq.mean(dim=0)
+        mask = mask.to(sq.dtype)
+        return (sq * mask).sum(dim=0) / mask.sum(dim=0).clamp(min=1)
+
+
+class TrainingEngine:
+    """
+    Description:
+        Training loop shared by all the systems : rollout of the model from the
+        first state of every trajectory, loss, backward, optional clipping and
+        optimizer step, with a horizon curriculum, periodic validation and callbacks
+    Inputs:
+        - model (nn.Module) : vector field model(t, x), for example Input_HNN
+        - system (SystemSpec) : state dimension and batch layout
+        - train_loader (DataLoader) : train trajectories, with a HardExampleSampler the
+                            trajectories get their own horizon and the sampler is
+                            updated with their error
+        - Ts (float) : sampling time
+        - loss_fn (callable) : loss_fn(x_nom, x_hat, mask, horizon) -> loss, x_nom is
+                            [batch_size, time_steps, state_dim], x_hat [time_steps,
+                            batch_size, state_dim] and mask None or [time_steps, batch_size]
+        - optimizer (torch.optim.Optimizer or None) : AdamW(lr=1e-3, weight_decay=1e-4) if None
+        - curriculum (object or None) : horizon curriculum with select(step) and
+                            observe(step, train_loss, test_loss) (AdaptiveHorizon,
+                            ScheduledHorizon, ConstantHorizon), whole trajectories if None
+        - integrator (callable) : integrator(model, x0, t_eval, Ts) -> rollout
+        - validate (callable or None) : validate(model, horizon) -> test loss,
+                            for example a Validator
+        - validate_every (int) : number of epochs between two validations
+        - growth_scheduler (MultilevelScheduler or None) : grows the multilevel models,
+                            at the horizon changes if the curriculum has stages
+        - grad_clip (float or None) : maximum norm of the gradients
+        - lr_scheduler (object or None) : stepped after every optimizer step once
+                            the epoch is above lr_schedule_start
+        - lr_schedule_start (int) : first epoch of the learning rate schedule
+        - alternating (bool) : two updates per batch, first of G_net only and then
+                            of H_net only (freeze_G_net(), freeze_H_net())
+        - callbacks (list or None) : Callback objects, [ProgressPrinter()] if None
+        - phase_timer (PhaseTimer or None) : times the phases of every epoch
+        - profile_window (ProfilerWindow or None) : torch.profiler window
+    Methods:
+        - run(epochs) : trains the model, returns the logs
+
+    Example use :
+        engine = TrainingEngine(model, SystemSpec("pendulum", 2), train_loader, Ts, loss_fn,
+                                curriculum=ConstantHorizon(100), validate=Validator(test_set, Ts))
+        logs = engine.run(epochs=100)
+    """
+
+    def __init__(
+        self,
+        model,
+        system,
+        train_loader,
+        Ts,
+        loss_fn,
+        optimizer=None,
+        curriculum=None,
+        integrator=odeint_rk4,
+        validate=None,
+        validate_every=10,
+        growth_scheduler=None,
+        grad_clip=None,
+        lr_scheduler=None,
+        lr_schedule_start=0,
+        alternating=False,
+        callbacks=None,
+        phase_timer=None,
+        profile_window=None,
+    ):
+        self.model = model
+        self.system = system
+        self.train_loader = train_loader
+        self.Ts = Ts
+        self.loss_fn = loss_fn
+        if optimizer is None:
+            optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3, weight_decay=1e-4)
+        self.optimizer = optimizer
+        self.curriculum = curriculum
+        self.integrator = integrator
+        self.validate = validate
+        self.validate_every = validate_every
+        self.growth_scheduler = growth_scheduler
+        self.grad_clip = grad_clip
+        self.lr_scheduler = lr_scheduler
+        self.lr_schedule_start = lr_schedule_start
+        self.alternating = alternating
+        self.callbacks = [ProgressPrinter()] if callbacks is None else list(callbacks)
+        self.phase_timer = phase_timer if phase_timer is not None else PhaseTimer()
+        self.profile_window = profile_window
+
+        # per trajectory horizons and error index, see HardExampleSampler
+        self.hard_sampler = None
+        if hasattr(train_loader.sampler, "sample_horizons"):
+            self.hard_sampler = train_loader.sampler
+
+        self.horizon = None  # whole trajectories without curriculum
+        self.trajectory_length = None
+        self.logs = {
+            "train_loss": [],
+            "test_loss": [],
+            "test_epochs": [],
+            "horizon_switch_epochs": [],
+            "horizons": [],
+            "phase_times": [],
+            "nfe_per_batch": [],
+            "nfe_forward": [],
+            "nfe_backward": [],
+            "seconds_per_nfe": [],
+            "profile": None,
+        }
+
+    def _callback(self, hook, *args):
+        for callback in self.callbacks:
+            method = getattr(callback, hook, None)
+            if method is not None:
+                method(self, *args)
+
+    def _select_horizon(self, step):
+        if self.curriculum is None:
+            return 0, self.horizon
+        horizon_updated, horizon = self.curriculum.select(step)
+        if horizon_updated:
+            if step > 0:
+                self.logs["horizon_switch_epochs"].append(step)
+            self.logs["horizons"].append(horizon)
+        return horizon_updated, horizon
+
+    def _grow(self, step, horizon_updated):
+        # increase the model size and initialise the new parameters
+        if self.growth_scheduler is None:
+            return
+        with self.phase_timer.phase("growth"):
+            stage = getattr(self.curriculum, "stage", None)
+            if stage is not None:
+                if horizon_updated:
+                    self.model = self.growth_scheduler.apply_stage(
+                        self.model, min(stage, len(self.growth_scheduler.plan) - 1)
+                    )
+            else:
+                self.model = self.growth_scheduler.update(step, self.model)
+
+    def _train_batch(self, step, i_batch, batch, full_u_func):
+        model = self.model
+        x, t_eval, idx = self.system.unpack(batch)
+        x = x[..., : self.system.state_dim]
+        # one input per trajectory ('sequence', 'recorded', 'excitation' U_FUNC)
+        if idx is not None and hasattr(full_u_func, "select"):
+            model.u_func = full_u_func.select(idx)
+
+        # with hard example mining every trajectory has its own horizon,
+        # the rollout is only as long as the longest one
+        self.trajectory_length = x.shape[1]
+        horizon = self.horizon or self.trajectory_length
+        mask = None
+        batch_horizon = horizon
+        if self.hard_sampler is not None:
+            sample_horizons = self.hard_sampler.sample_horizons(idx, horizon)
+            batch_horizon = int(sample_horizons.max())
+            mask = _horizon_mask(sample_horizons, batch_horizon, device=x.device)
+
+        t_eval = t_eval[0, :batch_horizon]
+        x_nom = x[:, :batch_horizon]
+
+        batch_loss = 0
+        for i in range(2 if self.alternating else 1):
+            if i == 0 and self.alternating:  # train only the model approximating G
+                model.freeze_H_net(freeze=True)
+                model.freeze_G_net(freeze=False)
+            elif i == 1 and self.alternating:  # train only the model approximating H
+                model.freeze_H_net(freeze=False)
+                model.freeze_G_net(freeze=True)
+
+            # forward and backward evaluations of the model, see NFECounter
+            model.nfe_counter.reset()
+            with self.phase_timer.phase("forward"):
+                x_hat = self.integrator(model, x_nom[:, 0], t_eval, self.Ts)
+
+            with self.phase_timer.phase("loss"):
+                loss = self.loss_fn(x_nom, x_hat, mask, horizon)
+                if self.hard_sampler is not None and i == 0:
+                    self.hard_sampler.update(
+                        idx, _per_sample_error(x_nom.permute(1, 0, 2), x_hat, mask)
+                    )
+
+            if i == 0:
+                self._callback("on_batch_end", step, i_batch, x_nom, x_hat, t_eval)
+            batch_loss = batch_loss + loss.item()
+
+            with self.phase_timer.phase("backward"):
+                loss.backward()
+            self.nfe_per_batch.append(model.nfe_counter.read())
+            self._callback("on_after_backward")
+
+            if self.grad_clip:
+                with self.phase_timer.phase("clip"):
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), self.grad_clip)
+            self._callback("on_before_optim")
+
+            with self.phase_timer.phase("optim"):
+                self.optimizer.step()
+                self.optimizer.zero_grad()
+
+            if self.lr_scheduler is not None and step > self.lr_schedule_start:
+                self.lr_scheduler.step()
+
+        return batch_loss
+
+    def run(self, epochs):
+        """
+        Trains the model for at most epochs epochs (the curriculum can stop it
+        earlier), returns the logs
+        """
+        logs = self.logs
+        phase_timer = self.phase_timer
+        # input of every trajectory of the dataset, each batch uses its rows
+        full_u_func = getattr(self.model, "u_func", None)
+
+        try:
+            for step in range(epochs):
+                t1 = time.time()
+                train_loss = 0
+                test_loss = None
+                self.nfe_per_batch = []
+
+                horizon_updated, self.horizon = self._select_horizon(step)
+                self._grow(step, horizon_updated)
+                self._callback("on_epoch_start", step)
+
+                self.model.train()
+                phase_timer.start("data")
+                for i_batch, batch in enumerate(self.train_loader):
+                    phase_timer.stop("data")
+                    if self.profile_window is not None:
+                        self.profile_window.step()
+                    train_loss += self._train_batch(step, i_batch, batch, full_u_func)
+                    phase_timer.start("data")
+                phase_timer.stop("data")
+
+                t2 = time.time()
+                self.model.eval()
+                with phase_timer.phase("validation"):
+                    if self.validate is not None and not (step % self.validate_every):
+                        if full_u_func is not None:
+                            self.model.u_func = full_u_func
+                        horizon = self.horizon or self.trajectory_length
+                        test_loss = self.validate(self.model, horizon)
+                        logs["test_loss"].append(test_loss)
+                        logs["test_epochs"].append(step)
+                t3 = time.time()
+
+                logs["train_loss"].append(train_loss)
+                phase_times = phase_timer.summary()["times"]
+                nfe_forward = sum(nfe["forward"] for nfe in self.nfe_per_batch)
+                logs["phase_times"].append(phase_times)
+                logs["nfe_per_batch"].append(self.nfe_per_batch)
+                logs["nfe_forward"].append(nfe_forward)
+                logs["nfe_backward"].append(
+                    sum(nfe["backward"] for nfe in self.nfe_per_batch)
+                )
+                # cost of one forward evaluation of the model (batch_size states)
+                logs["seconds_per_nfe"].append(
+                    phase_times.get("forward", 0.0) / nfe_forward if nfe_forward else None
+                )
+
+                epoch = {
+                    "train_loss": train_loss,
+                    "test_loss": test_loss,
+                    "train_time": t2 - t1,
+                    "test_time": t3 - t2,
+                }
+                self._callback("on_epoch_end", step, epoch)
+
+                if self.curriculum is not None:
+                    self.curriculum.observe(step, train_loss, test_loss)
+                    if getattr(self.curriculum, "finished", False):
+                        print("loss converged at the last horizon, training stopped")
+                        break
+        finally:
+            if full_u_func is not None:
+                self.model.u_func = full_u_func
+            if self.profile_window is not None:
+                self.profile_window.stop()
+                logs["profile"] = self.profile_window.table
+        return logs
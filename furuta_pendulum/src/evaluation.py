@@ -0,0 +1,533 @@
+import time
+
+import torch
+
+from .dynamics import U_FUNC, hamiltonian_fn_furuta
+from .train_helpers import StreamingLoss
+from .trajectories import energy_furuta, rk4_step
+from .utils import save_stats
+
+""" EVALUATION OF TRAINED MODELS """
+
+
+def inference_context(model):
+    """
+    torch.inference_mode() if the gradient of H_net is computed in the forward
+    pass (forward_with_jacobian(), see hamiltonian_gradient()), otherwise
+    torch.no_grad() since the autograd fallback needs a graph inside the step
+    """
+    H_net = getattr(model, "H_net", None)
+    if H_net is not None and hasattr(H_net, "forward_with_jacobian"):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+def rollout_and_score(
+    model,
+    x0,
+    Ts,
+    steps,
+    x_nom=None,
+    w=None,
+    denom=None,
+    time_weights=None,
+    energy_fn=None,
+    divergence_threshold=None,
+    t0=None,
+    track_time=False,
+):
+    """
+    Description:
+        Rolls out the model step by step with rk4_step() (same scheme as
+        odeint(method="rk4")) and scores every step as soon as it is computed, the
+        predicted trajectory is never stored so the memory is O(batch_size) for any
+        number of steps (for example 10000 steps stability tests). The nominal
+        trajectory is optional and can be shorter than the rollout, the steps after
+        its end are only used for the energy drift and the finite check.
+    Inputs:
+        - model (nn.Module) : vector field model(t, x)
+        - x0 (tensor) : initial states [batch_size, (q1,p1,q2,p2)]
+        - Ts (float) : sampling time
+        - steps (int) : number of integration steps
+        - x_nom (tensor or None) : nominal trajectories [batch_size, time_steps, (q1,p1,q2,p2)]
+                                   with x_nom[:, 0] = x0 (data loader layout)
+        - w, denom, time_weights : see trajectory_loss(), time_weights [steps + 1]
+        - energy_fn (callable or None) : energy of states [batch_size, (q1,p1,q2,p2)],
+                                         for example
+                                         lambda x: hamiltonian_fn_furuta(x, g, Jr, Lr, Mp, Lp)
+                                         (in the coordinates of x0)
+        - divergence_threshold (float or None) : error norm after which a trajectory
+                                                 counts as diverged
+        - t0 (float or None) : time of x0, Ts (first element of t_eval) if None
+        - track_time (bool) : also accumulate the errors and the energy drift of every
+                              step (summed over the batch so that chunks can be added)
+    Outputs:
+        - scores (dict) :
+            - 'loss' (float) : trajectory_loss() over the steps with a nominal state
+            - 'per_sample_error' (tensor) : mean squared error of each trajectory [batch_size]
+            - 'max_deviation' (tensor) : largest absolute error [batch_size, (q1,p1,q2,p2)]
+            - 'energy_error' (tensor) : mean |E(x_hat) - E(x_nom)| [batch_size]
+            - 'energy_drift' (tensor) : largest |E(x_hat_k) - E(x0)| [batch_size]
+            - 'divergence_step' (tensor) : first step with an error above
+                                           divergence_threshold, -1 if none [batch_size]
+            - 'finite' (tensor) : the rollout stayed finite [batch_size]
+            - 'final_state' (tensor) : predicted state after steps [batch_size, (q1,p1,q2,p2)]
+            - 'scored_steps' (int) : number of steps compared to the nominal trajectory
+            - 'sq_error_time' (tensor) : squared error of every step and coordinate summed
+                                         over the batch [scored_steps, (q1,p1,q2,p2)]
+            - 'energy_drift_time' (tensor) : |E(x_hat_k) - E(x0)| summed over the
+                                             batch [steps + 1]
+        the energy entries are None without energy_fn, the error entries are
+        None without x_nom and the time entries are None without track_time
+    """
+    t0 = Ts if t0 is None else t0
+    batch_size = x0.shape[0]
+    device = x0.device
+    scored_steps = 0 if x_nom is None else min(steps + 1, x_nom.shape[1])
+
+    loss = StreamingLoss(w, denom)
+    sq_error = torch.zeros(batch_size, device=device)
+    max_deviation = torch.zeros_like(x0)
+    divergence_step = torch.full((batch_size,), -1, dtype=torch.long, device=device)
+    finite = torch.ones(batch_size, dtype=torch.bool, device=device)
+    energy_error = None
+    energy_drift = None
+    sq_error_time = None
+    energy_drift_time = None
+    if track_time:
+        sq_error_time = torch.zeros(scored_steps, x0.shape[-1], device=device)
+        if energy_fn is not None:
+            energy_drift_time = torch.zeros(steps + 1, device=device)
+
+    with inference_context(model):
+        x_hat = x0
+        if energy_fn is not None:
+            E0 = energy_fn(x0).reshape(-1)
+            energy_drift = torch.zeros(batch_size, device=device)
+            if x_nom is not None:
+                energy_error = torch.zeros(batch_size, device=device)
+
+        for k in range(steps + 1):
+            if k > 0:
+                t = torch.tensor(t0 + (k - 1) * Ts, device=device, dtype=x0.dtype)
+                x_hat = rk4_step(model, t, x_hat, Ts).detach()
+            finite &= torch.isfinite(x_hat).all(dim=-1)
+
+            if energy_fn is not None:
+                E_hat = energy_fn(x_hat).reshape(-1)
+                energy_drift = torch.maximum(energy_drift, (E_hat - E0).abs())
+                if track_time:
+                    energy_drift_time[k] = (E_hat - E0).abs().sum()
+
+            if k < scored_steps:
+                x_k = x_nom[:, k]
+                error = x_hat - x_k
+                loss.update(x_k, x_hat, None if time_weights is None else time_weights[k])
+                sq_error += error.square().sum(dim=-1)
+                if track_time:
+                    sq_error_time[k] = error.square().sum(dim=0)
+                max_deviation = torch.maximum(max_deviation, error.abs())
+                if divergence_threshold is not None:
+                    diverged = (error.norm(dim=-1) > divergence_threshold) & (
+                        divergence_step < 0
+                    )
+                    divergence_step[diverged] = k
+                if energy_fn is not None:
+                    energy_error += (E_hat - energy_fn(x_k).reshape(-1)).abs()
+
+    scored = scored_steps > 0
+    return {
+        "loss": loss.result().item() if scored else None,
+        "per_sample_error": sq_error / scored_steps if scored else None,
+        "max_deviation": max_deviation if scored else None,
+        "energy_error": energy_error / scored_steps if scored and energy_fn else None,
+        "energy_drift": energy_drift,
+        "divergence_step": divergence_step if scored else None,
+        "finite": finite,
+        "final_state": x_hat,
+        "scored_steps": scored_steps,
+        "sq_error_time": sq_error_time,
+        "energy_drift_time": energy_drift_time,
+    }
+
+
+class Validator:
+    """
+    Description:
+        Evaluates the whole test split in a few large batched rollouts (see
+        rollout_and_score()) instead of one odeint per test loader batch. The
+        trajectories of the split are gathered once, the chunk size is chosen so
+        that the activations of one model evaluation of a chunk fit in
+        memory_budget. Cheap enough to validate at every epoch.
+    Inputs:
+        - dataset (TrajectoryDataset_furuta, TrajectoryDataset_system or Subset) : test
+                                                        split, for example test_loader.dataset
+        - Ts (float) : sampling time
+        - memory_budget (int) : bytes available for the activations of one chunk
+        - max_batch_size (int or None) : upper bound of the chunk size
+    Methods:
+        - __call__(model, horizon, w, denom, time_weights, u_func) : mean loss over all
+                   the trajectories of the split, same loss as train(). u_func is the
+                   input of the whole dataset, model.u_func if None
+        - batch_size(model) : chunk size used for the model
+
+    Example use :
+        validator = Validator(test_loader.dataset, Ts)
+        test_loss = validator(model, horizon)
+    """
+
+    def __init__(self, dataset, Ts, memory_budget=256 * 2**20, max_batch_size=None):
+        base, indices = dataset, torch.arange(len(dataset))
+        if isinstance(dataset, torch.utils.data.Subset):
+            base, indices = dataset.dataset, torch.as_tensor(dataset.indices)
+        self.indices = indices
+        if hasattr(base, "trajectories"):  # TrajectoryDataset_system
+            self.x = base.trajectories[indices.to(base.trajectories.device)]
+        else:
+            if base.coord_type == "newtonian":
+                coords = (base.q1, base.dq1dt, base.q2, base.dq2dt)
+            else:
+                coords = (base.q1, base.p1, base.q2, base.p2)
+            # [num_trajectories, time_steps, (q1,p1,q2,p2)], gathered once
+            self.x = torch.stack(
+                [coord[indices.to(coord.device)] for coord in coords], dim=-1
+            )
+        self.t0 = base.t_eval[0].item()
+        self.Ts = Ts
+        self.memory_budget = memory_budget
+        self.max_batch_size = max_batch_size
+
+    def __len__(self):
+        return self.x.shape[0]
+
+    def batch_size(self, model):
+        """
+        Estimate : the outputs of all the linear layers, and their jacobian w.r.t.
+        the state (forward_with_jacobian()), for the 4 stages of an rk4 step
+        """
+        widths = sum(
+            module.out_features
+            for module in model.modules()
+            if isinstance(module, torch.nn.Linear)
+        )
+        dim = self.x.shape[-1]
+        bytes_per_trajectory = self.x.element_size() * 4 * (widths + dim) * (1 + dim)
+        size = max(1, self.memory_budget // bytes_per_trajectory)
+        if self.max_batch_size is not None:
+            size = min(size, self.max_batch_size)
+        return min(size, len(self))
+
+    def __call__(self, model, horizon, w=None, denom=None, time_weights=None, u_func=None):
+        horizon = min(horizon, self.x.shape[1])
+        batch_size = self.batch_size(model)
+
+        # one input per trajectory ('sequence', 'recorded', 'excitation'), selected
+        # from the input of the whole dataset : during training model.u_func can
+        # hold the selection of the last train batch
+        model_u_func = getattr(model, "u_func", None)
+        if u_func is None:
+            u_func = model_u_func
+        total = 0.0
+        try:
+            for start in range(0, len(self), batch_size):
+                chunk = slice(start, start + batch_size)
+                if u_func is not None:
+                    model.u_func = u_func.select(self.indices[chunk])
+                x = self.x[chunk]
+                scores = rollout_and_score(
+                    model,
+                    x[:, 0],
+                    self.Ts,
+                    horizon - 1,
+                    x_nom=x[:, :horizon],
+                    w=w,
+                    denom=denom,
+                    time_weights=time_weights,
+                    t0=self.t0,
+                )
+                total += scores["loss"] * x.shape[0]
+        finally:
+            if model_u_func is not None:
+                model.u_func = model_u_func
+        return total / len(self)
+
+
+COORDINATE_NAMES = ("q1", "p1", "q2", "p2")
+
+
+def _coordinate_names(system, state_dim):
+    """
+    Names of the state_dim coordinates of the reports, from the system if it
+    gives them
+    """
+    coordinates = getattr(system, "coordinates", None)
+    if coordinates is not None and len(coordinates) == state_dim:
+        return tuple(coordinates)
+    if state_dim == len(COORDINATE_NAMES):
+        return COORDINATE_NAMES
+    return tuple("x{}".format(i + 1) for i in range(state_dim))
+
+
+def furuta_energy_fn(g, Jr, Lr, Mp, Lp, coord_type="hamiltonian"):
+    """
+    Description:
+        Energy of states [batch_size, 4] for rollout_and_score() and
+        evaluate_long_horizon(), furuta_H() in hamiltonian coordinates and
+        energy_furuta() in newtonian coordinates (q1, dq1dt, q2, dq2dt).
+        The states must not be rescaled (see min_max_inverse())
+    Inputs:
+        - g, Jr, Lr, Mp, Lp (floats) : furuta pendulum parameters
+        - coord_type (string) : 'hamiltonian' or 'newtonian'
+    Outputs:
+        - energy_fn (callable) : energy [batch_size, 1]
+    """
+    if coord_type == "newtonian":
+        return lambda x: energy_furuta(
+            x[:, 1:2], x[:, 3:4], x[:, 0:1], g, Jr, Lr, Mp, Lp
+        )
+    return lambda x: hamiltonian_fn_furuta(x[:, :4], g, Jr, Lr, Mp, Lp)
+
+
+def hamiltonian_conservation(model, x0, Ts, steps, batch_size=None, t0=None):
+    """
+    Description:
+        Unforced (u = 0) and undissipated rollout of the model, the learned
+        Hamiltonian H_net is then a conserved quantity and its drift only comes
+        from the integration error and from the parts of the model that are not
+        Hamiltonian. The input function and the dissipation of the model are
+        restored afterwards.
+    Inputs:
+        - model (Input_HNN) : trained model
+        - x0 (tensor) : initial states [num_trajectories, (q1,p1,q2,p2)]
+        - Ts (float) : sampling time
+        - steps (int) : number of integration steps
+        - batch_size (int or None) : number of trajectories rolled out at once, all if None
+        - t0 (float or None) : time of x0
+    Outputs:
+        - H0 (tensor) : learned Hamiltonian of the initial states [num_trajectories]
+        - H_drift (tensor) : largest |H_net(x_hat_k) - H_net(x0)| [num_trajectories]
+        - finite (tensor) : the rollout stayed finite [num_trajectories]
+    """
+    batch_size = x0.shape[0] if batch_size is None else batch_size
+    u_func = getattr(model, "u_func", None)
+    dissip = getattr(model, "dissip", None)
+    H_fn = lambda x: model.H_net(x)[..., :1]
+    H0, H_drift, finite = [], [], []
+    try:
+        model.u_func = U_FUNC(utype=None)
+        if dissip is not None:
+            model.dissip = False
+        for start in range(0, x0.shape[0], batch_size):
+            x0_chunk = x0[start : start + batch_size]
+            with inference_context(model):
+                H0.append(H_fn(x0_chunk).reshape(-1))
+            scores = rollout_and_score(
+                model, x0_chunk, Ts, steps, energy_fn=H_fn, t0=t0
+            )
+            H_drift.append(scores["energy_drift"])
+            finite.append(scores["finite"])
+    finally:
+        model.u_func = u_func
+        if dissip is not None:
+            model.dissip = dissip
+    return torch.cat(H0), torch.cat(H_drift), torch.cat(finite)
+
+
+def _report_curve(curve, points):
+    """
+    Indices and values of at most points evenly spaced time steps of a curve
+    [time_steps, ...]
+    """
+    idx = torch.linspace(0, curve.shape[0] - 1, min(points, curve.shape[0]))
+    idx = idx.round().long().unique()
+    return idx, curve[idx.to(curve.device)]
+
+
+def evaluate_long_horizon(
+    model,
+    dataset,
+    Ts,
+    steps=None,
+    energy_fn=None,
+    divergence_threshold=1.0,
+    unforced_steps=None,
+    memory_budget=256 * 2**20,
+    report_points=50,
+    report_path=None,
+    system=None,
+):
+    """
+    Description:
+        Evaluation suite of a trained model : all the trajectories of the dataset
+        are rolled out together (chunks sized by Validator) from their initial
+        state for steps integration steps, the metrics are accumulated during the
+        rollout (rollout_and_score(track_time=True)) so the rollouts are never
+        stored. Meant to be run on every new checkpoint and compared to a reference
+        report with check_regression().
+    Inputs:
+        - model (Input_HNN) : trained model
+        - dataset (TrajectoryDataset_furuta or Subset) : test trajectories
+        - Ts (float) : sampling time
+        - steps (int or None) : rollout length, the length of the trajectories if None.
+                                Longer rollouts are only compared to the data over
+                                the length of the trajectories
+        - energy_fn (callable or None) : energy of the states, see furuta_energy_fn()
+        - divergence_threshold (float) : error norm after which a trajectory counts
+                                         as diverged
+        - unforced_steps (int or None) : length of the unforced rollouts of
+                                         hamiltonian_conservation(), steps if None and
+                                         skipped if 0
+        - memory_budget (int) : bytes available for one chunk, see Validator
+        - report_points (int) : number of points of the curves in the report
+        - report_path (string or None) : the report is saved there (json, save_stats())
+        - system (PortHamiltonianSystem, SystemSpec or None) : names of the coordinates
+                                         in the report, model.system or the furuta
+                                         pendulum (COORDINATE_NAMES) if None
+    Outputs:
+        - report (dict) : json serializable metrics
+            - 'rmse' : RMSE of every coordinate over the compared steps
+            - 'time', 'rmse_time' : RMSE of every coordinate versus time
+            - 'energy_error', 'energy_drift_mean', 'energy_drift_max', 'energy_drift_time' :
+                    mean |E(x_hat) - E(x_nom)| and drift |E(x_hat_k) - E(x0)|
+                    (None without energy_fn)
+            - 'diverged_fraction', 'divergence_time_median', 'divergence_time_min' :
+                    time after which the error norm is above divergence_threshold
+            - 'finite_fraction' : proportion of rollouts that stayed finite
+            - 'H_drift_mean', 'H_drift_max', 'H_drift_relative' : drift of the learned
+                    Hamiltonian on the unforced rollouts
+            - 'num_trajectories', 'steps', 'compared_steps', 'seconds'
+        The curves are NaN if a rollout is not finite (see 'finite_fraction')
+    """
+    t_start = time.perf_counter()
+    validator = Validator(dataset, Ts, memory_budget=memory_budget)
+    x_all = validator.x
+    num_trajectories, time_steps, _ = x_all.shape
+    steps = time_steps - 1 if steps is None else steps
+    unforced_steps = steps if unforced_steps is None else unforced_steps
+    batch_size = validator.batch_size(model)
+
+    sq_error_time = 0
+    energy_drift_time = 0
+    energy_error, energy_drift, divergence_step, finite = [], [], [], []
+
+    # one input per trajectory ('sequence', 'recorded', 'excitation')
+    u_func = getattr(model, "u_func", None)
+    try:
+        for start in range(0, num_trajectories, batch_size):
+            chunk = slice(start, start + batch_size)
+            if u_func is not None:
+                model.u_func = u_func.select(validator.indices[chunk])
+            x = x_all[chunk]
+            scores = rollout_and_score(
+                model,
+                x[:, 0],
+                Ts,
+                steps,
+                x_nom=x,
+                energy_fn=energy_fn,
+                divergence_threshold=divergence_threshold,
+                t0=validator.t0,
+                track_time=True,
+            )
+            sq_error_time = sq_error_time + scores["sq_error_time"]
+            divergence_step.append(scores["divergence_step"])
+            finite.append(scores["finite"])
+            if energy_fn is not None:
+                energy_drift_time = energy_drift_time + scores["energy_drift_time"]
+                energy_error.append(scores["energy_error"])
+                energy_drift.append(scores["energy_drift"])
+    finally:
+        if u_func is not None:
+            model.u_func = u_func
+
+    coordinates = _coordinate_names(system or getattr(model, "system", None), x_all.shape[-1])
+    compared_steps = sq_error_time.shape[0]
+    idx, rmse_time = _report_curve((sq_error_time / num_trajectories).sqrt(), report_points)
+    rmse = (sq_error_time.sum(dim=0) / (num_trajectories * compared_steps)).sqrt()
+    divergence_step = torch.cat(divergence_step)
+    diverged = divergence_step >= 0
+    divergence_time = divergence_step[diverged].double() * Ts
+
+    report = {
+        "num_trajectories": num_trajectories,
+        "steps": steps,
+        "compared_steps": compared_steps,
+        "rmse": dict(zip(coordinates, rmse.tolist())),
+        "time": (validator.t0 + idx.double() * Ts).tolist(),
+        "rmse_time": dict(zip(coordinates, rmse_time.T.tolist())),
+        "energy_error": None,
+        "energy_drift_mean": None,
+        "energy_drift_max": None,
+        "energy_drift_time": None,
+        "diverged_fraction": diverged.double().mean().item(),
+        "divergence_time_median": divergence_time.median().item() if diverged.any() else None,
+        "divergence_time_min": divergence_time.min().item() if diverged.any() else None,
+        "finite_fraction": torch.cat(finite).double().mean().item(),
+        "H_drift_mean": None,
+        "H_drift_max": None,
+        "H_drift_relative": None,
+    }
+
+    if energy_fn is not None:
+        energy_drift = torch.cat(energy_drift)
+        _, drift_time = _report_curve(energy_drift_time / num_trajectories, report_points)
+        report["energy_error"] = torch.cat(energy_error).mean().item()
+        report["energy_drift_mean"] = energy_drift.mean().item()
+        report["energy_drift_max"] = energy_drift.max().item()
+        report["energy_drift_time"] = drift_time.tolist()
+
+    if unforced_steps:
+        H0, H_drift, _ = hamiltonian_conservation(
+            model, x_all[:, 0], Ts, unforced_steps, batch_size, validator.t0
+        )
+        report["H_drift_mean"] = H_drift.mean().item()
+        report["H_drift_max"] = H_drift.max().item()
+        report["H_drift_relative"] = (H_drift / H0.abs().clamp_min(1e-12)).mean().item()
+
+    report["seconds"] = time.perf_counter() - t_start
+    if report_path is not None:
+        save_stats(report, report_path)
+    return report
+
+
+# metrics of the report where lower is better, compared by check_regression()
+REGRESSION_METRICS = (
+    "energy_error",
+    "energy_drift_mean",
+    "energy_drift_max",
+    "diverged_fraction",
+    "H_drift_mean",
+    "H_drift_max",
+)
+
+
+def check_regression(report, reference, rtol=0.1, atol=1e-8):
+    """
+    Description:
+        Compares a report of evaluate_long_horizon() to the report of a reference
+        checkpoint (for example loaded with read_dict())
+    Inputs:
+        - report, reference (dict) : reports of evaluate_long_horizon()
+        - rtol, atol (floats) : a metric regresses if it is above
+                                reference * (1 + rtol) + atol
+    Outputs:
+        - regressions (list) : (metric, value, reference value) of every metric that
+                               got worse, empty if the checkpoint passes
+    """
+    pairs = [(name, report.get(name), reference.get(name)) for name in REGRESSION_METRICS]
+    pairs += [
+        ("rmse_" + name, report["rmse"][name], reference["rmse"][name])
+        for name in reference["rmse"]
+    ]
+    regressions = [
+        (name, value, ref)
+        for name, value, ref in pairs
+        if value is not None
+        and ref is not None
+        and not value <= ref * (1 + rtol) + atol  # also catches NaN
+    ]
+    if report["finite_fraction"] < reference["finite_fraction"]:
+        regressions.append(
+            ("finite_fraction", report["finite_fraction"], reference["finite_fraction"])
+        )
+    return regressions
@@ -0,0 +1,319 @@
+import hashlib
+import json
+import os
+import time
+
+import torch
+
+""" EXPORT
+
+Bakes a trained model (Input_HNN, simple_HNN) into a standalone TorchScript
+artifact for inference hosts that cannot run the training code : the vector
+field (gradient of H_net through forward_with_jacobian(), so no autograd in the
+graph, G_net and the learned dissipation) is traced, and a fixed step rk4 (3/8
+rule, the scheme of rk4_step() and odeint(method="rk4")) is scripted around it.
+The input is held constant over a step (zero order hold), as on a controller.
+
+The artifact comes with a versioned JSON manifest (state layout, Ts, shapes,
+checksum, export check error). load_exported() only needs torch, the artifact
+can also be opened directly with torch.jit.load(). With format="onnx" the
+vector field is exported as an ONNX graph and the integration is left to the host.
+
+Example use :
+    manifest = export_model(model, "exports/furuta", Ts=0.005)
+    # on the inference host
+    stepper, manifest = load_exported("exports/furuta")
+    x_next = stepper(x, u)  # [batch_size, state_dim], [batch_size]
+    x_seq = stepper.rollout(x0, u_seq)  # [steps + 1, batch_size, state_dim]
+"""
+
+# version of the manifest and of the interface of the exported modules
+EXPORT_FORMAT_VERSION = 1
+
+
+class _HeldInput:
+    """
+    Input function of the model while tracing : returns the traced input u
+    whatever the time (zero order hold over an integration step)
+    """
+
+    def __init__(self, u):
+        self.u = u
+
+    def forward(self, t):
+        return self.u
+
+    def per_trajectory(self):
+        return True
+
+    def select(self, idx):
+        return self
+
+
+class _VectorField(torch.nn.Module):
+    """
+    f(x, u) of a model whose u_func is replaced by the input u [batch_size] (or
+    [batch_size, num_inputs])
+    """
+
+    def __init__(self, model):
+        super(_VectorField, self).__init__()
+        self.model = model
+
+    def forward(self, x, u):
+        u_func = getattr(self.model, "u_func", None)
+        if u_func is not None:
+            self.model.u_func = _HeldInput(u)
+        try:
+            return self.model(torch.zeros((), dtype=x.dtype), x)
+        finally:
+            if u_func is not None:
+                self.model.u_func = u_func
+
+
+class _Hamiltonian(torch.nn.Module):
+    """
+    Learned Hamiltonian [batch_size, 1], the first output of H_net
+    """
+
+    def __init__(self, H_net):
+        super(_Hamiltonian, self).__init__()
+        self.H_net = H_net
+
+    def forward(self, x):
+        return self.H_net(x)[..., :1]
+
+
+class RK4Stepper(torch.nn.Module):
+    """
+    Description:
+        Scripted fixed step rk4 (3/8 rule) around a traced vector field
+    Inputs:
+        - vector_field (ScriptModule) : traced f(x, u)
+        - hamiltonian (ScriptModule) : traced H(x)
+        - Ts (float) : step size
+    Methods:
+        - forward(x, u) : one step from x [batch_size, state_dim] with the input u
+                          [batch_size] ([batch_size, num_inputs] with several inputs)
+        - rollout(x0, u_seq) : steps from x0 with the inputs u_seq [steps, batch_size(,
+                               num_inputs)], [steps + 1, batch_size, state_dim]
+        - vector_field_at(x, u) : dx/dt [batch_size, state_dim]
+        - energy(x) : learned Hamiltonian [batch_size, 1]
+    """
+
+    def __init__(self, vector_field, hamiltonian, Ts):
+        super(RK4Stepper, self).__init__()
+        self.vector_field = vector_field
+        self.hamiltonian = hamiltonian
+        self.Ts = Ts
+
+    def forward(self, x, u):
+        k1 = self.vector_field(x, u)
+        k2 = self.vector_field(x + self.Ts * k1 / 3, u)
+        k3 = self.vector_field(x + self.Ts * (k2 - k1 / 3), u)
+        k4 = self.vector_field(x + self.Ts * (k1 - k2 + k3), u)
+        return x + self.Ts * (k1 + 3 * (k2 + k3) + k4) / 8
+
+    @torch.jit.export
+    def rollout(self, x0, u_seq):
+        x = x0
+        trajectory = [x0]
+        for k in range(u_seq.shape[0]):
+            x = self.forward(x, u_seq[k])
+            trajectory.append(x)
+        return torch.stack(trajectory, dim=0)
+
+    @torch.jit.export
+    def vector_field_at(self, x, u):
+        return self.vector_field(x, u)
+
+    @torch.jit.export
+    def energy(self, x):
+        return self.hamiltonian(x)
+
+
+def _state_dim(model, state_dim):
+    if state_dim is not None:
+        return state_dim
+    if hasattr(model, "state_dim"):
+        return model.state_dim  # Input_HNN
+    if hasattr(model, "input_dim"):
+        return model.input_dim  # simple_HNN
+    return 4
+
+
+def _num_inputs(model, x):
+    """
+    Number of inputs of the model, the width of its input matrix G_net(x)
+    ([batch_size, state_dim] for one input, [batch_size, state_dim, num_inputs])
+    """
+    G_net = getattr(model, "G_net", None)
+    if G_net is None or not hasattr(model, "u_func"):
+        return 0
+    G = G_net.forward(x)
+    return G.shape[-1] if G.dim() == 3 else 1
+
+
+def _sample_input(batch_size, num_inputs, device):
+    if num_inputs > 1:
+        return torch.randn(batch_size, num_inputs, device=device) * 0.1
+    return torch.randn(batch_size, device=device) * 0.1
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def export_model(
+    model,
+    path,
+    Ts,
+    state_dim=None,
+    coordinates=None,
+    format="torchscript",
+    check_batch_sizes=(2, 3),
+    tolerance=1e-5,
+    metadata=None,
+):
+    """
+    Description:
+        Exports a trained model to path + ".pt" (TorchScript, RK4Stepper) or
+        path + ".onnx" (vector field only) and writes the manifest path + ".json".
+        The export is checked against the model on random states for several
+        batch sizes, the largest difference is saved in the manifest.
+    Inputs:
+        - model (nn.Module) : trained Input_HNN or simple_HNN, its H_net must
+                              implement forward_with_jacobian()
+        - path (string) : path of the artifact without extension
+        - Ts (float) : step size of the integrator
+        - state_dim (int or None) : dimension of the state, from the model if None
+        - coordinates (tuple or None) : names of the state coordinates
+        - format (string) : 'torchscript' or 'onnx'
+        - check_batch_sizes (tuple) : batch sizes of the export check
+        - tolerance (float) : largest accepted difference in the export check
+        - metadata (dict or None) : saved in the manifest (training run, dataset...)
+    Outputs:
+        - manifest (dict) : content of the manifest
+    """
+    assert format in ("torchscript", "onnx"), "format must be 'torchscript' or 'onnx'"
+    if not hasattr(model.H_net, "forward_with_jacobian"):
+        raise ValueError(
+            "H_net must implement forward_with_jacobian() so that its gradient is "
+            "part of the exported graph"
+        )
+    state_dim = _state_dim(model, state_dim)
+    if coordinates is None:
+        system = getattr(model, "system", None)
+        if system is not None:
+            coordinates = system.coordinates
+        elif state_dim == 4:
+            coordinates = ("q1", "p1", "q2", "p2")
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    was_training = model.training
+    model.eval()
+    device = next(model.parameters()).device
+    vector_field = _VectorField(model)
+    x = torch.randn(check_batch_sizes[0], state_dim, device=device) * 0.1
+    try:
+        with torch.no_grad():
+            num_inputs = _num_inputs(model, x)
+            u = _sample_input(check_batch_sizes[0], num_inputs, device)
+            traced_f = torch.jit.trace(vector_field, (x, u), check_trace=False)
+            traced_H = torch.jit.trace(_Hamiltonian(model.H_net), (x,), check_trace=False)
+
+            # largest difference between the export and the model
+            check_error = 0.0
+            for batch_size in check_batch_sizes:
+                x = torch.randn(batch_size, state_dim, device=device) * 0.1
+                u = _sample_input(batch_size, num_inputs, device)
+                error = (traced_f(x, u) - vector_field(x, u)).abs().max().item()
+                check_error = max(check_error, error)
+    finally:
+        model.train(was_training)
+    if not check_error <= tolerance:
+        raise ValueError(
+            "exported vector field differs from the model by {:.3g}".format(check_error)
+        )
+
+    if format == "torchscript":
+        artifact = path + ".pt"
+        stepper = torch.jit.script(RK4Stepper(traced_f, traced_H, Ts))
+        stepper.save(artifact)
+    else:
+        artifact = path + ".onnx"
+        torch.onnx.export(
+            traced_f,
+            (x, u),
+            artifact,
+            input_names=["x", "u"],
+            output_names=["dxdt"],
+            dynamic_axes={name: {0: "batch_size"} for name in ("x", "u", "dxdt")},
+        )
+
+    u_shape = ["batch_size", num_inputs] if num_inputs > 1 else ["batch_size"]
+    # the onnx graph is the vector field only
+    integrator = "rk4 (3/8 rule), input held over the step" if format == "torchscript" else None
+    manifest = {
+        "format_version": EXPORT_FORMAT_VERSION,
+        "format": format,
+        "artifact": os.path.basename(artifact),
+        "sha256": _sha256(artifact),
+        "model_class": type(model).__name__,
+        "H_net_class": type(model.H_net).__name__,
+        "state_dim": state_dim,
+        "coordinates": list(coordinates) if coordinates is not None else None,
+        "num_inputs": num_inputs,
+        "dissip": bool(getattr(model, "dissip", False)),
+        "dissip_net": getattr(model, "dissip_net", None) is not None,
+        "Ts": Ts,
+        "integrator": integrator,
+        "inputs": {"x": ["batch_size", state_dim], "u": u_shape},
+        "dtype": str(x.dtype).replace("torch.", ""),
+        "num_parameters": sum(param.numel() for param in model.parameters()),
+        "check_error": check_error,
+        "torch_version": torch.__version__,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "metadata": dict(metadata or {}),
+    }
+    with open(path + ".json", "w") as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+
+def load_exported(path, map_location="cpu", verify=True):
+    """
+    Description:
+        Loads an artifact of export_model() without the training code
+    Inputs:
+        - path (string) : path of the artifact without extension (or of the manifest)
+        - map_location (string) : device of the loaded module
+        - verify (bool) : check the manifest version and the artifact checksum
+    Outputs:
+        - stepper (ScriptModule or string) : RK4Stepper, or the path of the ONNX
+                                             file (to give to an ONNX runtime)
+        - manifest (dict) : content of the manifest
+    """
+    if path.endswith(".json"):
+        path = path[: -len(".json")]
+    with open(path + ".json") as file:
+        manifest = json.load(file)
+    artifact = os.path.join(os.path.dirname(path), manifest["artifact"])
+    if verify:
+        if manifest["format_version"] > EXPORT_FORMAT_VERSION:
+            raise ValueError(
+                "manifest version {} is newer than the supported version {}".format(
+                    manifest["format_version"], EXPORT_FORMAT_VERSION
+                )
+            )
+        if _sha256(artifact) != manifest["sha256"]:
+            raise ValueError("checksum of {} does not match its manifest".format(artifact))
+    if manifest["format"] == "onnx":
+        return artifact, manifest
+    return torch.jit.load(artifact, map_location=map_location), manifest
@@ -0,0 +1,402 @@
+import csv
+import os
+
+import numpy as np
+import torch
+
+from .data import data_loader_furuta
+from .dynamics import U_FUNC
+from .dynamics_numpy import furuta_constants
+from .trajectories import energy_furuta
+
+""" HARDWARE LOG INGESTION
+
+Builds datasets from measurements of the real (Qube-servo) furuta pendulum. The
+logs contain the encoder timestamps, the two angles and the motor voltage and can
+be larger than memory, they are read chunk by chunk :
+
+    read_log_chunks()     -> raw samples, chunk_size rows at a time
+    StreamingResampler    -> uniform Ts grid (angles linear, voltage zero order hold)
+    TrajectoryWindower    -> windows of time_steps samples
+    window_to_coordinates -> velocities by central differences, momenta with the
+                             mass matrix of furuta_H()
+
+Example use :
+    q1, p1, q2, p2, energy, derivatives, t_eval, u = ingest_furuta_logs(
+        ["run1.csv", "run2.csv"], Ts=0.005, time_steps=400, time_scale=1e-6)
+    u_func = recorded_u_func(u, Ts=0.005)  # measured voltage, one row per window
+"""
+
+# name of the columns of the logs for each signal
+DEFAULT_COLUMNS = {"t": "time", "q1": "alpha", "q2": "theta", "u": "voltage"}
+
+
+def read_log_chunks(
+    path, columns=DEFAULT_COLUMNS, chunk_size=100000, binary_dtype=None, delimiter=","
+):
+    """
+    Description:
+        Reads a log file chunk by chunk without loading the whole file.
+        '.csv' and '.txt' files must have a header row with the column names,
+        other files are read as binary records described by binary_dtype.
+    Inputs:
+        - path (string) : path of the log
+        - columns (dict) : name of the column of each signal 't', 'q1', 'q2', 'u'
+        - chunk_size (int) : number of rows per chunk
+        - binary_dtype (np.dtype) : structured dtype of one binary record, for example
+                                    np.dtype([("time", "<u8"), ("alpha", "<i4"),
+                                              ("theta", "<i4"), ("voltage", "<f4")])
+        - delimiter (string) : delimiter of the csv files
+    Outputs:
+        - chunk (dict) : generator of {'t', 'q1', 'q2', 'u'} float64 arrays [chunk_size]
+    """
+    if os.path.splitext(path)[1].lower() in (".csv", ".txt"):
+        with open(path, newline="") as f:
+            reader = csv.reader(f, delimiter=delimiter)
+            header = [name.strip() for name in next(reader)]
+            cols = {key: header.index(name) for key, name in columns.items()}
+            rows = []
+            for row in reader:
+                if not row:
+                    continue
+                rows.append([row[cols[key]] for key in columns])
+                if len(rows) == chunk_size:
+                    yield _rows_to_chunk(rows, columns)
+                    rows = []
+            if rows:
+                yield _rows_to_chunk(rows, columns)
+    else:
+        if binary_dtype is None:
+            raise ValueError("binary_dtype is needed to read binary logs")
+        binary_dtype = np.dtype(binary_dtype)
+        num_records = os.path.getsize(path) // binary_dtype.itemsize
+        for start in range(0, num_records, chunk_size):
+            records = np.fromfile(
+                path,
+                dtype=binary_dtype,
+                count=min(chunk_size, num_records - start),
+                offset=start * binary_dtype.itemsize,
+            )
+            yield {key: records[name].astype(np.float64) for key, name in columns.items()}
+
+
+def _rows_to_chunk(rows, columns):
+    values = np.asarray(rows, dtype=np.float64)
+    return {key: values[:, i] for i, key in enumerate(columns)}
+
+
+class StreamingResampler:
+    """
+    Description:
+        Resamples the raw samples onto the uniform grid t0 + k*Ts, chunk after chunk.
+        The angles are linearly interpolated (and unwrapped so that a full turn does not
+        create a jump), the voltage is held constant between two samples like the
+        motor command. The last raw sample of a chunk is kept to interpolate across
+        the chunk boundary. Samples with a timestamp that does not increase are
+        dropped, a gap larger than max_gap between two samples starts a new segment.
+    Inputs:
+        - Ts (float) : sampling time of the grid
+        - time_scale (float) : multiplier from the log timestamps to seconds (1e-6 for us)
+        - angle_scale (float or tuple) : multiplier from the log angles to radians for
+                                         (q1, q2), for example 2*pi/2048 for encoder counts
+        - max_gap (float or None) : largest allowed time between two samples in seconds,
+                                    5*Ts if None
+        - unwrap (bool) : unwrap the angles
+    Methods:
+        - push(chunk) : list of (segment, new_segment), segment is a dict of
+                        {'t', 'q1', 'q2', 'u'} arrays on the grid
+    """
+
+    def __init__(self, Ts, time_scale=1.0, angle_scale=1.0, max_gap=None, unwrap=True):
+        self.Ts = Ts
+        self.time_scale = time_scale
+        self.angle_scale = np.broadcast_to(np.asarray(angle_scale, dtype=np.float64), (2,))
+        self.max_gap = 5 * Ts if max_gap is None else max_gap
+        self.unwrap = unwrap
+        self.tail = None  # last raw sample {'t', 'q1', 'q2', 'u'} of the previous chunk
+        self.t_next = None  # next time of the grid
+
+    def push(self, chunk):
+        t = chunk["t"] * self.time_scale
+        q1 = chunk["q1"] * self.angle_scale[0]
+        q2 = chunk["q2"] * self.angle_scale[1]
+        u = chunk["u"]
+
+        if self.tail is not None:
+            t = np.concatenate(([self.tail["t"]], t))
+            q1 = np.concatenate(([self.tail["q1"]], q1))
+            q2 = np.concatenate(([self.tail["q2"]], q2))
+            u = np.concatenate(([self.tail["u"]], u))
+
+        # drop repeated or out of order timestamps
+        keep = np.concatenate(([True], t[1:] > np.maximum.accumulate(t)[:-1]))
+        t, q1, q2, u = t[keep], q1[keep], q2[keep], u[keep]
+        if self.unwrap:
+            # the tail is already unwrapped and only the differences matter
+            q1 = np.unwrap(q1)
+            q2 = np.unwrap(q2)
+
+        # split at the gaps, a segment ends at index stops[i] (excluded)
+        gaps = np.nonzero(np.diff(t) > self.max_gap)[0] + 1
+        starts = np.concatenate(([0], gaps))
+        stops = np.concatenate((gaps, [len(t)]))
+
+        segments = []
+        for n, (start, stop) in enumerate(zip(starts, stops)):
+            new_segment = n > 0 or self.t_next is None
+            if new_segment:
+                self.t_next = t[start]
+            num = int(np.floor((t[stop - 1] - self.t_next) / self.Ts + 1e-9)) + 1
+            if num <= 0:
+                continue
+            t_grid = self.t_next + self.Ts * np.arange(num)
+            self.t_next = t_grid[-1] + self.Ts
+
+            t_seg = t[start:stop]
+            hold = np.searchsorted(t_seg, t_grid, side="right") - 1
+            segment = {
+                "t": t_grid,
+                "q1": np.interp(t_grid, t_seg, q1[start:stop]),
+                "q2": np.interp(t_grid, t_seg, q2[start:stop]),
+                "u": u[start:stop][hold],
+            }
+            segments.append((segment, new_segment))
+
+        self.tail = {"t": t[-1], "q1": q1[-1], "q2": q2[-1], "u": u[-1]}
+        return segments
+
+
+class TrajectoryWindower:
+    """
+    Description:
+        Cuts the resampled stream into windows of time_steps + 2 samples (one extra
+        sample on each side for the central differences of window_to_coordinates()).
+        Only the samples that can still belong to a window are buffered, a new
+        segment (gap in the log) empties the buffer.
+    Inputs:
+        - time_steps (int) : number of time steps of a trajectory
+        - stride (int or None) : number of samples between the starts of two
+                                 windows, time_steps (no overlap) if None
+    Methods:
+        - push(segment, new_segment) : windows [num_windows, time_steps + 2, (q1,q2,u)]
+    """
+
+    def __init__(self, time_steps, stride=None):
+        self.length = time_steps + 2
+        self.stride = time_steps if stride is None else stride
+        self.buffer = np.empty((0, 3))
+
+    def push(self, segment, new_segment=False):
+        if new_segment:
+            self.buffer = np.empty((0, 3))
+        samples = np.stack((segment["q1"], segment["q2"], segment["u"]), axis=1)
+        self.buffer = np.concatenate((self.buffer, samples))
+
+        num_windows = (len(self.buffer) - self.length) // self.stride + 1
+        if num_windows <= 0:
+            return np.empty((0, self.length, 3))
+        idx = self.stride * np.arange(num_windows)[:, None] + np.arange(self.length)
+        windows = self.buffer[idx]
+        self.buffer = self.buffer[num_windows * self.stride :]
+        return windows
+
+
+def window_to_coordinates(windows, Ts, g, Jr, Lr, Mp, Lp):
+    """
+    Description:
+        Generalized coordinates of the windows. The velocities are estimated by
+        central differences and the momenta are obtained with the mass matrix of
+        furuta_H() :
+            p1 = C4*dq1 + C3*cos(q1)*dq2
+            p2 = C3*cos(q1)*dq1 + (C1 + C2*sin(q1)**2)*dq2
+    Inputs:
+        - windows (ndarray) : [num_windows, time_steps + 2, (q1,q2,u)]
+        - Ts (float) : sampling time
+        - g, Jr, Lr, Mp, Lp (Float) : furuta pendulum parameters
+    Outputs:
+        - x (ndarray) : [num_windows, time_steps, (q1,p1,q2,p2)]
+        - dx (ndarray) : [num_windows, time_steps, (dq1/dt,dp1/dt,dq2/dt,dp2/dt)]
+        - u (ndarray) : measured input [num_windows, time_steps]
+    """
+    C1, C2, C3, C4, _ = furuta_constants(g, Jr, Lr, Mp, Lp)
+    q1_all = windows[:, :, 0]
+    q2_all = windows[:, :, 1]
+    dq1_all = np.gradient(q1_all, Ts, axis=1)
+    dq2_all = np.gradient(q2_all, Ts, axis=1)
+
+    s = np.sin(q1_all)
+    c = np.cos(q1_all)
+    p1_all = C4 * dq1_all + C3 * c * dq2_all
+    p2_all = C3 * c * dq1_all + (C1 + C2 * s**2) * dq2_all
+    dp1_all = np.gradient(p1_all, Ts, axis=1)
+    dp2_all = np.gradient(p2_all, Ts, axis=1)
+
+    # drop the first and last samples, their differences are one sided
+    inner = slice(1, -1)
+    x = np.stack(
+        (q1_all[:, inner], p1_all[:, inner], q2_all[:, inner], p2_all[:, inner]), axis=-1
+    )
+    dx = np.stack(
+        (dq1_all[:, inner], dp1_all[:, inner], dq2_all[:, inner], dp2_all[:, inner]),
+        axis=-1,
+    )
+    return x, dx, windows[:, inner, 2]
+
+
+def ingest_furuta_logs(
+    paths,
+    Ts=0.005,
+    time_steps=400,
+    stride=None,
+    columns=DEFAULT_COLUMNS,
+    time_scale=1.0,
+    angle_scale=1.0,
+    chunk_size=100000,
+    binary_dtype=None,
+    max_gap=None,
+    max_windows=None,
+    g=9.81,
+    Jr=5.72 * 1e-5,
+    Lr=0.085,
+    Mp=0.024,
+    Lp=0.129,
+):
+    """
+    Description:
+        Streams hardware logs into trajectories with the layout of
+        multiple_trajectories_furuta(). Every log is read chunk by chunk, resampled,
+        windowed and converted to generalized coordinates, only the windows are kept
+        in memory. The default furuta parameters are the ones of
+        set_furuta_params(which="real").
+    Inputs:
+        - paths (string or list) : log files, see read_log_chunks()
+        - Ts (float) : sampling time of the trajectories
+        - time_steps (int) : number of time steps of each trajectory
+        - stride (int or None) : samples between the starts of two trajectories,
+                                 see TrajectoryWindower
+        - columns, chunk_size, binary_dtype : see read_log_chunks()
+        - time_scale, angle_scale, max_gap : see StreamingResampler
+        - max_windows (int or None) : stop once this many trajectories were read
+        - g, Jr, Lr, Mp, Lp (Float) : furuta pendulum parameters
+    Outputs:
+        - q1, p1, q2, p2 (tensors) : generalized coordinates [num_windows, time_steps]
+        - energy (tensor) : energy [num_windows, time_steps]
+        - derivatives (tensor) : [num_windows, time_steps, (dq1/dt,dp1/dt,dq2/dt,dp2/dt)]
+        - t_eval (tensor) : time steps [time_steps], Ts*(1, .., time_steps) like the
+                            simulated trajectories
+        - u (tensor) : measured input [num_windows, time_steps], see recorded_u_func()
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+
+    x, dx, u = [], [], []
+    num_windows = 0
+    for path in paths:
+        # every log is an independent recording
+        resampler = StreamingResampler(Ts, time_scale, angle_scale, max_gap)
+        windower = TrajectoryWindower(time_steps, stride)
+        for chunk in read_log_chunks(path, columns, chunk_size, binary_dtype):
+            for segment, new_segment in resampler.push(chunk):
+                windows = windower.push(segment, new_segment)
+                if len(windows) == 0:
+                    continue
+                x_w, dx_w, u_w = window_to_coordinates(windows, Ts, g, Jr, Lr, Mp, Lp)
+                x.append(x_w)
+                dx.append(dx_w)
+                u.append(u_w)
+                num_windows += len(windows)
+            if max_windows is not None and num_windows >= max_windows:
+                break
+        if max_windows is not None and num_windows >= max_windows:
+            break
+
+    if num_windows == 0:
+        raise ValueError("the logs are shorter than one trajectory of time_steps samples")
+
+    x = torch.tensor(np.concatenate(x)[:max_windows], dtype=torch.float32)
+    derivatives = torch.tensor(np.concatenate(dx)[:max_windows], dtype=torch.float32)
+    u = torch.tensor(np.concatenate(u)[:max_windows], dtype=torch.float32)
+    q1, p1, q2, p2 = x[:, :, 0], x[:, :, 1], x[:, :, 2], x[:, :, 3]
+
+    energy = energy_furuta(derivatives[:, :, 0], derivatives[:, :, 2], q1, g, Jr, Lr, Mp, Lp)
+    t_eval = torch.linspace(1, time_steps, time_steps) * Ts
+    return q1, p1, q2, p2, energy, derivatives, t_eval, u
+
+
+def recorded_u_func(u, Ts=0.005, t0=None, interp="zoh"):
+    """
+    Description:
+        Input function replaying the measured input of every trajectory
+        (U_FUNC 'recorded')
+    Inputs:
+        - u (tensor) : measured input [num_windows, time_steps]
+        - Ts (float) : sampling time
+        - t0 (float or None) : time of the first sample, Ts (first element of
+                               t_eval) if None
+        - interp (string) : 'zoh' like the motor command, 'linear' or 'cubic',
+                            see recorded_fun()
+    Outputs:
+        - u_func (U_FUNC) : input function, u_func.forward(t) has shape [num_windows]
+    """
+    t0 = Ts if t0 is None else t0
+    return U_FUNC(
+        utype="recorded", params={"u_rec": u, "t0": t0, "Ts": Ts, "interp": interp}
+    )
+
+
+def load_logs_device(
+    device,
+    paths,
+    w_rescale,
+    time_steps=400,
+    shuffle=False,
+    coord_type="hamiltonian",
+    proportion=0.5,
+    batch_size=1,
+    Ts=0.005,
+    hard_mining=False,
+    **ingest_kwargs
+):
+    """
+    Description:
+        load_data_device() for hardware logs : ingests the logs with
+        ingest_furuta_logs() and creates the train and test loaders. The loaders
+        return the trajectory indices (see unpack_batch()) so that the measured
+        input of each trajectory can be selected from u_func.
+    Inputs:
+        - device (string) : device on which the trajectories are put
+        - paths (string or list) : log files
+        - w_rescale (list) : multipliers of (q1,p1,q2,p2)
+        - time_steps, Ts : see ingest_furuta_logs()
+        - shuffle, coord_type, proportion, batch_size, hard_mining : see load_data_device()
+        - ingest_kwargs : other arguments of ingest_furuta_logs()
+    Outputs:
+        - train_loader (data loader object) : train loader
+        - test_loader (data loader object) : test loader
+        - u_func (U_FUNC) : measured input of every trajectory, see recorded_u_func()
+    """
+    q1, p1, q2, p2, energy, derivatives, t_eval, u = ingest_furuta_logs(
+        paths, Ts=Ts, time_steps=time_steps, **ingest_kwargs
+    )
+
+    q1 = (q1 * w_rescale[0]).to(device)
+    p1 = (p1 * w_rescale[1]).to(device)
+    q2 = (q2 * w_rescale[2]).to(device)
+    p2 = (p2 * w_rescale[3]).to(device)
+
+    train_loader, test_loader = data_loader_furuta(
+        q1,
+        p1,
+        q2,
+        p2,
+        energy.to(device),
+        derivatives.to(device),
+        t_eval.to(device),
+        batch_size=batch_size,
+        shuffle=shuffle,
+        proportion=proportion,
+        coord_type=coord_type,
+        hard_mining=hard_mining,
+        return_index=True,  # to select the measured input of each trajectory
+    )
+    return train_loader, test_loader, recorded_u_func(u.to(device), Ts)
@@ -1,5 +1,7 @@
 import torch
 
+from .dynamics import NFECounter
+
 
 def choose_nonlinearity(name):
     """
@@ -19,6 +21,58 @@ def choose_nonlinearity(name):
     return nl
 
 
+def choose_nonlinearity_derivative(name):
+    """
+    Returns the derivative of the activation function returned by
+    choose_nonlinearity(name), used to compute input Jacobians analytically
+    """
+    dnl = None
+    if name == "tanh":
+
+        def dnl(x):
+            return 1 - torch.tanh(x).pow(2)
+
+    elif name == "x+sin(x)^2":
+
+        def dnl(x):
+            return 1 + torch.sin(2 * x)
+
+    else:
+        raise ValueError("nonlinearity not recognized")
+    return dnl
+
+
+def hamiltonian_gradient(H_net, q_p):
+    """
+    Description:
+        Evaluates the Hamiltonian H_net(q_p) and its gradient w.r.t. q_p.
+        If H_net implements forward_with_jacobian() the gradient is computed
+        analytically in the forward pass, so training only needs a first order
+        backward pass. Otherwise it falls back on torch.autograd.grad with
+        create_graph=True (double backward during training).
+    Inputs:
+        - H_net (nn.Module) : network approximating the Hamiltonian function
+        - q_p (tensor) : generalized coordinates [batch_size, input_dim]
+    Outputs:
+        - H (tensor) : Hamiltonian [batch_size, 1], or [batch_size, output_dim] if
+                       H_net has extra outputs (see Dissipation_Net(fused=True)),
+                       the Hamiltonian is then the first one
+        - dH (tensor) : gradient of H[:, 0] w.r.t. q_p [batch_size, input_dim]
+    """
+    if hasattr(H_net, "forward_with_jacobian"):
+        H, J = H_net.forward_with_jacobian(q_p)
+        return H, J[..., 0, :]
+
+    with torch.enable_grad():
+        q_p.requires_grad_(True)
+
+        H = H_net(q_p)
+
+        # .sum() to sum up the hamiltonian funcs of a batch
+        dH = torch.autograd.grad(H[..., 0].sum(), q_p, create_graph=True)[0]
+    return H, dH
+
+
 "MLP MODELS"
 
 
@@ -31,11 +85,22 @@ class hidden_Layer(torch.nn.Module):
         super().__init__()
         self.fc = torch.nn.Linear(hidden_dim, hidden_dim)
         self.activation = choose_nonlinearity(activation)  # activation function
+        self.activation_derivative = choose_nonlinearity_derivative(activation)
 
     def forward(self, x):
         x = self.activation(self.fc(x))
         return x
 
+    def forward_with_jacobian(self, x, J):
+        """
+        Propagates the input Jacobian J [..., hidden_dim, n] through the layer
+        """
+        z = self.fc(x)
+        J = self.activation_derivative(z).unsqueeze(dim=-1) * torch.matmul(
+            self.fc.weight, J
+        )
+        return self.activation(z), J
+
 
 class MLP(torch.nn.Module):
     """
@@ -57,12 +122,32 @@ class MLP(torch.nn.Module):
         )  # trick from EE-559 to define hidden layers
         self.fc2 = torch.nn.Linear(hidden_dim, output_dim)
         self.activation = choose_nonlinearity(activation)  # activation function
+        self.activation_derivative = choose_nonlinearity_derivative(activation)
 
     def forward(self, x):
         h = self.activation(self.fc1(x))
         h = self.hidden_layers(h)
         return self.fc2(h)
 
+    def forward_with_jacobian(self, x):
+        """
+        Description:
+            Forward pass that also returns the Jacobian of the output w.r.t. the
+            input, computed layer by layer (forward mode) with the known
+            activation derivatives instead of torch.autograd.grad
+        Inputs:
+            - x (tensor) : input [..., input_dim]
+        Outputs:
+            - y (tensor) : output [..., output_dim]
+            - J (tensor) : Jacobian dy/dx [..., output_dim, input_dim]
+        """
+        z = self.fc1(x)
+        J = self.activation_derivative(z).unsqueeze(dim=-1) * self.fc1.weight
+        h = self.activation(z)
+        for layer in self.hidden_layers:
+            h, J = layer.forward_with_jacobian(h, J)
+        return self.fc2(h), torch.matmul(self.fc2.weight, J)
+
 
 """ RESNETS """
 
@@ -87,7 +172,7 @@ class Expanding_ResNet(torch.nn.Module):
     ):
         super(Expanding_ResNet, self).__init__()
 
-        self.resblocks = [
+        self.resblocks = torch.nn.ModuleList(
             MLP(
                 input_dim=output_dim,
                 hidden_dim=hidden_dim,
@@ -96,7 +181,7 @@ class Expanding_ResNet(torch.nn.Module):
                 activation=activation_res,
             )
             for _ in range(num_blocks)
-        ]
+        )
 
         self.mlp = MLP(
             input_dim=input_dim,
@@ -119,6 +204,19 @@ class Expanding_ResNet(torch.nn.Module):
 
         return y
 
+    def forward_with_jacobian(self, x):
+        """
+        Same as forward() but also returns the Jacobian dy/dx, see MLP.forward_with_jacobian()
+        """
+        y, J = self.mlp.forward_with_jacobian(x)
+
+        for i in self.resblock_list:
+            r, J_r = self.resblocks[i].forward_with_jacobian(y)
+            y = r + y
+            J = torch.matmul(J_r, J) + J
+
+        return y, J
+
     def make_params_small(self):
         with torch.no_grad():
             for i in range(len(self.resblocks)):
@@ -144,7 +242,7 @@ class Interp_ResNet(torch.nn.Module):
     ):
         super(Interp_ResNet, self).__init__()
 
-        self.resblocks = [
+        self.resblocks = torch.nn.ModuleList(
             MLP(
                 input_dim=input_dim,
                 hidden_dim=hidden_dim,
@@ -153,7 +251,7 @@ class Interp_ResNet(torch.nn.Module):
                 activation=activation_res,
             )
             for _ in range(num_blocks)
-        ]
+        )
 
         self.mlp = MLP(
             input_dim=input_dim,
@@ -176,6 +274,23 @@ class Interp_ResNet(torch.nn.Module):
         y = self.mlp(y)
         return y
 
+    def forward_with_jacobian(self, x):
+        """
+        Same as forward() but also returns the Jacobian dy/dx, see MLP.forward_with_jacobian()
+        """
+        y = x
+        J = torch.eye(x.shape[-1], device=x.device, dtype=x.dtype).expand(
+            *x.shape, x.shape[-1]
+        )
+
+        for i in self.resblock_list:
+            r, J_r = self.resblocks[i].forward_with_jacobian(y)
+            y = r * self.alpha + y
+            J = torch.matmul(J_r, J) * self.alpha + J
+
+        y, J_mlp = self.mlp.forward_with_jacobian(y)
+        return y, torch.matmul(J_mlp, J)
+
     def init_new_resblocks_two(self, i, j):
         # i and j are the new resblocks to be initialised
         # in our simple case we introduce reblocks 1 and 2 between resblocks 0 and 3
@@ -224,7 +339,7 @@ class Expanding_ResNet_wide(torch.nn.Module):
     ):
         super(Expanding_ResNet_wide, self).__init__()
 
-        self.resblocks = [
+        self.resblocks = torch.nn.ModuleList(
             MLP(
                 input_dim=input_dim,
                 hidden_dim=hidden_dim,
@@ -233,7 +348,7 @@ class Expanding_ResNet_wide(torch.nn.Module):
                 activation=activation_res,
             )
             for _ in range(num_blocks)
-        ]
+        )
 
         self.mlp = MLP(
             input_dim=input_dim,
@@ -255,6 +370,23 @@ class Expanding_ResNet_wide(torch.nn.Module):
         y = self.mlp(y)
         return y
 
+    def forward_with_jacobian(self, x):
+        """
+        Same as forward() but also returns the Jacobian dy/dx, see MLP.forward_with_jacobian()
+        """
+        y = x
+        J = torch.eye(x.shape[-1], device=x.device, dtype=x.dtype).expand(
+            *x.shape, x.shape[-1]
+        )
+
+        for i in self.resblock_list:
+            r, J_r = self.resblocks[i].forward_with_jacobian(y)
+            y = r + y
+            J = torch.matmul(J_r, J) + J
+
+        y, J_mlp = self.mlp.forward_with_jacobian(y)
+        return y, torch.matmul(J_mlp, J)
+
     def make_params_small(self):
         with torch.no_grad():
             for i in range(len(self.resblocks)):
@@ -262,6 +394,122 @@ class Expanding_ResNet_wide(torch.nn.Module):
                     param.copy_(param / 1000)
 
 
+""" DISSIPATION """
+
+
+class Dissipation_Net(torch.nn.Module):
+    """
+    Description:
+        Learned positive semi-definite dissipation matrix R(x) = L(x) L(x)^T acting
+        on the momenta, dp/dt = -dH/dq - R(x) dH/dp + G_p u (the (J - R) dH + G u
+        of port-Hamiltonian systems, with R zero on the positions). L is lower
+        triangular, its num_entries = dof*(dof+1)/2 entries are given by an MLP of
+        the state, by constant parameters (state_dependent=False) or, with fused,
+        by the outputs 1: of H_net, so that they come out of the same pass as
+        the gradient of H (see hamiltonian_gradient()).
+    Inputs:
+        - dof (int) : number of degrees of freedom, R is [dof, dof]
+        - input_dim (int) : dimension of the state, input of the MLP
+        - hidden_dim (int) : width of the MLP
+        - nb_hidden_layers (int) : number of hidden layers of the MLP
+        - state_dependent (bool) : R(x) if True, constant R otherwise
+        - fused (bool) : the entries of L are the outputs 1: of H_net, which must
+                         then have output_dim = 1 + num_entries (the models zero
+                         them at initialization, see init_fused_outputs())
+        - init (float) : initial value of the diagonal of R
+        - activation (string) : activation function of the MLP
+    """
+
+    def __init__(
+        self,
+        dof=2,
+        input_dim=4,
+        hidden_dim=32,
+        nb_hidden_layers=1,
+        state_dependent=True,
+        fused=False,
+        init=1e-5,
+        activation="tanh",
+    ):
+        super(Dissipation_Net, self).__init__()
+        self.dof = dof
+        self.fused = fused
+        self.num_entries = dof * (dof + 1) // 2
+        rows, cols = torch.tril_indices(dof, dof)
+        self.register_buffer("rows", rows)
+        self.register_buffer("cols", cols)
+        # entries of L at initialization, R = init * identity
+        self.register_buffer("L0", (rows == cols).float() * init**0.5)
+
+        self.net = None
+        self.L_entries = None
+        if fused:
+            pass
+        elif state_dependent:
+            self.net = MLP(input_dim, hidden_dim, nb_hidden_layers, self.num_entries, activation)
+            with torch.no_grad():
+                self.net.fc2.weight.zero_()
+                self.net.fc2.bias.zero_()
+        else:
+            self.L_entries = torch.nn.Parameter(torch.zeros(self.num_entries))
+
+    def init_fused_outputs(self, H_net):
+        """
+        Zero initialization of the outputs 1: of H_net (weights and bias of the
+        layers that produce them) when the net is fused, so that the entries of L
+        start at L0 and R at init * identity as with the other modes
+        """
+        if isinstance(H_net, MLP):
+            layers = [H_net.fc2]
+        elif hasattr(H_net, "mlp"):
+            layers = [H_net.mlp.fc2]
+            if isinstance(H_net, Expanding_ResNet):
+                # residual blocks applied after the mlp, on the outputs
+                layers += [block.fc2 for block in H_net.resblocks]
+        else:
+            raise ValueError("unknown H_net {}, cannot find its output layer".format(type(H_net)))
+        for layer in layers:
+            if layer.out_features != 1 + self.num_entries:
+                raise ValueError(
+                    "a fused Dissipation_Net needs an H_net with output_dim = 1 + {}".format(
+                        self.num_entries
+                    )
+                )
+            with torch.no_grad():
+                layer.weight[1:].zero_()
+                layer.bias[1:].zero_()
+
+    def cholesky_factor(self, x, entries=None):
+        """
+        Lower triangular L(x) [batch_size, dof, dof] of the states x, entries are
+        the outputs 1: of H_net when fused
+        """
+        if self.fused:
+            raw = entries
+        elif self.net is not None:
+            raw = self.net(x)
+        else:
+            raw = self.L_entries.expand(x.shape[0], -1)
+        L = x.new_zeros(x.shape[0], self.dof, self.dof)
+        L[:, self.rows, self.cols] = self.L0 + raw
+        return L
+
+    def matrix(self, x, entries=None):
+        """
+        R(x) = L(x) L(x)^T [batch_size, dof, dof]
+        """
+        L = self.cholesky_factor(x, entries)
+        return torch.matmul(L, L.transpose(-1, -2))
+
+    def forward(self, x, dHdp, entries=None):
+        """
+        R(x) dH/dp [batch_size, dof], computed as L (L^T dH/dp) without forming R
+        """
+        L = self.cholesky_factor(x, entries)
+        v = torch.matmul(L.transpose(-1, -2), dHdp.unsqueeze(dim=-1))
+        return torch.matmul(L, v).squeeze(dim=-1)
+
+
 """ NEURAL ODE MODELS """
 
 
@@ -270,11 +518,18 @@ class simple_HNN(torch.nn.Module):
     Modified version of the original SymODEN_R module from symoden repository
     Similar to unconstrained ODE HNN from the report
 
+    With dissip the dissipation is R(x) dH/dp with a dissip_net (Dissipation_Net),
+    the learned coefficients C1_dissip and C2_dissip otherwise
     """
 
-    def __init__(self, input_dim, H_net=None, device=None):
+    def __init__(self, input_dim, H_net=None, device=None, dissip=True, dissip_net=None):
         super(simple_HNN, self).__init__()
         self.H_net = H_net
+        self.dissip = dissip
+        # learned dissipation matrix (Dissipation_Net), replaces C1_dissip and C2_dissip
+        self.dissip_net = dissip_net
+        if dissip_net is not None and dissip_net.fused:
+            dissip_net.init_fused_outputs(H_net)
 
         self.device = device
         self.input_dim = input_dim
@@ -287,32 +542,37 @@ class simple_HNN(torch.nn.Module):
         self.C2_dissip = torch.nn.Parameter(torch.tensor([0.02]).sqrt())
         self.C2_dissip.requires_grad = True
 
-    def forward(self, t, x):
-        with torch.enable_grad():
-            q_p = x
-
-            # q1,p1,q2,p2 = torch.chunk(x,4,dim=-1)
-
-            q_p.requires_grad_(True)
-
-            H = self.H_net(q_p)
-
-            # .sum() to sum up the hamiltonian funcs of a batch
-            dH = torch.autograd.grad(H.sum(), q_p, create_graph=True)
-
-            dH = dH[0]
+        # number of evaluations of forward(), see NFECounter
+        self.nfe_counter = NFECounter()
 
-            dHdq1, dHdp1, dHdq2, dHdp2 = torch.chunk(dH, 4, dim=-1)
-
-            dq1dt = dHdp1
+    def forward(self, t, x):
+        q_p = x
+
+        # gradient of H_net w.r.t. (q1,p1,q2,p2), see hamiltonian_gradient()
+        H, dH = hamiltonian_gradient(self.H_net, q_p)
+
+        dHdq1, dHdp1, dHdq2, dHdp2 = torch.chunk(dH, 4, dim=-1)
+
+        dq1dt = dHdp1
+        dq2dt = dHdp2
+        if self.dissip and self.dissip_net is not None:
+            # R(x) (dH/dp1, dH/dp2), the entries of L are in H if the net is fused
+            entries = H[:, 1:] if self.dissip_net.fused else None
+            R_dHdp = self.dissip_net(q_p, torch.cat((dHdp1, dHdp2), dim=-1), entries)
+            dp1dt = -dHdq1 - R_dHdp[:, 0:1]
+            dp2dt = -dHdq2 - R_dHdp[:, 1:2]
+        elif self.dissip:
             dp1dt = -dHdq1 - self.C1_dissip.pow(2) * dHdp1
-            dq2dt = dHdp2
             dp2dt = -dHdq2 - self.C2_dissip.pow(2) * dHdp2
+        else:
+            dp1dt = -dHdq1
+            dp2dt = -dHdq2
 
-            # symplectic gradient
-            S_h = torch.cat((dq1dt, dp1dt, dq2dt, dp2dt), dim=-1)
+        # symplectic gradient
+        S_h = torch.cat((dq1dt, dp1dt, dq2dt, dp2dt), dim=-1)
+        self.nfe_counter.forward(S_h)
 
-            return S_h
+        return S_h
 
 
 class Autoencoder(torch.nn.Module):
@@ -381,59 +641,121 @@ class Input_HNN(torch.nn.Module):
     """
     Modified version of the original SymODEN_R module from symoden repository
     Similar to unconstrained ODE HNN from the report
+
+    With system=None the state is the furuta pendulum (q1,p1,q2,p2), otherwise
+    the state layout and number of degrees of freedom of the system are used
+    (PortHamiltonianSystem, see make_system()), G_net then returns [batch_size,
+    state_dim] (one input) or [batch_size, state_dim, num_inputs]
+
+    With dissip and a dissip_net (Dissipation_Net) the dissipation is the learned
+    matrix R(x) instead of one coefficient per degree of freedom
     """
 
-    def __init__(self, u_func=None, G_net=None, H_net=None, device=None, dissip=False):
+    def __init__(
+        self,
+        u_func=None,
+        G_net=None,
+        H_net=None,
+        device=None,
+        dissip=False,
+        system=None,
+        dissip_net=None,
+    ):
         super(Input_HNN, self).__init__()
         self.H_net = H_net
         self.G_net = G_net
         self.u_func = u_func
         self.device = device
         self.dissip = dissip
-        # add learnable dissipation coefficients
-        self.C1_dissip = torch.nn.Parameter(torch.tensor([0.000009]).sqrt())
-        self.C1_dissip.requires_grad = True
-        self.C2_dissip = torch.nn.Parameter(torch.tensor([0.00004]).sqrt())
-        self.C2_dissip.requires_grad = True
-
-    def forward(self, t, x):
-        with torch.enable_grad():
-            q_p = x[:, :4]
-
-            q_p.requires_grad_(True)
-
-            H = self.H_net(q_p)
-
-            # .sum() to sum up the hamiltonian funcs of a batch
-            dH = torch.autograd.grad(H.sum(), q_p, create_graph=True)
-
-            dHdq1, dHdp1, dHdq2, dHdp2 = torch.chunk(dH[0], 4, dim=-1)
-
-            G = self.G_net.forward(q_p)
-
-            u = self.u_func.forward(t)
+        self.system = system
+        self.dissip_net = dissip_net
+        if system is None:
+            # furuta pendulum, (q1,p1,q2,p2)
+            self.state_dim = 4
+            self.q_index = slice(0, None, 2)
+            self.p_index = slice(1, None, 2)
+            self.interleaved = True
+            # add learnable dissipation coefficients
+            self.C1_dissip = torch.nn.Parameter(torch.tensor([0.000009]).sqrt())
+            self.C1_dissip.requires_grad = True
+            self.C2_dissip = torch.nn.Parameter(torch.tensor([0.00004]).sqrt())
+            self.C2_dissip.requires_grad = True
+        else:
+            self.state_dim = system.state_dim
+            self.q_index = system.q_index
+            self.p_index = system.p_index
+            self.interleaved = system.layout == "interleaved"
+            # one learnable dissipation coefficient per degree of freedom
+            self.C_dissip = torch.nn.Parameter(torch.full((system.dof,), 1e-5).sqrt())
+        if dissip_net is not None:
+            assert dissip_net.dof == self.state_dim // 2, "dissip_net must have one row per momentum"
+            if dissip_net.fused:
+                dissip_net.init_fused_outputs(H_net)
+
+        # number of evaluations of forward(), see NFECounter
+        self.nfe_counter = NFECounter()
+
+    def dissipation_coefficients(self):
+        """
+        Learned dissipation coefficient of every degree of freedom [dof]
+        """
+        if self.system is None:
+            return torch.cat((self.C1_dissip, self.C2_dissip)).pow(2)
+        return self.C_dissip.pow(2)
 
-            dq1dt = dHdp1
-            dq2dt = dHdp2
-            if self.dissip:
+    def dissipation(self, q_p, dHdp, H=None):
+        """
+        Dissipative term of dp/dt [batch_size, dof] : R(x) dH/dp with dissip_net
+        (its entries are the outputs 1: of H if it is fused), the learned
+        coefficients times dH/dp otherwise
+        """
+        if self.dissip_net is None:
+            return self.dissipation_coefficients() * dHdp
+        entries = H[:, 1:] if self.dissip_net.fused else None
+        return self.dissip_net(q_p, dHdp, entries)
 
-                dp1dt = (
-                    -dHdq1
-                    + (G[:, 1] * u).unsqueeze(dim=1)
-                    - self.C1_dissip.pow(2) * dHdp1
-                )
-                dp2dt = (
-                    -dHdq2
-                    + (G[:, 3] * u).unsqueeze(dim=1)
-                    - self.C2_dissip.pow(2) * dHdp2
-                )
-            else:
-                dp1dt = -dHdq1 + (G[:, 1] * u).unsqueeze(dim=1)
-                dp2dt = -dHdq2 + (G[:, 3] * u).unsqueeze(dim=1)
+    def dissipation_matrix(self, q_p):
+        """
+        Learned dissipation matrix R of the states q_p [batch_size, dof, dof]
+        """
+        if self.dissip_net is None:
+            coefficients = self.dissipation_coefficients()
+            return torch.diag_embed(coefficients.expand(q_p.shape[0], -1))
+        entries = self.H_net(q_p)[:, 1:] if self.dissip_net.fused else None
+        return self.dissip_net.matrix(q_p, entries)
 
-            # symplectic gradient
-            S_h = torch.cat((dq1dt, dp1dt, dq2dt, dp2dt), dim=-1)
-            return S_h
+    def forward(self, t, x):
+        q_p = x[:, : self.state_dim]
+
+        # gradient of H_net w.r.t. the state, see hamiltonian_gradient()
+        H, dH = hamiltonian_gradient(self.H_net, q_p)
+
+        dHdq = dH[:, self.q_index]
+        dHdp = dH[:, self.p_index]
+
+        G = self.G_net.forward(q_p)
+
+        # scalar or one input per trajectory (u_func.select()), as a column
+        # (or [batch_size or 1, num_inputs] with a multi input G)
+        if G.dim() == 2:
+            u = self.u_func.forward(t).reshape(-1, 1)
+            G_u = G[:, self.p_index] * u
+        else:
+            u = self.u_func.forward(t).reshape(-1, 1, G.shape[-1])
+            G_u = (G[:, self.p_index] * u).sum(dim=-1)
+
+        dqdt = dHdp
+        dpdt = -dHdq + G_u
+        if self.dissip:
+            dpdt = dpdt - self.dissipation(q_p, dHdp, H)
+
+        # symplectic gradient, in the layout of the state
+        if self.interleaved:
+            S_h = torch.stack((dqdt, dpdt), dim=-1).reshape(q_p.shape)
+        else:
+            S_h = torch.cat((dqdt, dpdt), dim=-1)
+        self.nfe_counter.forward(S_h)
+        return S_h
 
     def freeze_G_net(self, freeze=True):
         """
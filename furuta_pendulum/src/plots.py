@@ -5,6 +5,7 @@ import torch
 from torchdiffeq import odeint as odeint
 
 from .trajectories import *
+from .data import unpack_batch
 import time as time
 
 """ FOR DATA """
@@ -229,7 +230,7 @@ def plot_furuta_hat_nom(
       None
     """
 
-    x_nom, t_eval = next(iter(data_loader_t))
+    x_nom, t_eval, _ = unpack_batch(next(iter(data_loader_t)))
 
     t_eval = t_eval[0, :]  # otherwise it is by batch
     time_steps = len(t_eval)
@@ -448,6 +449,7 @@ def train_test_loss_plot(
     horizons=[100, 150, 200, 250, 300],
     switch_steps=[200, 200, 200, 200, 200],
     title="train and test loss per epoch",
+    switch_epochs=None,
 ):
     """
     Description:
@@ -460,15 +462,22 @@ def train_test_loss_plot(
          - horizons (list) : horizons with which the model will be trained
          - switch_steps (list) : number of epochs per horizon
          - title (string) : title of the plot
+         - switch_epochs (list or None) : epochs at which the horizon actually changed,
+                                         as logged by train() in logs["horizon_switch_epochs"]
+                                         (needed with horizon_type='adaptive'), replaces
+                                         switch_steps when given
     Outputs:
         None
     """
-    # convert switch steps from : [200,200,200,200,200] to [200,400,600...]
-    horizon_steps = []
-    horizon_steps.append(0)
-    for i, number in enumerate(switch_steps):
-        horizon_steps.append(horizon_steps[i] + number)
-    horizon_steps = horizon_steps[1:-1]
+    if switch_epochs is not None:
+        horizon_steps = list(switch_epochs)
+    else:
+        # convert switch steps from : [200,200,200,200,200] to [200,400,600...]
+        horizon_steps = []
+        horizon_steps.append(0)
+        for i, number in enumerate(switch_steps):
+            horizon_steps.append(horizon_steps[i] + number)
+        horizon_steps = horizon_steps[1:-1]
 
     fig, ax = plt.subplots(figsize=(10, 4))
 
@@ -484,7 +493,7 @@ def train_test_loss_plot(
     plt.legend()
     plt.title(title)
 
-    if horizons:
+    if horizons and horizon_steps:
         for i, epoch_num in enumerate(horizon_steps[:-1]):
             ax.annotate(
                 "%3d" % horizons[i],
@@ -0,0 +1,315 @@
+import json
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from .dynamics import U_FUNC
+from .trajectories import rk4_rollout
+
+""" INFERENCE SERVER """
+
+
+def load_checkpoint(model, checkpoint_path, device=None):
+    """
+    Description:
+        Loads a checkpoint saved with torch.save(model.state_dict(), path)
+        into an already constructed model and puts it in eval mode
+    Inputs:
+        - model (nn.Module) : model with the same architecture as the checkpoint
+        - checkpoint_path (string) : path of the saved state_dict
+        - device (string or torch.device) : device on which to load the model
+    Outputs:
+        - model (nn.Module) : model with the loaded weights
+    """
+    state_dict = torch.load(checkpoint_path, map_location=device)
+    model.load_state_dict(state_dict)
+    if device is not None:
+        model = model.to(device)
+    model.eval()
+    return model
+
+
+class InferenceServer:
+    """
+    Description:
+        Serves a trained simple_HNN or Input_HNN to several consumers from a
+        single process. Requests are put in a queue and a worker thread
+        groups the requests that arrive within max_wait seconds (up to
+        max_batch_size) into one batched call of the model:
+            - predict : rollout of all the initial states in one batch with
+                        rk4_rollout(), each trajectory with its own input
+                        sequence (zero-order hold, see U_FUNC 'sequence')
+            - hamiltonian : one batched evaluation of H_net
+        The time between submission and result of every request is recorded,
+        see latency_stats().
+    Inputs:
+        - model (nn.Module) : trained simple_HNN or Input_HNN
+        - Ts (float) : sampling time of the predictions and input sequences
+        - max_batch_size (int) : maximum number of requests in one batch
+        - max_wait (float) : time in seconds to wait for other requests after
+                             the first request of a batch arrived
+        - device (string or torch.device) : device of the model
+    Methods:
+        - start() / stop() : start and stop the worker thread
+        - predict(x0, steps, u_seq) : predicted trajectory [steps + 1, (q1,p1,q2,p2)]
+        - hamiltonian(x) : H(x) [batch_size]
+        - submit_predict(...) / submit_hamiltonian(...) : non blocking versions
+                                                         returning a Future
+        - latency_stats() : p50 / p99 latency and mean batch size
+
+    Example use :
+        model = load_checkpoint(model, model_path + "model", device)
+        server = InferenceServer(model, Ts=0.005).start()
+        x = server.predict(torch.tensor([0.0, 0.0, 1.0, 0.0]), steps=100, u_seq=u)
+        socket_server = serve_socket(server, port=5005)  # optional, other processes
+    """
+
+    def __init__(self, model, Ts=0.005, max_batch_size=64, max_wait=0.002, device=None):
+        self.model = model
+        self.Ts = Ts
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.device = device if device is not None else next(model.parameters()).device
+
+        self.requests = queue.Queue()
+        self.latencies = []  # submission to result time of every request
+        self.batch_sizes = []  # number of requests of every batch
+        self._lock = threading.Lock()
+        self._worker = None
+        self._running = False
+
+    def start(self):
+        if self._worker is None:
+            self._running = True
+            self._worker = threading.Thread(target=self._serve, daemon=True)
+            self._worker.start()
+        return self
+
+    def stop(self):
+        """
+        Stops accepting requests, serves the requests already queued and
+        waits for the worker thread to exit
+        """
+        if self._worker is not None:
+            with self._lock:
+                self._running = False
+                self.requests.put(None)  # last item of the queue, see _submit()
+            self._worker.join()
+            self._worker = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def submit_predict(self, x0, steps, u_seq=None):
+        """
+        Description:
+            Queues a prediction request
+        Inputs:
+            - x0 (tensor or list) : initial state (q1,p1,q2,p2)
+            - steps (int) : number of steps to predict
+            - u_seq (tensor, list or None) : input sequence [steps], zero if None
+        Outputs:
+            - future (Future) : result is the trajectory [steps + 1, (q1,p1,q2,p2)]
+        """
+        x0 = torch.as_tensor(x0, dtype=torch.float32).reshape(-1)[:4]
+        if u_seq is None:
+            u_seq = torch.zeros(steps)
+        u_seq = torch.as_tensor(u_seq, dtype=torch.float32).reshape(-1)
+        if u_seq.shape[0] < steps:
+            raise ValueError("u_seq must contain at least steps inputs")
+        return self._submit("predict", (x0, u_seq[:steps], int(steps)))
+
+    def submit_hamiltonian(self, x):
+        """
+        Description:
+            Queues the evaluation of the Hamiltonian
+        Inputs:
+            - x (tensor or list) : states [(q1,p1,q2,p2)] or [batch_size, (q1,p1,q2,p2)]
+        Outputs:
+            - future (Future) : result is H(x) [batch_size]
+        """
+        x = torch.as_tensor(x, dtype=torch.float32).reshape(-1, 4)
+        return self._submit("hamiltonian", x)
+
+    def predict(self, x0, steps, u_seq=None, timeout=None):
+        return self.submit_predict(x0, steps, u_seq).result(timeout)
+
+    def hamiltonian(self, x, timeout=None):
+        return self.submit_hamiltonian(x).result(timeout)
+
+    def _submit(self, kind, payload):
+        future = Future()
+        # under the lock so that no request is queued after the stop sentinel
+        with self._lock:
+            if not self._running:
+                raise RuntimeError("the server is not running, call start() first")
+            self.requests.put((kind, payload, future, time.perf_counter()))
+        return future
+
+    def _next_batch(self):
+        """
+        Blocks until a request arrives, then collects the requests that arrive
+        within max_wait seconds, up to max_batch_size requests. Also returns
+        whether the stop sentinel was read (no request can follow it)
+        """
+        request = self.requests.get()
+        if request is None:
+            return [], True
+        batch = [request]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _serve(self):
+        stopped = False
+        while not stopped:
+            batch, stopped = self._next_batch()
+            for kind in ("predict", "hamiltonian"):
+                requests = [request for request in batch if request[0] == kind]
+                if not requests:
+                    continue
+                try:
+                    if kind == "predict":
+                        results = self._predict_batch([r[1] for r in requests])
+                    else:
+                        results = self._hamiltonian_batch([r[1] for r in requests])
+                except Exception as error:
+                    for _, _, future, _ in requests:
+                        future.set_exception(error)
+                    continue
+
+                done = time.perf_counter()
+                with self._lock:
+                    self.batch_sizes.append(len(requests))
+                    for (_, _, future, submitted), result in zip(requests, results):
+                        self.latencies.append(done - submitted)
+                        future.set_result(result)
+
+    def _predict_batch(self, payloads):
+        """
+        One rollout for all the requests, the input sequences are padded with
+        zeros to the longest horizon and each trajectory is cut to its own
+        number of steps
+        """
+        max_steps = max(steps for _, _, steps in payloads)
+        x0 = torch.stack([x0 for x0, _, _ in payloads]).to(self.device)
+        u_seq = torch.zeros(len(payloads), max(max_steps, 1))
+        for i, (_, u, steps) in enumerate(payloads):
+            u_seq[i, :steps] = u
+        u_seq = u_seq.to(self.device)
+
+        u_func = getattr(self.model, "u_func", None)
+        if u_func is not None:
+            self.model.u_func = U_FUNC(
+                utype="sequence", params={"u_seq": u_seq, "t0": 0.0, "Ts": self.Ts}
+            )
+        try:
+            with torch.no_grad():
+                x = rk4_rollout(self.model, x0, 0.0, self.Ts, max_steps)
+        finally:
+            if u_func is not None:
+                self.model.u_func = u_func
+
+        x = x.cpu()
+        return [x[: steps + 1, i] for i, (_, _, steps) in enumerate(payloads)]
+
+    def _hamiltonian_batch(self, payloads):
+        sizes = [x.shape[0] for x in payloads]
+        x = torch.cat(payloads).to(self.device)
+        with torch.no_grad():
+            H = self.model.H_net(x)[..., 0].cpu()  # first output, see Dissipation_Net
+        return list(torch.split(H, sizes))
+
+    def latency_stats(self):
+        """
+        Returns the mean, p50, p99 and max latency in seconds of the served
+        requests and the mean number of requests per batch
+        """
+        with self._lock:
+            if not self.latencies:
+                return {}
+            latencies = torch.tensor(self.latencies)
+            batch_sizes = torch.tensor(self.batch_sizes, dtype=torch.float32)
+        return {
+            "mean": latencies.mean().item(),
+            "p50": torch.quantile(latencies, 0.5).item(),
+            "p99": torch.quantile(latencies, 0.99).item(),
+            "max": latencies.max().item(),
+            "num_requests": len(latencies),
+            "mean_batch_size": batch_sizes.mean().item(),
+        }
+
+
+class _JSONLinesHandler(socketserver.StreamRequestHandler):
+    """
+    One JSON request per line, one JSON answer per line :
+        {"op": "predict", "x0": [q1,p1,q2,p2], "steps": N, "u": [u_0, ..., u_N-1]}
+            -> {"x": [[q1,p1,q2,p2], ...]}
+        {"op": "hamiltonian", "x": [[q1,p1,q2,p2], ...]} -> {"H": [...]}
+        {"op": "stats"} -> latency_stats()
+    """
+
+    def handle(self):
+        server = self.server.inference_server
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if request["op"] == "predict":
+                    x = server.predict(request["x0"], request["steps"], request.get("u"))
+                    answer = {"x": x.tolist()}
+                elif request["op"] == "hamiltonian":
+                    answer = {"H": server.hamiltonian(request["x"]).tolist()}
+                elif request["op"] == "stats":
+                    answer = server.latency_stats()
+                else:
+                    raise ValueError("unknown op " + str(request["op"]))
+            except Exception as error:
+                answer = {"error": str(error)}
+            self.wfile.write((json.dumps(answer) + "\n").encode())
+            self.wfile.flush()
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve_socket(inference_server, host="127.0.0.1", port=0):
+    """
+    Description:
+        Exposes a running InferenceServer on a TCP socket (JSON lines protocol,
+        see _JSONLinesHandler) so that controllers and dashboards in other
+        processes can share the same model. Every connection is handled in
+        its own thread, the requests of all connections are batched together
+        by the InferenceServer.
+    Inputs:
+        - inference_server (InferenceServer) : started inference server
+        - host (string) : address to listen on, loopback by default
+        - port (int) : port to listen on, 0 picks a free port
+    Outputs:
+        - socket_server (TCPServer) : call socket_server.shutdown() to stop it,
+                                      socket_server.server_address gives the port
+    """
+    socket_server = _ThreadingTCPServer((host, port), _JSONLinesHandler)
+    socket_server.inference_server = inference_server
+    threading.Thread(target=socket_server.serve_forever, daemon=True).start()
+    return socket_server
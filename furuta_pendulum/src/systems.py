@@ -0,0 +1,443 @@
+import math
+
+import torch
+
+from .data import data_loader_system, unpack_batch
+from .dynamics import furuta_H, furuta_dH
+from .engine import SystemSpec
+from .trajectories import rk4_rollout
+
+""" SYSTEM REGISTRY
+
+Port-Hamiltonian systems with any number of degrees of freedom
+
+    dq/dt = dH/dp + G_q u
+    dp/dt = -dH/dq - D dH/dp + G_p u
+
+described by their state layout, true Hamiltonian, damping D and input matrix G.
+The dynamics are vectorized over a batch of states, the datasets they generate
+have the same batches as the furuta pendulum ones (x, t_eval, idx) so that
+Input_HNN(system=...), train(system=...) and Validator can be used with them,
+evaluate_long_horizon(system=...) names the coordinates of the report.
+
+Example use :
+    system = make_system("double_pendulum", masses=(1.0, 0.5))
+    train_loader, test_loader = load_system_data(system, 100, 200, 0.01, u_func)
+    model = Input_HNN(u_func, system.input_matrix_net(), H_net, system=system)
+    logs = train(device, model, Ts, train_loader, test_loader, False, True, False, 0, system=system)
+"""
+
+
+class PortHamiltonianSystem:
+    """
+    Description:
+        Port-Hamiltonian system with dof degrees of freedom and state_dim = 2*dof
+    Inputs:
+        - name (string) : name of the system
+        - dof (int) : number of degrees of freedom
+        - hamiltonian (callable) : H(q, p) -> [batch_size, 1], q and p [batch_size, dof]
+        - input_matrix (tensor or callable) : G, constant [state_dim] (one input) or
+                            [state_dim, num_inputs], or G(x) -> [batch_size, state_dim(, num_inputs)]
+        - damping (list or None) : damping coefficient of every degree of freedom
+        - layout (string) : 'interleaved' (q1,p1,q2,p2,...) or 'block' (q1,..,qn,p1,..,pn)
+        - coordinates (tuple or None) : names of the state coordinates
+        - gradient (callable or None) : closed form gradient x -> dH [batch_size, state_dim],
+                            autograd is used if None
+        - q_range, p_range (floats) : initial states are drawn in [-q_range, q_range]
+                            and [-p_range, p_range], see sample_initial_states()
+        - params (dict or None) : physical parameters, for the logs
+    """
+
+    def __init__(
+        self,
+        name,
+        dof,
+        hamiltonian,
+        input_matrix,
+        damping=None,
+        layout="block",
+        coordinates=None,
+        gradient=None,
+        q_range=1.0,
+        p_range=0.1,
+        params=None,
+    ):
+        assert layout in ("interleaved", "block"), "layout must be 'interleaved' or 'block'"
+        self.name = name
+        self.dof = dof
+        self.state_dim = 2 * dof
+        self.layout = layout
+        self._hamiltonian = hamiltonian
+        self._input_matrix = input_matrix
+        self._gradient = gradient
+        self.damping = torch.tensor(damping if damping is not None else [0.0] * dof)
+        self.q_range = q_range
+        self.p_range = p_range
+        self.params = dict(params or {})
+        if layout == "interleaved":
+            self.q_index = slice(0, None, 2)
+            self.p_index = slice(1, None, 2)
+        else:
+            self.q_index = slice(0, dof)
+            self.p_index = slice(dof, None)
+        if coordinates is None:
+            q_names = ["q{}".format(i + 1) for i in range(dof)]
+            p_names = ["p{}".format(i + 1) for i in range(dof)]
+            coordinates = self.merge_names(q_names, p_names)
+        self.coordinates = tuple(coordinates)
+
+    def merge_names(self, q_names, p_names):
+        if self.layout == "interleaved":
+            return [name for pair in zip(q_names, p_names) for name in pair]
+        return list(q_names) + list(p_names)
+
+    @property
+    def num_inputs(self):
+        G = self.input_matrix(torch.zeros(1, self.state_dim))
+        return 1 if G.dim() == 2 else G.shape[-1]
+
+    def split(self, x):
+        """
+        (q, p) [..., dof] of states [..., state_dim]
+        """
+        return x[..., self.q_index], x[..., self.p_index]
+
+    def merge(self, q, p):
+        """
+        States [..., state_dim] from (q, p) [..., dof]
+        """
+        if self.layout == "interleaved":
+            return torch.stack((q, p), dim=-1).reshape(*q.shape[:-1], self.state_dim)
+        return torch.cat((q, p), dim=-1)
+
+    def hamiltonian(self, x):
+        """
+        True Hamiltonian of states [batch_size, state_dim], [batch_size, 1]
+        """
+        q, p = self.split(x)
+        return self._hamiltonian(q, p)
+
+    def gradient(self, x):
+        """
+        Gradient of the Hamiltonian w.r.t. the state [batch_size, state_dim]
+        """
+        if self._gradient is not None:
+            return self._gradient(x)
+        with torch.enable_grad():
+            x = x.detach().requires_grad_(True)
+            H = self.hamiltonian(x)
+            return torch.autograd.grad(H.sum(), x)[0]
+
+    def input_matrix(self, x):
+        """
+        Input matrix of states [batch_size, state_dim], [batch_size, state_dim]
+        (one input) or [batch_size, state_dim, num_inputs]
+        """
+        if callable(self._input_matrix):
+            return self._input_matrix(x)
+        G = torch.as_tensor(self._input_matrix, dtype=x.dtype, device=x.device)
+        return G.expand(x.shape[0], *G.shape)
+
+    def dynamics(self, t, x, u=None):
+        """
+        Description:
+            Vector field of the system for a batch of states
+        Inputs:
+            - t (tensor) : time
+            - x (tensor) : states [batch_size, state_dim]
+            - u (tensor or None) : input, scalar, [batch_size] or [batch_size or 1, num_inputs]
+        Outputs:
+            - dxdt (tensor) : [batch_size, state_dim]
+        """
+        dH = self.gradient(x)
+        dHdq, dHdp = self.split(dH)
+        dqdt = dHdp
+        dpdt = -dHdq - self.damping.to(x.device, x.dtype) * dHdp
+        dxdt = self.merge(dqdt, dpdt)
+        if u is not None:
+            G = self.input_matrix(x)
+            if G.dim() == 2:
+                dxdt = dxdt + G * u.reshape(-1, 1)
+            else:
+                dxdt = dxdt + (G * u.reshape(-1, 1, G.shape[-1])).sum(dim=-1)
+        return dxdt
+
+    def vector_field(self, u_func=None):
+        """
+        f(t, x) of the system driven by u_func (U_FUNC), for rk4_rollout() or odeint
+        """
+
+        def f(t, x):
+            u = None if u_func is None else u_func.forward(t)
+            return self.dynamics(t, x, u)
+
+        return f
+
+    def input_matrix_net(self):
+        """
+        True input matrix with the interface of G_FUNC, to be used as G_net of Input_HNN
+        """
+        return SystemInputMatrix(self)
+
+    def spec(self):
+        """
+        SystemSpec of the training engine
+        """
+        return SystemSpec(
+            self.name,
+            state_dim=self.state_dim,
+            coordinates=self.coordinates,
+            unpack_batch=unpack_batch,
+        )
+
+    def sample_initial_states(self, num_trajectories, device="cpu", generator=None):
+        """
+        Uniform initial states [num_trajectories, state_dim]
+        """
+        q = torch.rand(num_trajectories, self.dof, generator=generator) * 2 - 1
+        p = torch.rand(num_trajectories, self.dof, generator=generator) * 2 - 1
+        return self.merge(q * self.q_range, p * self.p_range).to(device)
+
+    def simulate(self, x0, Ts, steps, u_func=None, t0=None, noise_std=0.0):
+        """
+        Description:
+            Fixed step rk4 rollout of all the initial states at once
+        Inputs:
+            - x0 (tensor) : initial states [num_trajectories, state_dim]
+            - Ts (float) : sampling time
+            - steps (int) : number of steps
+            - u_func (U_FUNC or None) : input, unforced if None
+            - t0 (float or None) : time of x0, Ts if None (first element of t_eval)
+            - noise_std (float) : standard deviation of the noise added to the states
+        Outputs:
+            - x (tensor) : trajectories [num_trajectories, steps + 1, state_dim]
+            - t_eval (tensor) : times [steps + 1]
+        """
+        t0 = Ts if t0 is None else t0
+        with torch.no_grad():
+            x = rk4_rollout(self.vector_field(u_func), x0, t0, Ts, steps)
+        x = x.permute(1, 0, 2).contiguous()
+        if noise_std:
+            x = x + noise_std * torch.randn_like(x)
+        t_eval = t0 + Ts * torch.arange(steps + 1, device=x0.device, dtype=x0.dtype)
+        return x, t_eval
+
+
+class SystemInputMatrix:
+    """
+    Input matrix of a PortHamiltonianSystem with the forward(coords) of G_FUNC
+    """
+
+    def __init__(self, system):
+        self.system = system
+
+    def forward(self, coords):
+        G = self.system.input_matrix(coords)
+        G.requires_grad = False
+        return G
+
+
+# name : factory returning a PortHamiltonianSystem, see register_system()
+SYSTEMS = {}
+
+
+def register_system(name):
+    """
+    Decorator adding a factory function (keyword parameters -> PortHamiltonianSystem)
+    to the registry under name
+    """
+
+    def decorator(factory):
+        SYSTEMS[name] = factory
+        return factory
+
+    return decorator
+
+
+def make_system(name, **params):
+    """
+    Builds the registered system name with its parameters
+    """
+    if name not in SYSTEMS:
+        raise ValueError(
+            "unknown system {!r}, registered systems : {}".format(name, available_systems())
+        )
+    return SYSTEMS[name](**params)
+
+
+def available_systems():
+    return sorted(SYSTEMS)
+
+
+def _mass_matrix_energy(M, p):
+    """
+    Kinetic energy 0.5 * p^T M^-1 p of momenta p [batch_size, dof] with the
+    mass matrices M [batch_size, dof, dof], [batch_size, 1]
+    """
+    v = torch.linalg.solve(M, p.unsqueeze(-1))
+    return 0.5 * (p.unsqueeze(-2) @ v).squeeze(-1)
+
+
+@register_system("simple_pendulum")
+def simple_pendulum(m=1.0, g=9.81, l=1.0, C=0.0):
+    def hamiltonian(q, p):
+        return p**2 / (2 * m * l**2) + m * g * l * (1 - torch.cos(q))
+
+    return PortHamiltonianSystem(
+        "simple_pendulum",
+        1,
+        hamiltonian,
+        input_matrix=[0.0, 1.0],
+        damping=[C],
+        layout="interleaved",
+        coordinates=("q", "p"),
+        q_range=math.pi / 2,
+        p_range=1.0,
+        params=dict(m=m, g=g, l=l, C=C),
+    )
+
+
+@register_system("furuta")
+def furuta(g=9.81, Jr=5.72e-5, Lr=0.085, Mp=0.024, Lp=0.129, C_q1=0.0, C_q2=0.0):
+    def hamiltonian(q, p):
+        return furuta_H(q[:, 0:1], p[:, 0:1], q[:, 1:2], p[:, 1:2], g, Jr, Lr, Mp, Lp)
+
+    def gradient(x):
+        return torch.cat(furuta_dH(x, g, Jr, Lr, Mp, Lp), dim=-1)
+
+    return PortHamiltonianSystem(
+        "furuta",
+        2,
+        hamiltonian,
+        input_matrix=[0.0, 1.0, 0.0, 1.0],  # G_FUNC(gtype='simple')
+        damping=[C_q1, C_q2],
+        layout="interleaved",
+        coordinates=("q1", "p1", "q2", "p2"),
+        gradient=gradient,
+        q_range=1.0,
+        p_range=1e-3,
+        params=dict(g=g, Jr=Jr, Lr=Lr, Mp=Mp, Lp=Lp, C_q1=C_q1, C_q2=C_q2),
+    )
+
+
+@register_system("cart_pole")
+def cart_pole(m_cart=1.0, m_pole=0.1, l=0.5, g=9.81, damping=(0.0, 0.0)):
+    """
+    Cart (position x) with a pole (point mass at distance l, angle theta from the
+    downward vertical), the input is a force on the cart
+    """
+
+    def hamiltonian(q, p):
+        c = torch.cos(q[:, 1])
+        M = torch.stack(
+            (
+                torch.stack((torch.full_like(c, m_cart + m_pole), m_pole * l * c), dim=-1),
+                torch.stack((m_pole * l * c, torch.full_like(c, m_pole * l**2)), dim=-1),
+            ),
+            dim=-2,
+        )
+        V = m_pole * g * l * (1 - c)
+        return _mass_matrix_energy(M, p) + V.unsqueeze(-1)
+
+    return PortHamiltonianSystem(
+        "cart_pole",
+        2,
+        hamiltonian,
+        input_matrix=[0.0, 0.0, 1.0, 0.0],  # (x, theta, p_x, p_theta)
+        damping=list(damping),
+        layout="block",
+        coordinates=("x", "theta", "p_x", "p_theta"),
+        q_range=1.0,
+        p_range=0.1,
+        params=dict(m_cart=m_cart, m_pole=m_pole, l=l, g=g, damping=list(damping)),
+    )
+
+
+@register_system("n_link_pendulum")
+def n_link_pendulum(n=3, masses=None, lengths=None, g=9.81, damping=None):
+    """
+    Planar chain of n links with point masses at their ends, absolute angles
+    from the downward vertical, the input is a torque on the first joint
+    """
+    masses = torch.tensor(masses if masses is not None else [1.0] * n)
+    lengths = torch.tensor(lengths if lengths is not None else [1.0] * n)
+    assert len(masses) == n and len(lengths) == n, "one mass and one length per link"
+    # mass carried by every link : sum of the masses at and after it
+    carried = masses.flip(0).cumsum(0).flip(0)
+    index = torch.arange(n)
+    # M_jk = l_j l_k cos(q_j - q_k) * carried[max(j, k)]
+    M_const = (
+        lengths[:, None] * lengths[None, :] * carried[torch.maximum(index[:, None], index[None, :])]
+    )
+    V_const = g * carried * lengths
+
+    def hamiltonian(q, p):
+        M = M_const.to(q) * torch.cos(q.unsqueeze(-1) - q.unsqueeze(-2))
+        V = (V_const.to(q) * (1 - torch.cos(q))).sum(dim=-1, keepdim=True)
+        return _mass_matrix_energy(M, p) + V
+
+    G = torch.zeros(2 * n)
+    G[n] = 1.0
+    return PortHamiltonianSystem(
+        "n_link_pendulum" if n != 2 else "double_pendulum",
+        n,
+        hamiltonian,
+        input_matrix=G,
+        damping=list(damping) if damping is not None else [0.0] * n,
+        layout="block",
+        q_range=math.pi / 4,
+        p_range=0.1,
+        params=dict(n=n, masses=masses.tolist(), lengths=lengths.tolist(), g=g),
+    )
+
+
+@register_system("double_pendulum")
+def double_pendulum(masses=(1.0, 1.0), lengths=(1.0, 1.0), g=9.81, damping=None):
+    return n_link_pendulum(2, list(masses), list(lengths), g, damping)
+
+
+def load_system_data(
+    system,
+    num_trajectories,
+    time_steps,
+    Ts,
+    u_func=None,
+    batch_size=100,
+    proportion=0.8,
+    shuffle=False,
+    noise_std=0.0,
+    device="cpu",
+    hard_mining=False,
+    generator=None,
+):
+    """
+    Description:
+        Generates trajectories of a registered system from random initial states
+        and returns the train and test loaders, with the batch layout of the
+        furuta pendulum loaders (x [batch_size, time_steps, state_dim], t_eval, idx)
+    Inputs:
+        - system (PortHamiltonianSystem) : see make_system()
+        - num_trajectories (int) : number of trajectories
+        - time_steps (int) : number of time steps of every trajectory
+        - Ts (float) : sampling time
+        - u_func (U_FUNC or None) : input, one per trajectory with 'sequence' or
+                                    'excitation' (the loaders then return the indices)
+        - batch_size, proportion, shuffle, hard_mining : see data_loader_furuta()
+        - noise_std (float) : noise added to the states
+        - device (string) : device of the trajectories
+        - generator (torch.Generator or None) : random initial states
+    Outputs:
+        - train_loader, test_loader (DataLoader)
+    """
+    x0 = system.sample_initial_states(num_trajectories, device, generator)
+    x, t_eval = system.simulate(x0, Ts, time_steps - 1, u_func, noise_std=noise_std)
+    return_index = u_func is not None and u_func.per_trajectory()
+    return data_loader_system(
+        x,
+        t_eval,
+        batch_size,
+        shuffle=shuffle,
+        proportion=proportion,
+        hard_mining=hard_mining,
+        return_index=return_index,
+    )
@@ -3,12 +3,54 @@ import torch
 
 from torch.optim.lr_scheduler import LinearLR
 
-from .plots import *
 from .dynamics import *
 from .trajectories import *
 from .utils import *
 from .train_helpers import *
+from .data import normalization_stats, unpack_batch
+from .engine import *
+from .evaluation import Validator
 
+# state (q1,p1,q2,p2), the input and input matrix columns of the batches are ignored
+FURUTA_SYSTEM = SystemSpec(
+    "furuta", state_dim=4, coordinates=("q1", "p1", "q2", "p2"), unpack_batch=unpack_batch
+)
+
+
+class TrainingPlot(Callback):
+    """
+    Plots the first trajectory of the first batch every `every` epochs
+    """
+
+    def __init__(self, every=10):
+        self.every = every
+
+    def on_batch_end(self, engine, step, i_batch, x_nom, x_hat, t_eval):
+        if step % self.every or i_batch:
+            return
+        t_plot = time.time()
+        with engine.phase_timer.phase("plot"):
+            # matplotlib is only imported when a plot is made
+            from .plots import training_plot
+
+            training_plot(t_eval, x_hat.detach(), x_nom)
+        print("plot time :", time.time() - t_plot)
+
+
+class GradientLogger(Callback):
+    """
+    Saves the gradients of the layers before and after clipping in logs["grads_preclip"],
+    logs["grads_postclip"] and their names in logs["layer_names"], see collect_gradients()
+    """
+
+    def on_after_backward(self, engine):
+        _, self.grads_preclip = collect_gradients(engine.model.named_parameters())
+
+    def on_before_optim(self, engine):
+        layer_names, grads_postclip = collect_gradients(engine.model.named_parameters())
+        engine.logs.setdefault("layer_names", []).append(layer_names)
+        engine.logs.setdefault("grads_preclip", []).append(self.grads_preclip)
+        engine.logs.setdefault("grads_postclip", []).append(grads_postclip)
 
 
 def train(
@@ -31,7 +73,15 @@ def train(
     loss_type="L2",
     collect_grads=False,
     rescale_loss=False,
-    rescale_dims=[1, 1, 1, 1],
+    rescale_dims=None,
+    growth_scheduler=None,
+    horizon_controller=None,
+    phase_timer=None,
+    profile_window=None,
+    loss_discount=None,
+    validator=None,
+    validate_every=10,
+    system=None,
 ):
     """
     Description:
@@ -45,7 +95,8 @@ def train(
         - train_loader (data loader object) : train loader 
         - test_loader (data loader object) : test loader 
         - w (bool or tensor) : either false or a tensor containing the weights
-                             to rescale each coordinate 
+                             to rescale each coordinate [state_dim], ones with
+                             loss_type='L2weighted' if false
         - grad_clip (bool) : activate gradient clipping or not
         - lr_schedule (bool) : use a learning rate scheduler or not
         - begin_decay (int) : epoch at which learning rate decay should start
@@ -61,187 +112,166 @@ def train(
         - horizon_type (string) : type of horizon can be :
                                                     - 'auto' : is determined by a function 
                                                                and the training epoch
+                                                    - 'adaptive' : is increased when the loss
+                                                                   converged, see AdaptiveHorizon
                                                     - 'constant' : stays constant
         - horizon_list (list) : horizons with which the model will be trained
         - switch_steps (list) : number of epochs per horizon
         - epochs (int) : number of training epochs
         - loss_type (string) : type of loss, can be one of : 'L2weighted' or 'L2'
         - collect_grads (bool) : save the gradient values during training
-        - rescale_loss (bool) : rescale the loss function during training
-        - rescale_dims (list): list containing how the coordinates were rescaled
+        - rescale_loss (bool) : rescale the loss function during training with the
+                                (max - min) of each coordinate over the train (test) set
+                                and the current horizon, see normalization_stats()
+        - rescale_dims (list or None): list containing how the coordinates were rescaled,
+                            all the state_dim coordinates if None
+        - growth_scheduler (MultilevelScheduler or None) : how the multilevel model grows
+                            during training, if None and resnet_config is set, it is
+                            built from resnet_config and switch_steps
+        - horizon_controller (AdaptiveHorizon or None) : controller used when
+                            horizon_type='adaptive', if None one is built with
+                            switch_steps as the maximum number of epochs per horizon.
+                            The model grows (growth_scheduler) when the horizon changes
+        - phase_timer (PhaseTimer or None) : times the phases of every epoch (data, forward,
+                            loss, backward, clip, optim, growth, plot, validation),
+                            a default one is used if None
+        - profile_window (ProfilerWindow or None) : runs torch.profiler for a window of
+                            training steps, the summary table is saved in logs["profile"]
+        - loss_discount (float or None) : the error at time step k is weighted by
+                            loss_discount**k, see trajectory_loss()
+        - validator (Validator or None) : evaluates the whole test split in a few
+                            batched rollouts, built from test_loader.dataset if None
+        - validate_every (int) : number of epochs between two validations (1 to
+                            validate at every epoch)
+        - system (PortHamiltonianSystem, SystemSpec or None) : system of the trajectories,
+                            the furuta pendulum (q1,p1,q2,p2) if None, see make_system()
 
     Outptus:
         - logs (dict) : dict containing statistics from the training run
     """
 
+    if system is None:
+        system = FURUTA_SYSTEM
+    elif hasattr(system, "spec"):
+        system = system.spec()  # PortHamiltonianSystem
+    state_dim = system.state_dim
+    if rescale_dims is None:
+        rescale_dims = [1] * state_dim
+    if len(rescale_dims) != state_dim:
+        raise ValueError(
+            "rescale_dims has {} entries for a state of dimension {}".format(
+                len(rescale_dims), state_dim
+            )
+        )
+    if loss_type == "L2weighted" and (w is None or w is False):
+        w = torch.ones(state_dim, device=device)
+    if torch.is_tensor(w) and w.shape[-1] != state_dim:
+        raise ValueError(
+            "w has {} weights for a state of dimension {}".format(w.shape[-1], state_dim)
+        )
+
     optim = torch.optim.AdamW(model.parameters(), lr= 1e-3, weight_decay=1e-4)  # Adam
+    scheduler = None
     if lr_schedule:
         scheduler = LinearLR(
             optim, start_factor=1.0, end_factor=0.5, total_iters=epochs - begin_decay
         )
 
-    logs = {
-        "train_loss": [],
-        "test_loss": [],
-        "grads_preclip": [],
-        "grads_postclip": [],
-        "layer_names": [],
-    }
-
-    denom = torch.tensor([1], device=device)
-    denom_test = torch.tensor([1], device=device)
-    horizon_updated = 1
-
-    for step in range(epochs):
-
-        train_loss = 0
-        test_loss = 0
-        t1 = time.time()
+    if phase_timer is None:
+        phase_timer = PhaseTimer(device)
 
-        if horizon_type == "auto":
-            horizon_updated, horizon = select_horizon_list(
-                step, epochs, horizon_list, switch_steps
-            )
-        elif horizon_type == "constant":
-            horizon = horizon
-
-        # increase the model size and initialie the new parameters
-        if resnet_config:
-            model = multilevel_strategy_update(
-                device, step, model, resnet_config, switch_steps
-            )
+    if resnet_config and growth_scheduler is None:
+        growth_scheduler = MultilevelScheduler.from_resnet_config(
+            resnet_config, switch_steps, len(model.H_net.resblocks), device
+        )
 
-        model.train()
+    if horizon_type == "auto":
+        curriculum = ScheduledHorizon(horizon_list, switch_steps)
+    elif horizon_type == "adaptive":
+        if horizon_controller is None:
+            horizon_controller = AdaptiveHorizon(horizon_list, max_epochs=switch_steps)
+        curriculum = horizon_controller
+    else:
+        curriculum = ConstantHorizon(horizon)
+
+    def time_weights(steps, device):
+        if loss_discount is None:
+            return None
+        return loss_discount ** torch.arange(steps, device=device, dtype=torch.float32)
+
+    def loss_fn(x_nom, x_hat, mask, horizon):
+        # (max-min) of the train set to rescale the loss function, computed
+        # once per horizon and cached with the dataset
+        denom = None
+        if rescale_loss:
+            _, _, denom = normalization_stats(train_loader.dataset, horizon, rescale_dims)
+        return L2_loss(
+            x_nom,
+            x_hat,
+            w,
+            param=loss_type,
+            rescale_loss=rescale_loss,
+            denom=denom,
+            mask=mask,
+            time_weights=time_weights(x_hat.shape[0], x_hat.device),
+            u_layout="batch_first",
+        )
 
-        for i_batch, (x, t_eval) in enumerate(train_loader):
-            # x is [batch_size, time_steps, (q1,p1,q2,p1,u,g1,g2,g3,g4)]
+    # input of the whole dataset, model.u_func holds the selection of the
+    # current batch during training (see U_FUNC.select())
+    full_u_func = getattr(model, "u_func", None)
 
-            t_eval = t_eval[0, :horizon]
+    if test_loader:
+        if validator is None:
+            validator = Validator(test_loader.dataset, Ts)
 
-            # calculate (max-min) to rescale the loss function
+        def validate(model, horizon):
+            # whole test split in a few batched rollouts, see Validator
+            denom_test = None
             if rescale_loss:
-                if horizon_updated:
-                    _, _, denom = get_maxmindenom(
-                        x=x[:, :horizon, :4].permute(1, 0, 2),
-                        dim1=(0),
-                        dim2=(0),
-                        rescale_dims=rescale_dims,
-                    )
-
-            for i in range(
-                2 if alternating else 1
-            ):  # only runs once if alternating = False
-                if i == 0 and alternating:  # train only the model approximating G
-                    model.freeze_H_net(freeze=True)
-                    model.freeze_G_net(freeze=False)
-                elif i == 1 and alternating:  # train only the model approximating H
-                    model.freeze_H_net(freeze=False)
-                    model.freeze_G_net(freeze=True)
-
-                train_x_hat = odeint(
-                    model, x[:, 0, :4], t_eval, method="rk4", options=dict(step_size=Ts)
-                )
-                # train_x_hat is [time_steps, batch_size, (q1,p1,q2,p1)]
-
-                train_loss_mini = L2_loss(
-                    x[:, :horizon, :4].permute(1, 0, 2),
-                    train_x_hat[:, :, :4],
-                    w,
-                    param=loss_type,
-                    rescale_loss=rescale_loss,
-                    denom=denom,
-                )
-                # after permute x is [time_steps, batch_size, (q1,p1,q2,p1)]
-
-                if (not step % 10) and (i_batch == 0):
-                    t_plot = time.time()
-                    training_plot(t_eval, train_x_hat[:, :, :4], x[:, :horizon, :4])
-                    print("plot time :", time.time() - t_plot)
-
-                train_loss = train_loss + train_loss_mini.item()
-
-                train_loss_mini.backward()
-                if collect_grads:
-                    layer_names, all_grads_preclip = collect_gradients(
-                        model.named_parameters()
-                    )
-
-                if grad_clip:  # gradient clipping to a norm of 1
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-                if collect_grads:
-                    layer_names, all_grads_postclip = collect_gradients(
-                        model.named_parameters()
-                    )
-                    logs["layer_names"].append(layer_names)
-                    logs["grads_preclip"].append(all_grads_preclip)
-                    logs["grads_postclip"].append(all_grads_postclip)
-
-                optim.step()
-                optim.zero_grad()
-
-                if step > begin_decay and lr_schedule:
-                    scheduler.step()
-
-
-        t2 = time.time()
-        train_time = t2 - t1
-
-        model.eval()
-        if test_loader:
-            if not (step % 10):  # run validation every 10 steps
-                for x, t_eval in iter(test_loader):
-
-                    with torch.no_grad():  # we won't need gradients for testing
-                        # run test data
-                        t_eval = t_eval[0, :horizon]
-                        if rescale_loss:
-                            if horizon_updated:
-                                _, _, denom_test = get_maxmindenom(
-                                    x=x[:, :horizon, :4].permute(1, 0, 2),
-                                    dim1=(0),
-                                    dim2=(0),
-                                    rescale_dims=rescale_dims,
-                                )
-
-                        test_x_hat = odeint(
-                            model,
-                            x[:, 0, :4],
-                            t_eval,
-                            method="rk4",
-                            options=dict(step_size=Ts),
-                        )
-
-
-                        test_loss_mini = L2_loss(
-                            x[:, :horizon, :4].permute(1, 0, 2),
-                            test_x_hat[:horizon, :, :4],
-                            w,
-                            param=loss_type,
-                            rescale_loss=rescale_loss,
-                            denom=denom_test,
-                        )
-                        test_loss = test_loss + test_loss_mini.item()
-                test_time = time.time() - t2
-                print(
-                    "epoch {:4d} | train time {:.2f} | train loss {:8e} | test loss {:8e} | test time {:.2f}  ".format(
-                        step, train_time, train_loss, test_loss, test_time
-                    )
-                )
-                logs["test_loss"].append(test_loss)
-
-            else:
-                print(
-                    "epoch {:4d} | train time {:.2f} | train loss {:8e} ".format(
-                        step, train_time, train_loss
-                    )
-                )
-        else:
-            print(
-                "epoch {:4d} | train time {:.2f} | train loss {:8e} ".format(
-                    step, train_time, train_loss
+                _, _, denom_test = normalization_stats(
+                    test_loader.dataset, horizon, rescale_dims
                 )
+            return validator(
+                model,
+                horizon,
+                w=w if loss_type == "L2weighted" else None,
+                denom=denom_test,
+                time_weights=time_weights(
+                    min(horizon, validator.x.shape[1]), validator.x.device
+                ),
+                u_func=full_u_func,
             )
-
-        # logging
-        logs["train_loss"].append(train_loss)
+    else:
+        validate = None
+
+    callbacks = [ProgressPrinter()]
+    if state_dim == 4:
+        # training_plot() draws the four furuta coordinates
+        callbacks.append(TrainingPlot(every=10))
+    if collect_grads:
+        callbacks.append(GradientLogger())
+
+    engine = TrainingEngine(
+        model,
+        system,
+        train_loader,
+        Ts,
+        loss_fn,
+        optimizer=optim,
+        curriculum=curriculum,
+        validate=validate,
+        validate_every=validate_every,
+        growth_scheduler=growth_scheduler,
+        grad_clip=1.0 if grad_clip else None,  # gradient clipping to a norm of 1
+        lr_scheduler=scheduler,
+        lr_schedule_start=begin_decay,
+        alternating=alternating,
+        callbacks=callbacks,
+        phase_timer=phase_timer,
+        profile_window=profile_window,
+    )
+    logs = engine.run(epochs)
+    for key in ("grads_preclip", "grads_postclip", "layer_names"):
+        logs.setdefault(key, [])
     return logs
@@ -1,9 +1,76 @@
+import bisect
+
 import torch
 
-def L2_loss(u, v, w=False, dim=(0, 1), param="L2", rescale_loss=False, denom=None):
+
+def trajectory_loss(
+    u, v, w=None, denom=None, time_weights=None, mask=None, u_layout="time_first"
+):
+    """
+    Description:
+        Weighted mean squared error between a nominal and a predicted trajectory,
+        the weighting, min max normalization, time step weights and mask are
+        applied in place on the squared error and reduced in one einsum, so the
+        only [time_steps, batch_size, dim] temporaries are the difference and its
+        square. The nominal trajectory can be given as it comes from the data
+        loader (batch first), it is then read through a transposed view instead
+        of a permuted copy.
+    Inputs:
+        - u (tensor) : nominal trajectory [time_steps, batch_size, dim], or
+                       [batch_size, time_steps, dim] if u_layout='batch_first'
+        - v (tensor) : predicted trajectory [time_steps, batch_size, dim] (odeint layout)
+        - w (None or tensor) : weight of each coordinate [dim]
+        - denom (None or tensor) : min max denominators, broadcastable to
+                                   [time_steps, batch_size, dim] (see normalization_stats())
+        - time_weights (None or tensor) : weight of each time step [time_steps],
+                                          for example discount ** torch.arange(time_steps)
+        - mask (None or tensor) : [time_steps, batch_size], 1 where the time step
+                                  is inside the horizon of the trajectory
+        - u_layout (string) : 'time_first' or 'batch_first'
+    Outputs:
+        - loss (tensor) : scalar, weighted mean over the time steps and trajectories
+                          summed over the coordinates
+    """
+    if u_layout == "batch_first":
+        u = u.transpose(0, 1)  # view, no copy
+    elif u_layout != "time_first":
+        raise ValueError("u_layout must be 'time_first' or 'batch_first'")
+
+    sq = (u - v).square()
+    # ((u-min)/denom)-((v-min)/denom) = (u-v)/denom
+    if w is not None:
+        sq.mul_(w.pow(2))
+    if denom is not None:
+        sq.div_(denom.pow(2))
+
+    if time_weights is None and mask is None:
+        # mean only over time steps and batch_size
+        return sq.sum() / (sq.shape[0] * sq.shape[1])
+
+    step_weights = torch.ones(sq.shape[:2], device=sq.device, dtype=sq.dtype)
+    if time_weights is not None:
+        step_weights = step_weights * time_weights.to(sq.dtype).unsqueeze(dim=1)
+    if mask is not None:
+        step_weights = step_weights * mask.to(sq.dtype)
+    return torch.einsum("tbc,tb->", sq, step_weights) / step_weights.sum()
+
+
+def L2_loss(
+    u,
+    v,
+    w=False,
+    dim=(0, 1),
+    param="L2",
+    rescale_loss=False,
+    denom=None,
+    mask=None,
+    time_weights=None,
+    u_layout="time_first",
+):
     """
     Calculate the L2 loss of between u and v
      u and v expected with shape : [time_steps, batch_size , (q1,p1,q2,p1)]
+     (u can also be [batch_size, time_steps, (q1,p1,q2,p1)] with u_layout='batch_first')
 
     Input:
         - u (tensor) :  nominal trajectory
@@ -18,24 +85,74 @@ def L2_loss(u, v, w=False, dim=(0, 1), param="L2", rescale_loss=False, denom=Non
                                  pre calculated denominator for min max scaling
                                  why? because it is calculated only when the horizon 
                                  is changed
+        - mask (None or tensor) : [time_steps, batch_size] tensor, 1 where the time step
+                                 is inside the horizon of the trajectory, 0 otherwise.
+                                 The mean is then only taken over the masked in terms
+        - time_weights (None or tensor) : weight of each time step [time_steps]
+        - u_layout (string) : layout of u, see trajectory_loss()
     Output:
         loss (tensor) : scalar loss
 
     """
+    if tuple(dim) != (0, 1):
+        diff = u - v
+        if rescale_loss:
+            diff = diff / denom
+        if param == "L2weighted":
+            diff = diff.mul(w)
+        return diff.pow(2).mean(dim=dim).sum()
 
-    diff = u - v
-    if rescale_loss:
-        # min max scaling of u and v using nominal statistics
-        # ((u-min)/denom)-((v-min)/denom) = (u-v)/denom
-        diff = (diff) / denom
+    return trajectory_loss(
+        u,
+        v,
+        w=w if param == "L2weighted" else None,
+        denom=denom if rescale_loss else None,
+        time_weights=time_weights,
+        mask=mask,
+        u_layout=u_layout,
+    )
 
-    if param == "L2weighted":
-        # mean only over time steps and batch_size
-        loss = (((diff).mul(w)).pow(2)).mean(dim=dim).sum()
-    elif param == "L2":
-        loss = (((diff)).pow(2)).mean(dim=dim).sum()
 
-    return loss
+class StreamingLoss:
+    """
+    Description:
+        trajectory_loss() accumulated one time step at a time, so that the loss
+        can be computed during the integration without storing the rollout
+        (see evaluate_long_horizon()). Gives the same value as trajectory_loss()
+        on the full trajectories.
+    Inputs:
+        - w, denom : see trajectory_loss()
+    Methods:
+        - update(u_t, v_t, step_weight) : adds the error of one time step,
+                                          u_t and v_t are [batch_size, dim],
+                                          step_weight is None, a float or [batch_size]
+        - result() : the loss (scalar tensor)
+    """
+
+    def __init__(self, w=None, denom=None):
+        self.w = w
+        self.denom = denom
+        self.total = 0.0
+        self.normalizer = 0.0
+
+    def update(self, u_t, v_t, step_weight=None):
+        sq = (u_t - v_t).square()
+        if self.w is not None:
+            sq.mul_(self.w.pow(2))
+        if self.denom is not None:
+            # denom [1, 1|batch_size, dim] of one time step
+            sq.div_(self.denom.reshape(-1, sq.shape[-1]).pow(2))
+        if step_weight is None:
+            self.total = self.total + sq.sum()
+            self.normalizer = self.normalizer + sq.shape[0]
+        else:
+            step_weight = torch.as_tensor(step_weight, device=sq.device, dtype=sq.dtype)
+            step_weight = step_weight.expand(sq.shape[0])
+            self.total = self.total + torch.einsum("bc,b->", sq, step_weight)
+            self.normalizer = self.normalizer + step_weight.sum()
+
+    def result(self):
+        return self.total / self.normalizer
 
 
 def select_horizon_list(
@@ -83,118 +200,336 @@ def select_horizon_list(
         horizon = horizon_list[-1]
     return horizon_updated, horizon
 
-def multilevel_strategy_update(device, step, model, resnet_config, switch_steps):
-    """ 
+
+class AdaptiveHorizon:
+    """
     Description:
-        Implements how the multilevel models are expanded (number of parameters increased) 
-        during training, and how to initialise the new model parameters.
+        Curriculum on the training horizon driven by the loss instead of a fixed number
+        of epochs per horizon. The loss is smoothed with an exponential moving average,
+        and the controller moves to the next horizon of horizon_list once the smoothed
+        loss has stopped improving (plateau), with a minimum and maximum number of epochs
+        per horizon. The epochs at which the horizon changed are logged so that
+        train_test_loss_plot() can show them.
     Inputs:
-        device (str) : device on which the model is trained
-        step (int) : current epoch
-        model (nn.Module) : model that is being trained
-        resnet_config (int) : resnet config, one of the folowing numbers:
-                                    - 1 : Expanding HNN (and its variants)
-                                    - 2 : Interp HNN (and its variants)
-        switch_steps (list) :
-    Outputs:
-        model (nn.Module) : model that is being traing and that was just updated
+        - horizon_list (list) : horizons with which the model will be trained
+        - min_epochs (int or list) : minimum number of epochs per horizon
+        - max_epochs (int or list) : maximum number of epochs per horizon
+                                    (for example switch_steps)
+        - smoothing (float) : factor of the exponential moving average of the loss
+        - tol (float) : relative improvement of the smoothed loss under which an epoch
+                        counts as not improving
+        - patience (int) : number of non improving epochs after which the loss is
+                           considered to have converged
+        - monitor (string) : which loss is watched, 'train' or 'test'
+        - stop_when_converged (bool) : set finished=True once the last horizon converged
+    Methods:
+        - select(step) : same outputs as select_horizon_list(), called at the start
+                         of every epoch
+        - observe(step, train_loss, test_loss=None) : called at the end of every epoch,
+                         test_loss is None when no validation was run during the epoch
 
+    Example use :
+        controller = AdaptiveHorizon([50, 100, 150], min_epochs=20, max_epochs=[200, 200, 200])
+        for step in range(epochs):
+            horizon_updated, horizon = controller.select(step)
+            ... train one epoch ...
+            controller.observe(step, train_loss, test_loss)
+            if controller.finished:
+                break
     """
-    # resnet strategy 1 :
-    if resnet_config == 1 or resnet_config == 3:
-        if step < sum(switch_steps[:1]):
-            if step == 0:
-                print("Model size increased")
-            model.H_net.resblock_list = [0]
-        elif step == sum(switch_steps[:1]) and len(model.H_net.resblocks) >= 2:
-            print("Model size increased")
-            model.H_net.resblock_list = [0, 1]
-        elif step == sum(switch_steps[:2]) and len(model.H_net.resblocks) >= 3:
-            print("Model size increased")
-            model.H_net.resblock_list = [0, 1, 2]
-        elif step == sum(switch_steps[:3]) and len(model.H_net.resblocks) >= 4:
-            print("Model size increased")
-            model.H_net.resblock_list = [0, 1, 2, 3]
-        elif step == sum(switch_steps[:4]) and len(model.H_net.resblocks) >= 5:
-            print("Model size increased")
-            model.H_net.resblock_list = [0, 1, 2, 3, 4]
-        elif step == sum(switch_steps[:5]) and len(model.H_net.resblocks) >= 6:
-            print("Model size increased")
-            model.H_net.resblock_list = [0, 1, 2, 3, 4, 5]
-
-    # resnet strategy 2 :
-    if resnet_config == 2:
-        if step < sum(switch_steps[:1]):
-            if step == 0:
-                print("Model size increased")
-            model.H_net.resblock_list = [0, 16]
-            model.H_net.alpha = torch.tensor(
-                [1 / len(model.H_net.resblock_list)], device=device
-            )
-        elif step == sum(switch_steps[:1]) and len(model.H_net.resblocks) >= 4:
-            print("Model size increased")
-            model.H_net.init_new_resblocks(0, 8, 16)
-            model.H_net.resblock_list = [0, 8, 16]
-            model.H_net.alpha = torch.tensor(
-                [1 / len(model.H_net.resblock_list)], device=device
-            )
-        elif step == sum(switch_steps[:2]) and len(model.H_net.resblocks) >= 6:
-            print("Model size increased")
-            model.H_net.init_new_resblocks(0, 4, 8)
-            model.H_net.init_new_resblocks(8, 12, 16)
-            model.H_net.resblock_list = [0, 4, 8, 12, 16]
-            model.H_net.alpha = torch.tensor(
-                [1 / len(model.H_net.resblock_list)], device=device
-            )
-        elif step == sum(switch_steps[:3]) and len(model.H_net.resblocks) >= 8:
-            print("Model size increased")
-            model.H_net.init_new_resblocks(0, 2, 4)
-            model.H_net.init_new_resblocks(4, 6, 8)
-            model.H_net.init_new_resblocks(8, 10, 12)
-            model.H_net.init_new_resblocks(12, 14, 16)
-            model.H_net.resblock_list = [0, 2, 4, 6, 8, 10, 12, 14, 16]
-            model.H_net.alpha = torch.tensor(
-                [1 / len(model.H_net.resblock_list)], device=device
-            )
-        elif step == sum(switch_steps[:4]) and len(model.H_net.resblocks) >= 10:
-            print("Model size increased")
-            model.H_net.init_new_resblocks(0, 1, 2)
-            model.H_net.init_new_resblocks(2, 3, 4)
-            model.H_net.init_new_resblocks(4, 5, 6)
-            model.H_net.init_new_resblocks(8, 9, 10)
-            model.H_net.init_new_resblocks(10, 11, 12)
-            model.H_net.init_new_resblocks(11, 12, 13)
-            model.H_net.init_new_resblocks(12, 13, 14)
-            model.H_net.init_new_resblocks(14, 15, 16)
-            model.H_net.resblock_list = [
-                0,
-                1,
-                2,
-                3,
-                4,
-                5,
-                6,
-                7,
-                8,
-                9,
-                10,
-                11,
-                12,
-                13,
-                14,
-                15,
-                16,
-            ]
-            model.H_net.alpha = torch.tensor(
-                [1 / len(model.H_net.resblock_list)], device=device
+
+    def __init__(
+        self,
+        horizon_list=[50, 100, 150, 200, 250, 300],
+        min_epochs=20,
+        max_epochs=200,
+        smoothing=0.9,
+        tol=1e-3,
+        patience=10,
+        monitor="train",
+        stop_when_converged=True,
+    ):
+        num_stages = len(horizon_list)
+        if isinstance(min_epochs, int):
+            min_epochs = [min_epochs] * num_stages
+        if isinstance(max_epochs, int):
+            max_epochs = [max_epochs] * num_stages
+        assert (
+            len(min_epochs) == num_stages and len(max_epochs) == num_stages
+        ), " horizon_list, min_epochs and max_epochs must have same length"
+
+        self.horizon_list = horizon_list
+        self.min_epochs = min_epochs
+        self.max_epochs = max_epochs
+        self.smoothing = smoothing
+        self.tol = tol
+        self.patience = patience
+        self.monitor = monitor
+        self.stop_when_converged = stop_when_converged
+
+        self.stage = 0
+        self.finished = False
+        self.switch_epochs = []  # epochs at which a new horizon was started
+        self.horizons = [horizon_list[0]]  # horizon started at each switch
+        self._updated = True
+        self._reset_stage(0)
+
+    @property
+    def horizon(self):
+        return self.horizon_list[self.stage]
+
+    def _reset_stage(self, step):
+        self.stage_start = step
+        self.smoothed_loss = None
+        self.best_loss = float("inf")
+        self.bad_epochs = 0
+
+    def select(self, step):
+        """
+        Returns (horizon_updated, horizon) for epoch step
+        """
+        horizon_updated = int(self._updated)
+        if self._updated:
+            print("horizon length :", self.horizon)
+            self._updated = False
+        return horizon_updated, self.horizon
+
+    def observe(self, step, train_loss, test_loss=None):
+        """
+        Updates the smoothed loss with the loss of epoch step and moves to the
+        next horizon if the loss converged. Returns True if the horizon changed.
+        """
+        loss = train_loss if self.monitor == "train" else test_loss
+        if loss is not None:
+            if self.smoothed_loss is None:
+                self.smoothed_loss = loss
+            else:
+                self.smoothed_loss = (
+                    self.smoothing * self.smoothed_loss + (1 - self.smoothing) * loss
+                )
+            if self.smoothed_loss < self.best_loss * (1 - self.tol):
+                self.best_loss = self.smoothed_loss
+                self.bad_epochs = 0
+            else:
+                self.bad_epochs += 1
+
+        epochs_in_stage = step + 1 - self.stage_start
+        converged = (
+            epochs_in_stage >= self.min_epochs[self.stage]
+            and self.bad_epochs >= self.patience
+        )
+        if not (converged or epochs_in_stage >= self.max_epochs[self.stage]):
+            return False
+
+        if self.stage == len(self.horizon_list) - 1:
+            self.finished = self.stop_when_converged and converged
+            return False
+
+        self.stage += 1
+        self.switch_epochs.append(step + 1)
+        self.horizons.append(self.horizon)
+        self._updated = True
+        self._reset_stage(step + 1)
+        return True
+
+
+class MultilevelScheduler:
+    """
+    Description:
+        Implements how the multilevel models are expanded (number of parameters increased)
+        during training, and how to initialise the new model parameters. The scheduler
+        is built from a growth plan, a list containing one dict per stage :
+            {
+                "blocks" : [0, 8, 16],     # resblocks active during this stage
+                "epochs" : 200,            # number of epochs of this stage
+                "init" : "interpolate",    # how the new resblocks are initialised
+                "alpha" : "inverse",       # how H_net.alpha is set
+            }
+        The epoch at which each stage starts is computed once, so update() does a
+        single dict lookup per epoch, whatever the depth or number of stages.
+    Inputs:
+        - plan (list) : growth plan, see above. "init" can be one of :
+                            - None : keep the current parameters of the new resblocks
+                            - 'small' : divide the parameters of the new resblocks by 1000
+                            - 'interpolate' : average of the closest active resblocks before
+                                              and after the new one
+                            - 'copy' : copy of the closest active resblock before
+                                       (or after) the new one
+                        "alpha" can be None (alpha untouched), 'inverse' (1/number of
+                        active resblocks) or a float
+        - device (str) : device on which the model is trained
+    Methods:
+        - stage_at(step) : index of the stage of epoch step
+        - update(step, model) : called every epoch, applies the stage starting at step
+        - apply_stage(model, stage) : activate the resblocks of a stage in model.H_net
+
+    Example use :
+        scheduler = MultilevelScheduler.from_resnet_config(2, switch_steps, num_blocks=17)
+        for step in range(epochs):
+            model = scheduler.update(step, model)
+    """
+
+    def __init__(self, plan, device=None):
+        self.plan = plan
+        self.device = device
+        self.stage = None  # stage currently applied to the model
+
+        # epoch at which each stage starts, and the reverse lookup
+        self.stage_starts = []
+        start = 0
+        for stage in plan:
+            self.stage_starts.append(start)
+            start = start + stage["epochs"]
+        self.transitions = {epoch: i for i, epoch in enumerate(self.stage_starts)}
+
+    @classmethod
+    def from_resnet_config(cls, resnet_config, switch_steps, num_blocks, device=None):
+        """
+        Description:
+            Builds the growth plan of the resnet configs used in train()
+        Inputs:
+            - resnet_config (int) : resnet config, one of the folowing numbers:
+                                        - 1 or 3 : Expanding HNN (and its variants), one
+                                                   resblock is added every stage
+                                        - 2 : Interp HNN (and its variants), the number of
+                                              intervals between resblocks doubles every
+                                              stage, see generate_multi_level_list_conf2()
+            - switch_steps (list) : number of epochs per stage
+            - num_blocks (int) : number of resblocks of the H_net
+            - device (str) : device on which the model is trained
+        Outputs:
+            - scheduler (MultilevelScheduler)
+        """
+        if resnet_config == 1 or resnet_config == 3:
+            levels = [list(range(k + 1)) for k in range(num_blocks)]
+            init = None  # the resblocks were already made small at initialisation
+            alpha = None
+        elif resnet_config == 2:
+            num_lists = 0
+            n = num_blocks
+            while n > 2:
+                n = (n + 1) // 2
+                num_lists += 1
+            levels = generate_multi_level_list_conf2(num_blocks, num_lists)[::-1]
+            init = "interpolate"
+            alpha = "inverse"
+        else:
+            raise ValueError("resnet_config not recognized")
+
+        plan = [
+            {
+                "blocks": levels[min(k, len(levels) - 1)],
+                "epochs": epochs,
+                "init": init,
+                "alpha": alpha,
+            }
+            for k, epochs in enumerate(switch_steps)
+        ]
+        return cls(plan, device=device)
+
+    def stage_at(self, step):
+        """
+        Returns the index of the stage that epoch step belongs to
+        """
+        return max(bisect.bisect_right(self.stage_starts, step) - 1, 0)
+
+    def update(self, step, model):
+        """
+        Description:
+            Called at the start of every epoch, grows the model if a stage starts
+            at this epoch (or if no stage was applied yet)
+        Inputs:
+            - step (int) : current epoch
+            - model (nn.Module) : model that is being trained
+        Outputs:
+            - model (nn.Module) : model that is being trained and that was just updated
+        """
+        stage = self.transitions.get(step)
+        if stage is None and self.stage is None:
+            stage = self.stage_at(step)
+        if stage is not None:
+            model = self.apply_stage(model, stage)
+        return model
+
+    def apply_stage(self, model, stage):
+        """
+        Description:
+            Activates the resblocks of stage in model.H_net, initialises the newly
+            active resblocks and sets alpha according to the growth plan
+        Inputs:
+            - model (nn.Module) : model that is being trained
+            - stage (int) : index of the stage in the growth plan
+        Outputs:
+            - model (nn.Module) : model that is being trained and that was just updated
+        """
+        if stage == self.stage:
+            return model
+
+        H_net = model.H_net
+        blocks = list(self.plan[stage]["blocks"])
+        if max(blocks) >= len(H_net.resblocks):
+            raise ValueError(
+                "growth plan uses resblock {:d} but H_net only has {:d} resblocks".format(
+                    max(blocks), len(H_net.resblocks)
+                )
             )
-    return model
+
+        if self.stage is not None:  # the first stage only selects the resblocks
+            previous = list(H_net.resblock_list)
+            new = [i for i in blocks if i not in previous]
+            self._init_new_resblocks(H_net, previous, new, self.plan[stage]["init"])
+
+        H_net.resblock_list = blocks
+
+        alpha = self.plan[stage]["alpha"]
+        if alpha == "inverse":
+            H_net.alpha = torch.tensor([1 / len(blocks)], device=self.device)
+        elif alpha is not None:
+            H_net.alpha = torch.tensor([float(alpha)], device=self.device)
+
+        print("Model size increased")
+        self.stage = stage
+        return model
+
+    def _init_new_resblocks(self, H_net, previous, new, init):
+        """
+        Initialise the resblocks in new from the resblocks in previous
+        (see the class docstring for the possible values of init)
+        """
+        if init is None or not new:
+            return
+        if init not in ("small", "interpolate", "copy"):
+            raise ValueError("init rule not recognized")
+
+        with torch.no_grad():
+            for j in new:
+                if init == "small":
+                    for param in H_net.resblocks[j].parameters():
+                        param.copy_(param / 1000)
+                    continue
+
+                before = [i for i in previous if i < j]
+                after = [i for i in previous if i > j]
+                sources = []
+                if before:
+                    sources.append(H_net.resblocks[before[-1]])
+                if after and (init == "interpolate" or not before):
+                    sources.append(H_net.resblocks[after[0]])
+                if not sources:
+                    continue
+
+                for params in zip(
+                    H_net.resblocks[j].parameters(),
+                    *(block.parameters() for block in sources)
+                ):
+                    params[0].copy_(sum(params[1:]) / len(sources))
 
 
 def generate_multi_level_list_conf2(length=17, num_lists=4):
     """
     This function generates lists of decreasing size containing which resnets should be active
-    for the multilevel strategy. Used to programatically get the lists for multilevel_strategy_update()
+    for the multilevel strategy. Used to programatically get the lists for
+    MultilevelScheduler.from_resnet_config()
 
     Example output :
         [[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16],
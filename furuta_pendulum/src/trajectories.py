@@ -3,6 +3,7 @@ import torch
 from torchdiffeq import odeint
 
 from .dynamics import *
+from .dynamics_numpy import *
 
 """Functions to generate the trajectories"""
 
@@ -24,6 +25,11 @@ def get_trajectory_furuta(
     Lr=0.085,
     Mp=0.024,
     Lp=0.129,
+    nfe_counter=None,
+    method="rk4",
+    rtol=1e-7,
+    atol=1e-9,
+    solver_stats=None,
 ):
     """
     Given the parameters, initial position, and inputs generate  trajectories
@@ -44,6 +50,14 @@ def get_trajectory_furuta(
          - C_q1 (Float) : friction coefficient
          - C_q2 (Float) : friction coefficient
          - g, Jr, Lr, Mp, Lp (Float) : furuta pendulum parameters
+         - nfe_counter (NFECounter or None) : counts the evaluations of the dynamics
+         - method (string) : 'rk4' : fixed step rk4 with step Ts
+                             'dopri5' : adaptive step Dormand-Prince with error control,
+                                        the internal steps do not depend on Ts
+                                        (see dopri5_solve())
+         - rtol, atol (Float) : tolerances of the 'dopri5' method
+         - solver_stats (dict or None) : filled with the accepted and rejected steps
+                                         and the number of evaluations of 'dopri5'
     Outputs:
         - q1, .., p2 (tensor) :  tensor containing generalized coordinates at different time steps
         - t_eval (tensor) : time steps at which the coordinates were generated
@@ -61,17 +75,22 @@ def get_trajectory_furuta(
         y0 = get_init_state(num_trajectories, init_method)
         y0 = y0.to(device)
 
-    # solve the differential equation using odeint
-    q_p = odeint(
-        func=lambda t, coords: dynamics_fn_furuta(
-            t, coords, C_q1, C_q2, g, Jr, Lr, Mp, Lp, u_func, g_func
-        ),
-        y0=y0,
-        t=t_eval,
-        method="rk4",
-        options=dict(step_size=Ts),
+    func = lambda t, coords: dynamics_fn_furuta(
+        t, coords, C_q1, C_q2, g, Jr, Lr, Mp, Lp, u_func, g_func, nfe_counter
     )
 
+    # solve the differential equation
+    if method == "rk4":
+        q_p = odeint(
+            func=func, y0=y0, t=t_eval, method="rk4", options=dict(step_size=Ts)
+        )
+    elif method == "dopri5":
+        q_p = dopri5_solve(
+            func, y0, t_eval, rtol=rtol, atol=atol, solver_stats=solver_stats
+        )
+    else:
+        raise ValueError("method must be 'rk4' or 'dopri5'")
+
     q1, p1, q2, p2 = torch.chunk(q_p, 4, dim=-1)
 
     # add noise
@@ -146,6 +165,202 @@ def get_init_state(n, init_method):
     return y0
 
 
+def rk4_step(func, t, x, dt):
+    """
+    Description:
+        One step of the fixed step Runge-Kutta 4 (3/8 rule) integrator, the same
+        scheme as odeint(method="rk4")
+    Inputs:
+        - func (callable) : vector field func(t, x), for example a model
+        - t (float or tensor) : time at the start of the step
+        - x (tensor) : state at the start of the step [batch_size, (q1,p1,q2,p2)]
+        - dt (float) : step size
+    Outputs:
+        - x (tensor) : state at t + dt
+    """
+    k1 = func(t, x)
+    k2 = func(t + dt / 3, x + dt * k1 / 3)
+    k3 = func(t + dt * 2 / 3, x + dt * (k2 - k1 / 3))
+    k4 = func(t + dt, x + dt * (k1 - k2 + k3))
+    return x + dt * (k1 + 3 * (k2 + k3) + k4) / 8
+
+
+def rk4_rollout(func, x0, t0, Ts, steps):
+    """
+    Description:
+        Rollout of func from x0 with a fixed step rk4_step(), equivalent to
+        odeint(func, x0, t_eval, method="rk4", options=dict(step_size=Ts)) with
+        t_eval = t0 + Ts * [0, ..., steps] but without the odeint overhead
+    Inputs:
+        - func (callable) : vector field func(t, x)
+        - x0 (tensor) : initial state [batch_size, (q1,p1,q2,p2)]
+        - t0 (float) : initial time
+        - Ts (float) : sampling time
+        - steps (int) : number of steps
+    Outputs:
+        - x (tensor) : trajectory [steps + 1, batch_size, (q1,p1,q2,p2)]
+    """
+    x = x0
+    trajectory = [x0]
+    for k in range(steps):
+        t = torch.tensor(t0 + k * Ts, device=x0.device, dtype=x0.dtype)
+        x = rk4_step(func, t, x, Ts)
+        trajectory.append(x)
+    return torch.stack(trajectory, dim=0)
+
+
+# Dormand-Prince 5(4) tableau, the stages and the 5th order solution are the
+# ones of odeint(method="dopri5")
+DOPRI5_C = [0.0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1.0, 1.0]
+DOPRI5_A = [
+    [],
+    [1 / 5],
+    [3 / 40, 9 / 40],
+    [44 / 45, -56 / 15, 32 / 9],
+    [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+    [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+    [35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84],
+]
+# difference between the 5th and 4th order solutions, gives the error estimate.
+# The 4th order weights are the ones of torchdiffeq (Shampine), not the classic
+# ones, but the error norm and the step size controller of dopri5_solve() differ
+# from odeint, so the accepted steps and the nfe can differ
+DOPRI5_E = [
+    35 / 384 - 1951 / 21600,
+    0.0,
+    500 / 1113 - 22642 / 50085,
+    125 / 192 - 451 / 720,
+    -2187 / 6784 + 12231 / 42400,
+    11 / 84 - 649 / 6300,
+    -1 / 60,
+]
+
+
+def _error_norm(x):
+    """
+    RMS norm over the coordinates, worst trajectory of the batch
+    """
+    if x.dim() > 1:
+        return x.pow(2).mean(dim=-1).sqrt().max()
+    return x.pow(2).mean().sqrt()
+
+
+def dopri5_step(func, t, x, dt, k1):
+    """
+    Description:
+        One step of the Dormand-Prince 5(4) integrator
+    Inputs:
+        - func (callable) : vector field func(t, x)
+        - t (float) : time at the start of the step
+        - x (tensor) : state at the start of the step
+        - dt (float) : step size
+        - k1 (tensor) : func(t, x), reused from the last stage of the previous step
+    Outputs:
+        - x_new (tensor) : 5th order solution at t + dt
+        - error (tensor) : estimate of the local error of x_new
+        - k7 (tensor) : func(t + dt, x_new), first stage of the next step
+    """
+    k = [k1]
+    for i in range(1, 7):
+        x_i = x + dt * sum(a * k_j for a, k_j in zip(DOPRI5_A[i], k) if a != 0.0)
+        t_i = torch.tensor(t + DOPRI5_C[i] * dt, device=x.device, dtype=x.dtype)
+        k.append(func(t_i, x_i))
+    # the 7th stage is evaluated at the 5th order solution
+    x_new = x_i
+    error = dt * sum(e * k_j for e, k_j in zip(DOPRI5_E, k) if e != 0.0)
+    return x_new, error, k[6]
+
+
+def dopri5_solve(
+    func,
+    x0,
+    t_eval,
+    rtol=1e-7,
+    atol=1e-9,
+    first_step=None,
+    safety=0.9,
+    max_steps=1000000,
+    solver_stats=None,
+):
+    """
+    Description:
+        Adaptive step Dormand-Prince 5(4) integration of func from x0 at t_eval[0].
+        The step size is controlled so that the local error of every trajectory of
+        the batch stays below atol + rtol*|x|, and steps are shortened to land
+        exactly on the points of t_eval, so the output is on the requested grid
+        whatever the internal steps are.
+    Inputs:
+        - func (callable) : vector field func(t, x)
+        - x0 (tensor) : initial state [batch_size, dim] or [dim]
+        - t_eval (tensor) : increasing output times, t_eval[0] is the time of x0
+        - rtol, atol (float) : relative and absolute tolerances
+        - first_step (float or None) : initial step size, estimated if None
+        - safety (float) : safety factor of the step size controller
+        - max_steps (int) : maximum number of attempted steps
+        - solver_stats (dict or None) : if given, filled with the number of
+                                        accepted and rejected steps and of
+                                        function evaluations (nfe)
+    Outputs:
+        - x (tensor) : solution at t_eval [len(t_eval), *x0.shape]
+    """
+    times = t_eval.tolist()
+    t = times[0]
+    x = x0
+    k1 = func(t_eval[0], x)
+    nfe = 1
+    accepted = 0
+    rejected = 0
+
+    if first_step is None:
+        # Hairer's initial step size heuristic
+        scale = atol + rtol * x.abs()
+        d0 = _error_norm(x / scale).item()
+        d1 = _error_norm(k1 / scale).item()
+        h = 0.01 * d0 / d1 if d0 > 1e-5 and d1 > 1e-5 else 1e-6
+    else:
+        h = first_step
+    if len(times) > 1:
+        h = min(h, times[-1] - times[0])
+
+    solution = [x0]
+    for t_next in times[1:]:
+        while t < t_next:
+            if accepted + rejected >= max_steps:
+                raise RuntimeError("dopri5_solve : max_steps reached at t = " + str(t))
+
+            # shorten the step to land on the next output time
+            landing = t_next - t <= h
+            dt = t_next - t if landing else h
+
+            x_new, error, k7 = dopri5_step(func, t, x, dt, k1)
+            nfe += 6
+
+            scale = atol + rtol * torch.maximum(x.abs(), x_new.abs())
+            error_norm = _error_norm(error / scale).item()
+
+            if error_norm <= 1.0:
+                accepted += 1
+                t = t_next if landing else t + dt
+                x = x_new
+                k1 = k7
+                factor = 10.0 if error_norm == 0 else safety * error_norm ** (-1 / 5)
+                factor = min(10.0, max(0.2, factor))
+                # a step shortened to land on t_next says nothing about the
+                # step size the error allows, do not let it shrink h
+                h = max(h, dt * factor) if landing else dt * factor
+            else:
+                rejected += 1
+                h = dt * max(0.2, safety * error_norm ** (-1 / 5))
+
+        solution.append(x)
+
+    if solver_stats is not None:
+        solver_stats["accepted"] = solver_stats.get("accepted", 0) + accepted
+        solver_stats["rejected"] = solver_stats.get("rejected", 0) + rejected
+        solver_stats["nfe"] = solver_stats.get("nfe", 0) + nfe
+    return torch.stack(solution, dim=0)
+
+
 """ ENERGY functions """
 
 
@@ -154,7 +369,8 @@ def coord_derivatives_furuta_energy(
 ):
     """
     Description:
-        Returns the derivatives of the generalized coordinates
+        Returns the derivatives of the generalized coordinates, with the closed
+        form gradient furuta_dH() (no autograd)
 
     Inputs :
       - coords (tensor) : vector containing generalized coordinates q1,p1,q2,p2
@@ -166,30 +382,21 @@ def coord_derivatives_furuta_energy(
     Outputs :
       - dq1dt, dp1dt, dq2dt, dp2dt (tensors) : Derivatives w.r.t coords
     """
-    if (
-        coords.requires_grad is not True
-    ):  # coords shape: [timesteps, batchnum, (q1,p1,q2,p2)]
-        coords.requires_grad = True
-
-    # Hamiltonian function
-    H = hamiltonian_fn_furuta(coords, g, Jr, Lr, Mp, Lp)
-
-    # gradient of the hamiltornian function wrt the generalized coordinates
-    dcoords = torch.autograd.grad(H.sum(), coords, create_graph=True)
-
-    dHdq1, dHdp1, dHdq2, dHdp2 = torch.chunk(dcoords[0], 4, dim=-1)
+    # coords shape: [batchnum, timesteps, (q1,p1,q2,p2)]
+    dHdq1, dHdp1, dHdq2, dHdp2 = furuta_dH(coords, g, Jr, Lr, Mp, Lp)
 
     U = u_func.forward(t)
     G = g_func.forward(coords)
     if not G.shape[0] == 1:
         G = G[0, :].unsqueeze(dim=0)
 
-    U_G = (U.unsqueeze(dim=-1) * G).unsqueeze(dim=-1)
+    # [time_steps, 4] or [batch_size, time_steps, 4] with one input per trajectory
+    U_G = U.unsqueeze(dim=-1) * G
 
-    dq1dt = dHdp1 + (U_G[:, 0])
-    dp1dt = -dHdq1 - C_q1 * dHdp1 + (U_G[:, 1])
-    dq2dt = dHdp2 + (U_G[:, 2])
-    dp2dt = -dHdq2 - C_q2 * dHdp2 + (U_G[:, 3])
+    dq1dt = dHdp1 + U_G[..., 0:1]
+    dp1dt = -dHdq1 - C_q1 * dHdp1 + U_G[..., 1:2]
+    dq2dt = dHdp2 + U_G[..., 2:3]
+    dp2dt = -dHdq2 - C_q2 * dHdp2 + U_G[..., 3:4]
 
     dq1dt, dp1dt, dq2dt, dp2dt = (
         dq1dt.squeeze(dim=-1),
@@ -304,6 +511,96 @@ def get_energy_furuta_newtonian(
     return energy, derivatives
 
 
+""" NUMPY BACKEND """
+
+
+def get_trajectory_furuta_numpy(
+    device,
+    init_method,
+    num_trajectories,
+    u_func=None,
+    g_func=None,
+    time_steps=20,
+    y0=None,
+    noise_std=0.0,
+    Ts=0.005,
+    C_q1=0.0,
+    C_q2=0.0,
+    g=9.81,
+    Jr=5.72 * 1e-5,
+    Lr=0.085,
+    Mp=0.024,
+    Lp=0.129,
+):
+    """
+    Description:
+        Same as get_trajectory_furuta() (same inputs, outputs and initial states)
+        but simulated in float64 NumPy with furuta_dynamics_numpy() and rk4_numpy()
+    Outputs:
+        - q1, .., p2 (tensor) : generalized coordinates [num_trajectories, time_steps]
+        - t_eval (tensor) : time steps at which the coordinates were generated
+    """
+    t_eval = torch.linspace(1, time_steps, time_steps, device=device) * Ts
+    if y0 is None:
+        y0 = get_init_state(num_trajectories, init_method)
+    x0 = y0.detach().cpu().double().numpy().reshape(-1, 4)
+
+    # input at every rk4 stage, the first time step is t_eval[0] = Ts
+    steps = time_steps - 1
+    stage_times = Ts + Ts * (
+        np.arange(steps)[:, None] + np.array([0.0, 1 / 3, 2 / 3, 1.0])[None, :]
+    )
+    U_G = tabulate_input(u_func, g_func, stage_times.reshape(-1))
+    U_G = U_G.reshape((steps, 4) + U_G.shape[1:])
+
+    constants = furuta_constants(g, Jr, Lr, Mp, Lp)
+    x = rk4_numpy(
+        lambda x, u_g: furuta_dynamics_numpy(x, u_g, C_q1, C_q2, constants),
+        x0,
+        Ts,
+        steps,
+        U_G,
+    )
+    # x is [time_steps, num_trajectories, (q1,p1,q2,p2)]
+
+    x = torch.tensor(x.transpose(1, 0, 2), dtype=torch.float32, device=device)
+    q1, p1, q2, p2 = x[..., 0], x[..., 1], x[..., 2], x[..., 3]
+
+    # add noise, as in get_trajectory_furuta()
+    if noise_std:
+        q1 = q1 + torch.randn(q1.shape, device=device) * noise_std
+        p1 = p1 + torch.randn(p1.shape, device=device) * noise_std * torch.max(p1)
+        q2 = q2 + torch.randn(q2.shape, device=device) * noise_std
+        p2 = p2 + torch.randn(p2.shape, device=device) * noise_std * torch.max(p2)
+
+    return q1, p1, q2, p2, t_eval
+
+
+def get_energy_furuta_numpy(
+    device, t_eval, u_func, g_func, q1, p1, q2, p2, C_q1, C_q2, g, Jr, Lr, Mp, Lp
+):
+    """
+    Description:
+        Same as get_energy_furuta() but with the closed form derivatives
+    Outputs:
+        - energy (tensor) : energy [num_trajectories, time_steps]
+        - derivatives (tensor) : [num_trajectories, time_steps, (dq1/dt,dp1/dt,dq2/dt,dp2/dt)]
+    """
+    x = torch.stack((q1, p1, q2, p2), dim=-1).detach().cpu().double().numpy()
+    U_G = tabulate_input(u_func, g_func, t_eval.detach().cpu().double().numpy())
+    # [time_steps, num_trajectories or 1, 4] -> [num_trajectories or 1, time_steps, 4]
+    U_G = U_G.transpose(1, 0, 2)
+
+    constants = furuta_constants(g, Jr, Lr, Mp, Lp)
+    derivatives = furuta_dynamics_numpy(x, U_G, C_q1, C_q2, constants)
+    derivatives = torch.tensor(derivatives, dtype=torch.float32, device=device)
+
+    energy = energy_furuta(
+        derivatives[..., 0], derivatives[..., 2], q1, g, Jr, Lr, Mp, Lp
+    )
+    return energy, derivatives
+
+
 """ MULTIPLE TRAJECTORIES """
 
 
@@ -325,6 +622,11 @@ def multiple_trajectories_furuta(
     Mp=0.024,
     Lp=0.129,
     energ_deriv=True,
+    method="rk4",
+    rtol=1e-7,
+    atol=1e-9,
+    solver_stats=None,
+    backend="torch",
 ):
     """
     Description:
@@ -332,7 +634,41 @@ def multiple_trajectories_furuta(
         energies, and derivatives.
         See their respective docstrings
 
+        backend="numpy" uses get_trajectory_furuta_numpy() and get_energy_furuta_numpy()
+        instead (closed form derivatives, no autograd, only method="rk4"), the outputs
+        are the same tensors
     """
+    if backend == "numpy":
+        if method != "rk4":
+            raise ValueError("the numpy backend only supports method='rk4'")
+        q1, p1, q2, p2, t_eval = get_trajectory_furuta_numpy(
+            device,
+            init_method,
+            num_trajectories,
+            u_func,
+            g_func,
+            time_steps,
+            y0,
+            noise_std,
+            Ts,
+            C_q1,
+            C_q2,
+            g,
+            Jr,
+            Lr,
+            Mp,
+            Lp,
+        )
+        energy = []
+        derivatives = []
+        if energ_deriv:
+            energy, derivatives = get_energy_furuta_numpy(
+                device, t_eval, u_func, g_func, q1, p1, q2, p2, C_q1, C_q2, g, Jr, Lr, Mp, Lp
+            )
+        return q1, p1, q2, p2, energy, derivatives, t_eval
+    elif backend != "torch":
+        raise ValueError("backend must be 'torch' or 'numpy'")
+
     # the first trajectory
     q1, p1, q2, p2, t_eval = get_trajectory_furuta(
         device,
@@ -351,6 +687,10 @@ def multiple_trajectories_furuta(
         Lr,
         Mp,
         Lp,
+        method=method,
+        rtol=rtol,
+        atol=atol,
+        solver_stats=solver_stats,
     )
     energy = []
     derivatives = []
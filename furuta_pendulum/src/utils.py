@@ -1,12 +1,10 @@
 import torch
 import random
 import json
+import time
 import numpy as np
 
-from .models import *
-from .dynamics import *
-from .data import *
-from .trajectories import *
+from contextlib import contextmanager
 
 
 def collect_gradients(named_parameters):
@@ -114,7 +112,6 @@ def get_maxmindenom(x, dim1, dim2, rescale_dims):
     minimums = x.amin(dim=dim1).unsqueeze(dim=dim2)
     denom = (maximums - minimums).abs()
     denom[:, :, ~(torch.Tensor(rescale_dims).bool())] = 1  #
-    print("min max values updated")
     return maximums, minimums, denom
 
 
@@ -203,3 +200,139 @@ def set_all_seeds(manualSeed=123, new_results=False):
     random.seed(manualSeed)
     torch.manual_seed(manualSeed)
     np.random.seed(manualSeed)
+
+
+class PhaseTimer:
+    """
+    Description:
+        Accumulates the wall clock time spent in named phases of the training
+        loop (data fetch, forward rollout, loss, backward, ...) and named counters
+        (for example the number of function evaluations of the model)
+    Inputs:
+        - device (string or torch.device) : device of the model
+        - synchronize (bool) : on cuda, synchronize at every phase boundary so that
+                               asynchronous kernels are attributed to the phase that
+                               launched them (slows down training a little)
+    Methods:
+        - phase(name) : context manager timing the code inside it
+        - start(name) / stop(name) : same as phase() for code that cannot be put
+                                     in a with block (for example a for loop header)
+        - count(name, n) : increase a counter by n
+        - summary(reset) : times, number of calls and counters since the last reset
+
+    Example use :
+        timer = PhaseTimer(device)
+        with timer.phase("backward"):
+            loss.backward()
+        logs["phase_times"].append(timer.summary()["times"])
+    """
+
+    def __init__(self, device=None, synchronize=False):
+        self.synchronize = (
+            synchronize and device is not None and torch.device(device).type == "cuda"
+        )
+        self.reset()
+
+    def reset(self):
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+        self._started = {}
+
+    def _sync(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+
+    def start(self, name):
+        self._sync()
+        self._started[name] = time.perf_counter()
+
+    def stop(self, name):
+        if name not in self._started:
+            return
+        self._sync()
+        elapsed = time.perf_counter() - self._started.pop(name)
+        self.times[name] = self.times.get(name, 0.0) + elapsed
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    @contextmanager
+    def phase(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self, reset=True):
+        summary = {
+            "times": dict(self.times),
+            "calls": dict(self.calls),
+            "counters": dict(self.counters),
+        }
+        if reset:
+            self.reset()
+        return summary
+
+
+class ProfilerWindow:
+    """
+    Description:
+        Captures a torch.profiler trace for a window of training steps (batches)
+        instead of the whole training run
+    Inputs:
+        - start (int) : step at which the profiler starts (counted from 0 over
+                        all the epochs)
+        - num_steps (int) : number of profiled steps
+        - trace_path (string or None) : if given, the chrome trace is saved there
+                                        (open it in chrome://tracing or perfetto)
+        - sort_by (string) : column used to sort the summary table
+        - row_limit (int) : number of rows of the summary table
+    Methods:
+        - step() : call once at the beginning of every training step
+        - stop() : stop the profiler if the window is still open (end of training)
+        - table (string) : summary table once the window is over, None before
+    """
+
+    def __init__(
+        self,
+        start=10,
+        num_steps=5,
+        trace_path=None,
+        sort_by="self_cpu_time_total",
+        row_limit=20,
+    ):
+        self.start = start
+        self.num_steps = num_steps
+        self.trace_path = trace_path
+        self.sort_by = sort_by
+        self.row_limit = row_limit
+        self.step_num = 0
+        self.profiler = None
+        self.table = None
+
+    def step(self):
+        if self.step_num == self.start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(
+                activities=activities, record_shapes=True
+            )
+            self.profiler.start()
+        elif self.step_num == self.start + self.num_steps:
+            self.stop()
+        self.step_num += 1
+
+    def stop(self):
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        if self.trace_path is not None:
+            self.profiler.export_chrome_trace(self.trace_path)
+        self.table = self.profiler.key_averages().table(
+            sort_by=self.sort_by, row_limit=self.row_limit
+        )
+        self.profiler = None
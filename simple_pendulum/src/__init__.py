@@ -0,0 +1,83 @@
+""" SIMPLE PENDULUM
+
+Public API of the package, the submodules are only imported when one of their
+names is used (PEP 562) so that the dynamics and the models can be used without
+importing the plotting (matplotlib) and the training code.
+"""
+
+import importlib
+
+# public name : submodule that defines it
+_LAZY_NAMES = {
+    # dynamics and trajectories
+    "pendulum_H": "dynamics",
+    "hamiltonian_fn_pend": "dynamics",
+    "dynamics_fn_pend": "dynamics",
+    "NFECounter": "dynamics",
+    "U_FUNC": "trajectories",
+    "G_FUNC": "trajectories",
+    "rk4_step": "trajectories",
+    "dopri5_solve": "trajectories",
+    "get_trajectory_pend": "trajectories",
+    "energy_pendulum": "trajectories",
+    "multiple_trajectories": "trajectories",
+    # models
+    "hamiltonian_gradient": "models_sub",
+    "MLP": "models_sub",
+    "Expanding_HNN": "models_sub",
+    "Interp_HNN": "models_sub",
+    "Expanding_wide_HNN": "models_sub",
+    "Dissipation_Net": "models_sub",
+    "Simple_HNN": "models_main",
+    "Input_HNN": "models_main",
+    # data and training
+    "TrajectoryDataset": "data",
+    "data_loader": "data",
+    "simple_pendulum_parameters": "train_helpers",
+    "load_data_device": "train_helpers",
+    "trajectory_loss": "train_helpers",
+    "L2_loss": "train_helpers",
+    "AdaptiveHorizon": "train_helpers",
+    "MultilevelScheduler": "train_helpers",
+    "SystemSpec": "engine",
+    "TrainingEngine": "engine",
+    "Callback": "engine",
+    "ConstantHorizon": "engine",
+    "ScheduledHorizon": "engine",
+    "Training": "train",
+    # evaluation
+    "rollout_and_score": "evaluation",
+    "Validator": "evaluation",
+    "evaluate_long_horizon": "evaluation",
+    "check_regression": "evaluation",
+    "pendulum_energy_fn": "evaluation",
+    # utils
+    "set_device": "utils",
+    "set_all_seeds": "utils",
+    "count_parameters": "utils",
+    "save_stats": "utils",
+    "read_dict": "utils",
+    "PhaseTimer": "utils",
+    # export
+    "export_model": "export",
+    "load_exported": "export",
+    "RK4Stepper": "export",
+    # plots (imports matplotlib)
+    "plot_traj_pend": "plots",
+    "train_test_loss_plot": "plots",
+    "plot_results": "plots",
+}
+
+__all__ = sorted(_LAZY_NAMES)
+
+
+def __getattr__(name):
+    if name not in _LAZY_NAMES:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module("." + _LAZY_NAMES[name], __name__), name)
+    globals()[name] = value  # __getattr__ is not called again for this name
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,467 @@
+import argparse
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+from torch.utils.data import DataLoader
+from torchdiffeq import odeint
+
+from .data import TrajectoryDataset
+from .dynamics import *
+from .export import _VectorField, export_model, load_exported
+from .models_main import *
+from .models_sub import *
+from .train_helpers import L2_loss, simple_pendulum_parameters
+from .trajectories import G_FUNC, U_FUNC, get_trajectory_pend, rk4_step
+from .utils import count_parameters, save_stats
+
+""" BENCHMARKS
+
+Reproducible timings of the dynamics, the integrator, the models and the training
+epoch, saved to a json file with the git commit.
+
+From the simple_pendulum folder :
+    python -m src.benchmark --output benchmark.json
+    python -m src.benchmark --quick
+"""
+
+
+def _synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+
+def time_function(fn, repeats=10, warmup=2, device="cpu"):
+    """
+    Times fn() after warmup calls, returns the mean, median, min and max time
+    per call in seconds
+    """
+    for _ in range(warmup):
+        fn()
+    _synchronize(device)
+
+    times = []
+    for _ in range(repeats):
+        t_start = time.perf_counter()
+        fn()
+        _synchronize(device)
+        times.append(time.perf_counter() - t_start)
+
+    times = torch.tensor(times, dtype=torch.float64)
+    return {
+        "mean": times.mean().item(),
+        "median": times.median().item(),
+        "min": times.min().item(),
+        "max": times.max().item(),
+        "repeats": repeats,
+    }
+
+
+def git_commit():
+    """
+    Returns the current commit hash and whether the working tree has uncommitted
+    changes, (None, None) outside of a git repository
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=cwd, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain"], cwd=cwd, capture_output=True, text=True, check=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def environment_info(device):
+    commit, dirty = git_commit()
+    info = {
+        "commit": commit,
+        "dirty": dirty,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "device": str(device),
+        "num_threads": torch.get_num_threads(),
+    }
+    if torch.device(device).type == "cuda":
+        info["gpu"] = torch.cuda.get_device_name(0)
+    return info
+
+
+def build_H_net(architecture):
+    """
+    H_net of each architecture with the sizes used in Training._init_model(),
+    the multilevel models have all their blocks active (fully grown model)
+    """
+    if architecture == "MLP":
+        return MLP(
+            input_dim=2, hidden_dim=60, nb_hidden_layers=2, output_dim=1, activation="x+sin(x)^2"
+        )
+    if architecture == "Expanding_HNN":
+        return Expanding_HNN(
+            resblock_list=list(range(6)), num_blocks=6, input_dim=2, hidden_dim=22, nb_hidden_layers=2
+        )
+    if architecture == "Expanding_wide_HNN":
+        return Expanding_wide_HNN(
+            resblock_list=list(range(6)), num_blocks=6, input_dim=2, hidden_dim=22, nb_hidden_layers=2
+        )
+    if architecture == "Interp_HNN":
+        return Interp_HNN(
+            resblock_list=list(range(17)), num_blocks=17, input_dim=2, hidden_dim=18, nb_hidden_layers=1
+        )
+    raise ValueError("unknown architecture " + str(architecture))
+
+
+def build_model(architecture, device, utype="chirp"):
+    model = Input_HNN(
+        u_func=U_FUNC(utype=utype),
+        G_net=G_FUNC(device, gtype="simple"),
+        H_net=build_H_net(architecture),
+        device=device,
+    )
+    return model.to(device)
+
+
+def bench_dynamics(device, batch_sizes=(1, 16, 128), repeats=10):
+    """
+    Evaluations per second of dynamics_fn_pend() for different batch sizes,
+    dynamics_fn_pend() takes a single state so a batch is a loop over its states
+    """
+    _, _, _, C, m, g, l = simple_pendulum_parameters()
+    u_func = U_FUNC(utype="chirp")
+    g_func = G_FUNC(device, gtype="simple")
+    t = torch.tensor(0.1, device=device)
+
+    results = []
+    for batch_size in batch_sizes:
+        coords = torch.randn(batch_size, 2, device=device)
+
+        def fn():
+            for i in range(batch_size):
+                dynamics_fn_pend(t, coords[i].clone(), C, m, g, l, u_func, g_func)
+
+        timing = time_function(fn, repeats=repeats, device=device)
+        timing["batch_size"] = batch_size
+        timing["evaluations_per_second"] = batch_size / timing["median"]
+        results.append(timing)
+    return results
+
+
+def bench_rollout(
+    device, horizons=(50, 100, 200), batch_size=100, architecture="MLP", repeats=5
+):
+    """
+    Cost of one odeint rk4 rollout of an Input_HNN without gradients versus
+    the horizon
+    """
+    Ts = simple_pendulum_parameters()[2]
+    model = build_model(architecture, device)
+    model.eval()
+    x0 = torch.randn(batch_size, 2, device=device)
+
+    results = []
+    for horizon in horizons:
+        t_eval = torch.linspace(1, horizon, horizon, device=device) * Ts
+
+        def fn():
+            with torch.no_grad():
+                odeint(model, x0, t_eval, method="rk4", options=dict(step_size=Ts))
+
+        timing = time_function(fn, repeats=repeats, warmup=1, device=device)
+        timing["horizon"] = horizon
+        timing["batch_size"] = batch_size
+        timing["architecture"] = architecture
+        timing["seconds_per_step"] = timing["median"] / horizon
+
+        # function evaluations of one rollout, see NFECounter
+        model.nfe_counter.reset()
+        fn()
+        timing["nfe"] = model.nfe_counter.read()["forward"]
+        timing["seconds_per_nfe"] = timing["median"] / timing["nfe"]
+        results.append(timing)
+    return results
+
+
+def bench_models(
+    device,
+    architectures=("MLP", "Expanding_HNN", "Expanding_wide_HNN", "Interp_HNN"),
+    batch_size=100,
+    horizon=50,
+    repeats=5,
+):
+    """
+    Forward (rk4 rollout over horizon time steps) + backward cost of an
+    Input_HNN for each H_net architecture
+    """
+    Ts = simple_pendulum_parameters()[2]
+    t_eval = torch.linspace(1, horizon, horizon, device=device) * Ts
+    x0 = torch.randn(batch_size, 2, device=device)
+
+    results = []
+    for architecture in architectures:
+        model = build_model(architecture, device)
+        model.train()
+
+        def fn():
+            x_hat = odeint(model, x0, t_eval, method="rk4", options=dict(step_size=Ts))
+            x_hat.pow(2).mean().backward()
+            model.zero_grad()
+
+        timing = time_function(fn, repeats=repeats, warmup=1, device=device)
+        timing["architecture"] = architecture
+        timing["num_parameters"] = count_parameters(model)
+        timing["batch_size"] = batch_size
+        timing["horizon"] = horizon
+        results.append(timing)
+    return results
+
+
+def benchmark_loader(device, num_trajectories=100, time_steps=200, batch_size=100):
+    """
+    Train loader with trajectories of the simple pendulum and a chirp input
+    """
+    y0, noise_std, Ts, C, m, g, l = simple_pendulum_parameters()
+    u_func = U_FUNC(utype="chirp")
+    g_func = G_FUNC(device, gtype="simple")
+    q, p = [], []
+    for _ in range(num_trajectories):
+        q_n, p_n, t_eval = get_trajectory_pend(
+            device, time_steps, Ts, y0, noise_std, C, m, g, l, u_func, g_func
+        )
+        q.append(q_n)
+        p.append(p_n)
+    # TrajectoryDataset expects [time_steps, num_trajectories]
+    dataset = TrajectoryDataset(device, torch.stack(q, dim=1), torch.stack(p, dim=1), t_eval)
+    return DataLoader(dataset, batch_size, shuffle=False)
+
+
+def bench_epoch(
+    device,
+    configs=(("MLP", 50), ("MLP", 200), ("Interp_HNN", 50), ("Interp_HNN", 200)),
+    num_trajectories=100,
+    time_steps=200,
+    batch_size=100,
+    repeats=3,
+):
+    """
+    Time of one training epoch (rollout, loss, backward and optimizer step over
+    the whole train loader, as in Training._train_step()) for
+    (architecture, horizon) pairs
+    """
+    Ts = simple_pendulum_parameters()[2]
+    train_loader = benchmark_loader(device, num_trajectories, time_steps, batch_size)
+    w = torch.tensor([1.0, 1.0], device=device)
+
+    results = []
+    for architecture, horizon in configs:
+        model = build_model(architecture, device)
+        model.train()
+        optim = torch.optim.AdamW(model.parameters(), lr=1e-3, weight_decay=1e-4)
+
+        def fn():
+            for x, t_eval in train_loader:
+                t_eval = t_eval[0, :horizon]
+                x_hat = odeint(
+                    model, x[:, 0, :], t_eval, method="rk4", options=dict(step_size=Ts)
+                )
+                loss = L2_loss(
+                    torch.permute(x[:, :horizon, :], (1, 0, 2)), x_hat, w, param="L2weighted"
+                )
+                loss.backward()
+                optim.step()
+                optim.zero_grad()
+
+        timing = time_function(fn, repeats=repeats, warmup=1, device=device)
+        timing["architecture"] = architecture
+        timing["horizon"] = horizon
+        timing["num_trajectories"] = num_trajectories
+        timing["batch_size"] = batch_size
+        results.append(timing)
+    return results
+
+
+def bench_export(
+    device,
+    architectures=("MLP", "Expanding_HNN", "Expanding_wide_HNN", "Interp_HNN"),
+    batch_size=16,
+    steps=20,
+    repeats=3,
+    tolerance=1e-4,
+):
+    """
+    Description:
+        Exports the model of every architecture with export_model() (the
+        resnets included), times the export and the cold start of
+        load_exported(), and checks that a rollout of the loaded RK4Stepper
+        matches rk4_step() on the model with the same inputs
+    Outputs:
+        - results (list) : one dict per architecture, timing of load_exported()
+    """
+    Ts = 0.05
+    results = []
+    for architecture in architectures:
+        model = build_model(architecture, device)
+        model.eval()
+        x0 = torch.randn(batch_size, 2, device=device) * 0.1
+        u_seq = torch.randn(steps, batch_size, device=device) * 0.1
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, architecture)
+            t_start = time.perf_counter()
+            manifest = export_model(model, path, Ts)
+            export_seconds = time.perf_counter() - t_start
+
+            timing = time_function(lambda: load_exported(path), repeats=repeats, warmup=0)
+            stepper, _ = load_exported(path, map_location=device)
+
+        vector_field = _VectorField(model)
+        with torch.no_grad():
+            x_export = stepper.rollout(x0, u_seq)
+            x = x0
+            rollout_error = 0.0
+            for k in range(steps):
+                f = lambda t, x, u=u_seq[k]: vector_field(x, u)
+                x = rk4_step(f, torch.tensor(0.0), x, Ts)
+                rollout_error = max(rollout_error, (x_export[k + 1] - x).abs().max().item())
+
+        timing["architecture"] = architecture
+        timing["export_seconds"] = export_seconds
+        timing["check_error"] = manifest["check_error"]
+        timing["rollout_error"] = rollout_error
+        timing["within_tolerance"] = rollout_error <= tolerance
+        results.append(timing)
+    return results
+
+
+# modules that must not be imported by the lean entry points, see bench_imports()
+HEAVY_MODULES = ("matplotlib", "seaborn", "dill")
+LEAN_MODULES = ("src", "src.dynamics", "src.models_main", "src.trajectories", "src.train_helpers", "src.evaluation", "src.train")
+
+_IMPORT_SCRIPT = """
+import importlib, sys, time
+t_start = time.perf_counter()
+import torch
+t_torch = time.perf_counter()
+# torch may import some of them itself (dill), only those added by the package count
+loaded = set(sys.modules)
+importlib.import_module({module!r})
+t_end = time.perf_counter()
+heavy = [name for name in {heavy!r} if name in sys.modules and name not in loaded]
+print(t_torch - t_start, t_end - t_torch, ",".join(heavy))
+"""
+
+
+def bench_imports(modules=LEAN_MODULES, budget=0.5, repeats=3):
+    """
+    Import time of the modules used by the workers (in a new interpreter every
+    time, without the time of `import torch`). A module is within the budget if
+    it imports in less than budget seconds and does not import HEAVY_MODULES
+    (those already imported by torch are not counted)
+    """
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+    for module in modules:
+        script = _IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+        torch_times, times = [], []
+        for _ in range(repeats):
+            output = subprocess.run(
+                [sys.executable, "-c", script], cwd=cwd, capture_output=True, text=True, check=True
+            ).stdout.split()
+            torch_times.append(float(output[0]))
+            times.append(float(output[1]))
+            heavy = output[2].split(",") if len(output) > 2 else []
+
+        times = torch.tensor(times, dtype=torch.float64)
+        median = times.median().item()
+        results.append(
+            {
+                "module": module,
+                "mean": times.mean().item(),
+                "median": median,
+                "min": times.min().item(),
+                "max": times.max().item(),
+                "repeats": repeats,
+                "torch_seconds": torch.tensor(torch_times).median().item(),
+                "heavy_modules": heavy,
+                "budget": budget,
+                "within_budget": median <= budget and not heavy,
+            }
+        )
+    return results
+
+
+def run_benchmarks(device="cpu", quick=False, output=None, seed=0):
+    """
+    Runs all the benchmarks, returns the results and saves them to output
+    (json) if it is given
+    """
+    torch.manual_seed(seed)
+    if quick:
+        results = {
+            "imports": bench_imports(repeats=1),
+            "dynamics": bench_dynamics(device, batch_sizes=(1, 16), repeats=3),
+            "rollout": bench_rollout(device, horizons=(20, 50), batch_size=16, repeats=2),
+            "models": bench_models(device, batch_size=16, horizon=10, repeats=2),
+            "epoch": bench_epoch(
+                device,
+                configs=(("MLP", 20), ("Interp_HNN", 20)),
+                num_trajectories=16,
+                time_steps=20,
+                batch_size=16,
+                repeats=1,
+            ),
+            "export": bench_export(device, architectures=("MLP", "Interp_HNN"), steps=5, repeats=1),
+        }
+    else:
+        results = {
+            "imports": bench_imports(),
+            "dynamics": bench_dynamics(device),
+            "rollout": bench_rollout(device),
+            "models": bench_models(device),
+            "epoch": bench_epoch(device),
+            "export": bench_export(device),
+        }
+    results["environment"] = environment_info(device)
+    results["quick"] = quick
+
+    if output is not None:
+        save_stats(results, output)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="simple pendulum benchmarks")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.device, args.quick, args.output, args.seed)
+    for name in ("imports", "dynamics", "rollout", "models", "epoch", "export"):
+        for result in results[name]:
+            details = {
+                key: value
+                for key, value in result.items()
+                if key in ("module", "batch_size", "horizon", "architecture")
+            }
+            print("{:8s} {} : {:.3e} s".format(name, details, result["median"]))
+    for result in results["imports"]:
+        if not result["within_budget"]:
+            print("import budget exceeded :", result["module"], result["heavy_modules"])
+    for result in results["export"]:
+        if not result["within_tolerance"]:
+            print("export differs from the model :", result["architecture"], result["rollout_error"])
+    print("results saved to", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -32,9 +32,39 @@ def coord_derivative_pend(t, coords, C, m, g, l, u_func, g_func):
     return dqdt, dpdt
 
 
-def dynamics_fn_pend(t, coords, C, m, g, l, u_func, g_func):
+def dynamics_fn_pend(t, coords, C, m, g, l, u_func, g_func, nfe_counter=None):
 
     dqdt, dpdt = coord_derivative_pend(t, coords, C, m, g, l, u_func, g_func)
     # symplectic gradient
     S = torch.hstack((dqdt, dpdt))
+    if nfe_counter is not None:
+        nfe_counter.forward(S)
     return S
+
+
+class NFECounter:
+    """
+    Counts the function evaluations (NFE) of a vector field : forward evaluations
+    and evaluations through which a gradient was propagated (backward).
+    Call forward(output) in the vector field, reset() and read() around a batch
+    or an epoch
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.forward_count = 0
+        self.backward_count = 0
+
+    def _count_backward(self, grad):
+        self.backward_count += 1
+
+    def forward(self, output):
+        self.forward_count += 1
+        if output.requires_grad:
+            output.register_hook(self._count_backward)
+        return output
+
+    def read(self):
+        return {"forward": self.forward_count, "backward": self.backward_count}
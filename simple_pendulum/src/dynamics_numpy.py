@@ -0,0 +1,59 @@
+import numpy as np
+import torch
+
+""" NUMPY GROUND TRUTH
+
+Autograd free simulation of the simple pendulum used to generate datasets, the
+derivatives of pendulum_H() are written in closed form and all the trajectories
+are integrated at once with the fixed step rk4 (3/8 rule) of odeint(method="rk4").
+See multiple_trajectories(backend="numpy")
+"""
+
+
+def pendulum_dynamics_numpy(x, U_G, C, m, g, l):
+    """
+    Same vector field as dynamics_fn_pend() for a batch of states
+    x [num_trajectories, (q,p)] and inputs U_G = u(t)*G [num_trajectories or 1, 2]
+    """
+    q, p = x[..., 0], x[..., 1]
+    dHdq = m * g * l * np.sin(q)
+    dHdp = p / (m * l**2)
+    dxdt = np.stack((dHdp, -dHdq - C * dHdp), axis=-1)
+    return dxdt + U_G
+
+
+def tabulate_input(u_func, g_func, times):
+    """
+    Evaluates u_func once at all the given times and multiplies it by the input
+    matrix (which does not depend on the state for G_FUNC), returns
+    U_G [num_times, num_trajectories or 1, 2]
+    """
+    t = torch.tensor(times, dtype=torch.float32)
+    U = u_func.forward(t).detach().cpu().double().numpy()
+    G = g_func.forward(torch.zeros(2)).detach().cpu().double().numpy()
+    G = G.reshape(-1)[:2]
+
+    if U.ndim == 1:
+        U = U[:, None]  # same input for every trajectory
+    else:
+        # one input per trajectory, [num_times, num_trajectories]
+        U = U.T
+    return U[..., None] * G
+
+
+def rk4_numpy(f, x0, Ts, steps, U_G):
+    """
+    Fixed step rk4 (3/8 rule, the scheme of odeint(method="rk4")) on all the
+    trajectories x0 [num_trajectories, dim] at once. U_G contains the input at the
+    stage times t + Ts*(0, 1/3, 2/3, 1) of every step [steps, 4, num_trajectories or 1, dim].
+    Returns the trajectory [steps + 1, num_trajectories, dim]
+    """
+    x = np.empty((steps + 1,) + x0.shape)
+    x[0] = x0
+    for k in range(steps):
+        k1 = f(x[k], U_G[k, 0])
+        k2 = f(x[k] + Ts * k1 / 3, U_G[k, 1])
+        k3 = f(x[k] + Ts * (k2 - k1 / 3), U_G[k, 2])
+        k4 = f(x[k] + Ts * (k1 - k2 + k3), U_G[k, 3])
+        x[k + 1] = x[k] + Ts * (k1 + 3 * (k2 + k3) + k4) / 8
+    return x
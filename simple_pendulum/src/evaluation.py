@@ -0,0 +1,379 @@
+import time
+
+import torch
+
+from .dynamics import pendulum_H
+from .train_helpers import StreamingLoss
+from .trajectories import U_FUNC, rk4_step
+from .utils import save_stats
+
+""" EVALUATION OF TRAINED MODELS """
+
+
+def inference_context(model):
+    """
+    torch.inference_mode() if H_net computes its gradient in the forward pass
+    (forward_with_jacobian()), torch.no_grad() if the autograd fallback of
+    hamiltonian_gradient() needs a graph inside the step
+    """
+    H_net = getattr(model, "H_net", None)
+    if H_net is not None and hasattr(H_net, "forward_with_jacobian"):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+def rollout_and_score(
+    model,
+    x0,
+    Ts,
+    steps,
+    x_nom=None,
+    w=None,
+    time_weights=None,
+    energy_fn=None,
+    divergence_threshold=None,
+    t0=None,
+    track_time=False,
+):
+    """
+    Rolls out the model step by step with rk4_step() and scores every step as
+    soon as it is computed, the rollout is never stored (O(batch_size) memory for
+    any number of steps).
+    x0 : initial states [batch_size, (q,p)]
+    x_nom (optional) : nominal trajectories [batch_size, time_steps, (q,p)] with
+        x_nom[:, 0] = x0, can be shorter than the rollout
+    w, time_weights : see trajectory_loss(), time_weights [steps + 1]
+    energy_fn (optional) : energy of states [batch_size, (q,p)]
+    divergence_threshold (optional) : error norm after which a trajectory diverged
+    t0 : time of x0, Ts (first element of t_eval) if None
+    track_time : also return the squared error of every step and coordinate
+        summed over the batch (sq_error_time [scored_steps, 2]) and the energy
+        drift of every step summed over the batch (energy_drift_time [steps + 1])
+    Returns a dict with the loss (trajectory_loss() over the steps with a nominal
+    state), per_sample_error, max_deviation, energy_error, energy_drift,
+    divergence_step (-1 if none), finite, final_state, scored_steps,
+    sq_error_time and energy_drift_time (None if not track_time)
+    """
+    t0 = Ts if t0 is None else t0
+    batch_size = x0.shape[0]
+    device = x0.device
+    scored_steps = 0 if x_nom is None else min(steps + 1, x_nom.shape[1])
+
+    loss = StreamingLoss(w)
+    sq_error = torch.zeros(batch_size, device=device)
+    max_deviation = torch.zeros_like(x0)
+    divergence_step = torch.full((batch_size,), -1, dtype=torch.long, device=device)
+    finite = torch.ones(batch_size, dtype=torch.bool, device=device)
+    energy_error = None
+    energy_drift = None
+    sq_error_time = None
+    energy_drift_time = None
+    if track_time:
+        sq_error_time = torch.zeros(scored_steps, x0.shape[-1], device=device)
+        if energy_fn is not None:
+            energy_drift_time = torch.zeros(steps + 1, device=device)
+
+    with inference_context(model):
+        x_hat = x0
+        if energy_fn is not None:
+            E0 = energy_fn(x0).reshape(-1)
+            energy_drift = torch.zeros(batch_size, device=device)
+            if x_nom is not None:
+                energy_error = torch.zeros(batch_size, device=device)
+
+        for k in range(steps + 1):
+            if k > 0:
+                t = torch.tensor(t0 + (k - 1) * Ts, device=device, dtype=x0.dtype)
+                x_hat = rk4_step(model, t, x_hat, Ts).detach()
+            finite &= torch.isfinite(x_hat).all(dim=-1)
+
+            if energy_fn is not None:
+                E_hat = energy_fn(x_hat).reshape(-1)
+                energy_drift = torch.maximum(energy_drift, (E_hat - E0).abs())
+                if track_time:
+                    energy_drift_time[k] = (E_hat - E0).abs().sum()
+
+            if k < scored_steps:
+                x_k = x_nom[:, k]
+                error = x_hat - x_k
+                loss.update(x_k, x_hat, None if time_weights is None else time_weights[k])
+                sq_error += error.square().sum(dim=-1)
+                if track_time:
+                    sq_error_time[k] = error.square().sum(dim=0)
+                max_deviation = torch.maximum(max_deviation, error.abs())
+                if divergence_threshold is not None:
+                    diverged = (error.norm(dim=-1) > divergence_threshold) & (
+                        divergence_step < 0
+                    )
+                    divergence_step[diverged] = k
+                if energy_fn is not None:
+                    energy_error += (E_hat - energy_fn(x_k).reshape(-1)).abs()
+
+    scored = scored_steps > 0
+    return {
+        "loss": loss.result().item() if scored else None,
+        "per_sample_error": sq_error / scored_steps if scored else None,
+        "max_deviation": max_deviation if scored else None,
+        "energy_error": energy_error / scored_steps if scored and energy_fn else None,
+        "energy_drift": energy_drift,
+        "divergence_step": divergence_step if scored else None,
+        "finite": finite,
+        "final_state": x_hat,
+        "scored_steps": scored_steps,
+        "sq_error_time": sq_error_time,
+        "energy_drift_time": energy_drift_time,
+    }
+
+
+class Validator:
+    """
+    Evaluates the whole test split (test_loader.dataset, a TrajectoryDataset or
+    a Subset of it) in a few large batched rollouts with rollout_and_score().
+    The trajectories are gathered once, the chunk size is chosen so that the
+    activations of one model evaluation of a chunk fit in memory_budget (bytes).
+    validator(model, horizon, w) returns the mean loss over the split.
+    """
+
+    def __init__(self, dataset, Ts, memory_budget=256 * 2**20, max_batch_size=None):
+        base, indices = dataset, torch.arange(len(dataset))
+        if isinstance(dataset, torch.utils.data.Subset):
+            base, indices = dataset.dataset, torch.as_tensor(dataset.indices)
+        # TrajectoryDataset stores [time_steps, num_trajectories],
+        # x is [num_trajectories, time_steps, (q,p)]
+        indices_device = indices.to(base.q.device)
+        self.x = torch.stack((base.q[:, indices_device], base.p[:, indices_device]), dim=-1)
+        self.x = self.x.transpose(0, 1).contiguous()
+        self.t0 = base.t_eval[0].item()
+        self.Ts = Ts
+        self.memory_budget = memory_budget
+        self.max_batch_size = max_batch_size
+
+    def __len__(self):
+        return self.x.shape[0]
+
+    def batch_size(self, model):
+        # outputs of the linear layers and their jacobian, for the 4 rk4 stages
+        widths = sum(
+            module.out_features
+            for module in model.modules()
+            if isinstance(module, torch.nn.Linear)
+        )
+        dim = self.x.shape[-1]
+        bytes_per_trajectory = self.x.element_size() * 4 * (widths + dim) * (1 + dim)
+        size = max(1, self.memory_budget // bytes_per_trajectory)
+        if self.max_batch_size is not None:
+            size = min(size, self.max_batch_size)
+        return min(size, len(self))
+
+    def __call__(self, model, horizon, w=None, time_weights=None):
+        horizon = min(horizon, self.x.shape[1])
+        batch_size = self.batch_size(model)
+        total = 0.0
+        for start in range(0, len(self), batch_size):
+            x = self.x[start : start + batch_size]
+            scores = rollout_and_score(
+                model,
+                x[:, 0],
+                self.Ts,
+                horizon - 1,
+                x_nom=x[:, :horizon],
+                w=w,
+                time_weights=time_weights,
+                t0=self.t0,
+            )
+            total += scores["loss"] * x.shape[0]
+        return total / len(self)
+
+
+COORDINATE_NAMES = ("q", "p")
+
+
+def pendulum_energy_fn(m, g, l):
+    """
+    energy (pendulum_H()) of states [batch_size, (q,p)], for rollout_and_score()
+    and evaluate_long_horizon()
+    """
+    return lambda x: pendulum_H(x[:, 0:1], x[:, 1:2], m, g, l)
+
+
+def hamiltonian_conservation(model, x0, Ts, steps, batch_size=None, t0=None):
+    """
+    Unforced (u = 0) and undissipated rollouts of the model from the states x0
+    [num_trajectories, (q,p)], the learned Hamiltonian H_net is then conserved
+    up to the integration error. Returns H_net(x0), the largest
+    |H_net(x_hat_k) - H_net(x0)| and whether the rollouts stayed finite, all
+    [num_trajectories]. The input and the dissipation of the model are restored.
+    """
+    batch_size = x0.shape[0] if batch_size is None else batch_size
+    u_func = getattr(model, "u_func", None)
+    dissip = getattr(model, "dissip", None)
+    H_fn = lambda x: model.H_net(x)[..., :1]
+    H0, H_drift, finite = [], [], []
+    try:
+        model.u_func = U_FUNC(utype=None)
+        if dissip is not None:
+            model.dissip = False
+        for start in range(0, x0.shape[0], batch_size):
+            x0_chunk = x0[start : start + batch_size]
+            with inference_context(model):
+                H0.append(H_fn(x0_chunk).reshape(-1))
+            scores = rollout_and_score(
+                model, x0_chunk, Ts, steps, energy_fn=H_fn, t0=t0
+            )
+            H_drift.append(scores["energy_drift"])
+            finite.append(scores["finite"])
+    finally:
+        model.u_func = u_func
+        if dissip is not None:
+            model.dissip = dissip
+    return torch.cat(H0), torch.cat(H_drift), torch.cat(finite)
+
+
+def _report_curve(curve, points):
+    # indices and values of at most points evenly spaced time steps of a curve
+    idx = torch.linspace(0, curve.shape[0] - 1, min(points, curve.shape[0]))
+    idx = idx.round().long().unique()
+    return idx, curve[idx.to(curve.device)]
+
+
+def evaluate_long_horizon(
+    model,
+    dataset,
+    Ts,
+    steps=None,
+    energy_fn=None,
+    divergence_threshold=1.0,
+    unforced_steps=None,
+    memory_budget=256 * 2**20,
+    report_points=50,
+    report_path=None,
+):
+    """
+    Evaluation suite of a trained model : all the trajectories of dataset (test
+    split) are rolled out together (chunks sized by Validator) for steps
+    integration steps (length of the trajectories if None) and the metrics are
+    accumulated during the rollout, the rollouts are never stored.
+    energy_fn : see pendulum_energy_fn()
+    unforced_steps : length of the hamiltonian_conservation() rollouts, steps if
+        None and skipped if 0
+    Returns a json serializable report (saved to report_path with save_stats() if
+    given) : rmse and rmse_time of every coordinate, energy_error and energy
+    drift, diverged_fraction and divergence times (error norm above
+    divergence_threshold), finite_fraction and the drift of the learned H on the
+    unforced rollouts. Compare it to a reference report with check_regression().
+    """
+    t_start = time.perf_counter()
+    validator = Validator(dataset, Ts, memory_budget=memory_budget)
+    x_all = validator.x
+    num_trajectories, time_steps, _ = x_all.shape
+    steps = time_steps - 1 if steps is None else steps
+    unforced_steps = steps if unforced_steps is None else unforced_steps
+    batch_size = validator.batch_size(model)
+
+    sq_error_time = 0
+    energy_drift_time = 0
+    energy_error, energy_drift, divergence_step, finite = [], [], [], []
+    for start in range(0, num_trajectories, batch_size):
+        x = x_all[start : start + batch_size]
+        scores = rollout_and_score(
+            model,
+            x[:, 0],
+            Ts,
+            steps,
+            x_nom=x,
+            energy_fn=energy_fn,
+            divergence_threshold=divergence_threshold,
+            t0=validator.t0,
+            track_time=True,
+        )
+        sq_error_time = sq_error_time + scores["sq_error_time"]
+        divergence_step.append(scores["divergence_step"])
+        finite.append(scores["finite"])
+        if energy_fn is not None:
+            energy_drift_time = energy_drift_time + scores["energy_drift_time"]
+            energy_error.append(scores["energy_error"])
+            energy_drift.append(scores["energy_drift"])
+
+    compared_steps = sq_error_time.shape[0]
+    idx, rmse_time = _report_curve((sq_error_time / num_trajectories).sqrt(), report_points)
+    rmse = (sq_error_time.sum(dim=0) / (num_trajectories * compared_steps)).sqrt()
+    divergence_step = torch.cat(divergence_step)
+    diverged = divergence_step >= 0
+    divergence_time = divergence_step[diverged].double() * Ts
+
+    report = {
+        "num_trajectories": num_trajectories,
+        "steps": steps,
+        "compared_steps": compared_steps,
+        "rmse": dict(zip(COORDINATE_NAMES, rmse.tolist())),
+        "time": (validator.t0 + idx.double() * Ts).tolist(),
+        "rmse_time": dict(zip(COORDINATE_NAMES, rmse_time.T.tolist())),
+        "energy_error": None,
+        "energy_drift_mean": None,
+        "energy_drift_max": None,
+        "energy_drift_time": None,
+        "diverged_fraction": diverged.double().mean().item(),
+        "divergence_time_median": divergence_time.median().item() if diverged.any() else None,
+        "divergence_time_min": divergence_time.min().item() if diverged.any() else None,
+        "finite_fraction": torch.cat(finite).double().mean().item(),
+        "H_drift_mean": None,
+        "H_drift_max": None,
+        "H_drift_relative": None,
+    }
+
+    if energy_fn is not None:
+        energy_drift = torch.cat(energy_drift)
+        _, drift_time = _report_curve(energy_drift_time / num_trajectories, report_points)
+        report["energy_error"] = torch.cat(energy_error).mean().item()
+        report["energy_drift_mean"] = energy_drift.mean().item()
+        report["energy_drift_max"] = energy_drift.max().item()
+        report["energy_drift_time"] = drift_time.tolist()
+
+    if unforced_steps:
+        H0, H_drift, _ = hamiltonian_conservation(
+            model, x_all[:, 0], Ts, unforced_steps, batch_size, validator.t0
+        )
+        report["H_drift_mean"] = H_drift.mean().item()
+        report["H_drift_max"] = H_drift.max().item()
+        report["H_drift_relative"] = (H_drift / H0.abs().clamp_min(1e-12)).mean().item()
+
+    report["seconds"] = time.perf_counter() - t_start
+    if report_path is not None:
+        save_stats(report, report_path)
+    return report
+
+
+# metrics of the report where lower is better, compared by check_regression()
+REGRESSION_METRICS = (
+    "energy_error",
+    "energy_drift_mean",
+    "energy_drift_max",
+    "diverged_fraction",
+    "H_drift_mean",
+    "H_drift_max",
+)
+
+
+def check_regression(report, reference, rtol=0.1, atol=1e-8):
+    """
+    Compares a report of evaluate_long_horizon() to the report of a reference
+    checkpoint, returns the (metric, value, reference value) of every metric above
+    reference * (1 + rtol) + atol (empty list if the checkpoint passes)
+    """
+    pairs = [(name, report.get(name), reference.get(name)) for name in REGRESSION_METRICS]
+    pairs += [
+        ("rmse_" + name, report["rmse"][name], reference["rmse"][name])
+        for name in reference["rmse"]
+    ]
+    regressions = [
+        (name, value, ref)
+        for name, value, ref in pairs
+        if value is not None
+        and ref is not None
+        and not value <= ref * (1 + rtol) + atol  # also catches NaN
+    ]
+    if report["finite_fraction"] < reference["finite_fraction"]:
+        regressions.append(
+            ("finite_fraction", report["finite_fraction"], reference["finite_fraction"])
+        )
+    return regressions
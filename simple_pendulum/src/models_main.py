@@ -1,5 +1,8 @@
 import torch
 
+from .dynamics import NFECounter
+from .models_sub import hamiltonian_gradient
+
 """ SIMPLE  HNN """
 
 
@@ -9,12 +12,16 @@ class Simple_HNN(torch.nn.Module):
     Equivalent of unconstrained ODE HNN from the report
     Architecture for input (q, p, u),
     where q and p are tensors of size (bs, n) and u is a tensor of size (bs, 1)
+    With dissip and a dissip_net (Dissipation_Net) the dissipation is R(x) dH/dp
     """
 
-    def __init__(self, H_net=None, device=None, dissip=False):
+    def __init__(self, H_net=None, device=None, dissip=False, dissip_net=None):
         super(Simple_HNN, self).__init__()
 
         self.H_net = H_net
+        self.dissip_net = dissip_net
+        if dissip_net is not None and dissip_net.fused:
+            dissip_net.init_fused_outputs(H_net)
 
         self.device = device
 
@@ -25,31 +32,30 @@ class Simple_HNN(torch.nn.Module):
         )  # torch.nn.Parameter(torch.rand(1))
         self.C_dissip.requires_grad = True
 
-    def forward(self, t, x):
-        with torch.enable_grad():
-            q_p = x
-
-            q, p = torch.chunk(x, 2, dim=-1)
-
-            q_p.requires_grad_(True)
+        # number of evaluations of forward(), see NFECounter
+        self.nfe_counter = NFECounter()
 
-            H = self.H_net(q_p)
-
-            dH = torch.autograd.grad(H.sum(), q_p, create_graph=True)
+    def forward(self, t, x):
+        q_p = x
 
-            dH = dH[0]
+        # gradient of H_net w.r.t. (q, p), see hamiltonian_gradient()
+        H, dH = hamiltonian_gradient(self.H_net, q_p)
 
-            dHdq, dHdp = torch.chunk(dH, 2, dim=-1)
+        dHdq, dHdp = torch.chunk(dH, 2, dim=-1)
 
-            dqdt = dHdp
-            if self.dissip:
-                dpdt = -dHdq - self.C_dissip * dHdp
-            else:
-                dpdt = -dHdq
+        dqdt = dHdp
+        if self.dissip and self.dissip_net is not None:
+            entries = H[:, 1:] if self.dissip_net.fused else None
+            dpdt = -dHdq - self.dissip_net(q_p, dHdp, entries)
+        elif self.dissip:
+            dpdt = -dHdq - self.C_dissip * dHdp
+        else:
+            dpdt = -dHdq
 
-            # symplectic gradient
-            S_h = torch.cat((dqdt, dpdt), dim=-1)
-            return S_h
+        # symplectic gradient
+        S_h = torch.cat((dqdt, dpdt), dim=-1)
+        self.nfe_counter.forward(S_h)
+        return S_h
 
 
 """ INPUT HNN """
@@ -62,11 +68,17 @@ class Input_HNN(torch.nn.Module):
 
     """
 
-    def __init__(self, u_func=None, G_net=None, H_net=None, device=None, dissip=False):
+    def __init__(
+        self, u_func=None, G_net=None, H_net=None, device=None, dissip=False, dissip_net=None
+    ):
         super(Input_HNN, self).__init__()
         self.H_net = H_net
         self.G_net = G_net
         self.u_func = u_func
+        # learned dissipation matrix R(x) (Dissipation_Net), replaces C if given
+        self.dissip_net = dissip_net
+        if dissip_net is not None and dissip_net.fused:
+            dissip_net.init_fused_outputs(H_net)
 
         self.device = device
         self.dissip = dissip
@@ -76,38 +88,40 @@ class Input_HNN(torch.nn.Module):
         )  # torch.nn.Parameter(torch.randn(1)+1) # torch.nn.Parameter(torch.tensor([0.5]))
         self.C.requires_grad = True
 
-    def forward(self, t, x):
-        with torch.enable_grad():
-            q_p = x
-
-            # q1,p1,q2,p2 = torch.chunk(x,4,dim=-1)
+        # number of evaluations of forward(), see NFECounter
+        self.nfe_counter = NFECounter()
 
-            q_p.requires_grad_(True)
-
-            H = self.H_net(q_p)
-
-            # .sum() to sum up the hamiltonian funcs of a batch
-            dH = torch.autograd.grad(H.sum(), q_p, create_graph=True)
-
-            dH = dH[0]
-
-            dHdq, dHdp = torch.chunk(dH, 2, dim=-1)
-
-            G = self.G_net.forward(q_p)
-
-            if self.u_func:
-                u = self.u_func.forward(t)
-            else:
-                u = torch.tensor([0.0])
-            dqdt = dHdp + (G[:, 0].T * u).unsqueeze(dim=1)
-            if self.dissip:
-                dpdt = -dHdq + (G[:, 1].T * u).unsqueeze(dim=1) - self.C.pow(2) * dHdp
-            else:
-                dpdt = -dHdq + (G[:, 1].T * u).unsqueeze(dim=1)
-            # symplectic gradient
-            S_h = torch.cat((dqdt, dpdt), dim=-1)
-
-            return S_h
+    def forward(self, t, x):
+        q_p = x
+
+        # gradient of H_net w.r.t. (q, p), see hamiltonian_gradient()
+        H, dH = hamiltonian_gradient(self.H_net, q_p)
+
+        dHdq, dHdp = torch.chunk(dH, 2, dim=-1)
+
+        G = self.G_net.forward(q_p)
+
+        if self.u_func:
+            u = self.u_func.forward(t)
+        else:
+            u = torch.tensor([0.0])
+        dqdt = dHdp + (G[:, 0].T * u).unsqueeze(dim=1)
+        if self.dissip and self.dissip_net is not None:
+            entries = H[:, 1:] if self.dissip_net.fused else None
+            dpdt = (
+                -dHdq
+                + (G[:, 1].T * u).unsqueeze(dim=1)
+                - self.dissip_net(q_p, dHdp, entries)
+            )
+        elif self.dissip:
+            dpdt = -dHdq + (G[:, 1].T * u).unsqueeze(dim=1) - self.C.pow(2) * dHdp
+        else:
+            dpdt = -dHdq + (G[:, 1].T * u).unsqueeze(dim=1)
+        # symplectic gradient
+        S_h = torch.cat((dqdt, dpdt), dim=-1)
+        self.nfe_counter.forward(S_h)
+
+        return S_h
 
     def freeze_G_net(self, freeze=True):
         """
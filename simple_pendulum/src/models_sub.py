@@ -16,6 +16,40 @@ def choose_nonlinearity(name):
     return nl
 
 
+def choose_nonlinearity_derivative(name):
+    """
+    Returns the derivative of the activation function returned by
+    choose_nonlinearity(name), used to compute input Jacobians analytically
+    """
+    dnl = None
+    if name == "tanh":
+        dnl = lambda x: 1 - torch.tanh(x).pow(2)
+    elif name == "x+sin(x)^2":
+        dnl = lambda x: 1 + torch.sin(2 * x)
+    else:
+        raise ValueError("nonlinearity not recognized")
+    return dnl
+
+
+def hamiltonian_gradient(H_net, q_p):
+    """
+    Evaluates H_net(q_p) and the gradient of its first output (the Hamiltonian,
+    the others are the entries of a fused Dissipation_Net) w.r.t. q_p. Uses the analytic
+    forward_with_jacobian() of H_net when it exists (first order backward during
+    training), otherwise falls back on torch.autograd.grad(create_graph=True)
+    """
+    if hasattr(H_net, "forward_with_jacobian"):
+        H, J = H_net.forward_with_jacobian(q_p)
+        return H, J[..., 0, :]
+
+    with torch.enable_grad():
+        q_p.requires_grad_(True)
+        H = H_net(q_p)
+        # .sum() to sum up the hamiltonian funcs of a batch
+        dH = torch.autograd.grad(H[..., 0].sum(), q_p, create_graph=True)[0]
+    return H, dH
+
+
 """ MLP """
 
 
@@ -28,11 +62,22 @@ class hidden_Layer(torch.nn.Module):
         super().__init__()
         self.fc = torch.nn.Linear(hidden_dim, hidden_dim)
         self.activation = choose_nonlinearity(activation)  # activation function
+        self.activation_derivative = choose_nonlinearity_derivative(activation)
 
     def forward(self, x):
         x = self.activation(self.fc(x))
         return x
 
+    def forward_with_jacobian(self, x, J):
+        """
+        Propagates the input Jacobian J [..., hidden_dim, n] through the layer
+        """
+        z = self.fc(x)
+        J = self.activation_derivative(z).unsqueeze(dim=-1) * torch.matmul(
+            self.fc.weight, J
+        )
+        return self.activation(z), J
+
 
 class MLP(torch.nn.Module):
     """
@@ -54,12 +99,25 @@ class MLP(torch.nn.Module):
         )  # trick from EE-559 to define hidden layers
         self.fc2 = torch.nn.Linear(hidden_dim, output_dim)
         self.activation = choose_nonlinearity(activation)  # activation function
+        self.activation_derivative = choose_nonlinearity_derivative(activation)
 
     def forward(self, x):
         h = self.activation(self.fc1(x))
         h = self.hidden_layers(h)
         return self.fc2(h)
 
+    def forward_with_jacobian(self, x):
+        """
+        Forward pass that also returns the Jacobian dy/dx [..., output_dim, input_dim],
+        computed layer by layer (forward mode) from the known activation derivatives
+        """
+        z = self.fc1(x)
+        J = self.activation_derivative(z).unsqueeze(dim=-1) * self.fc1.weight
+        h = self.activation(z)
+        for layer in self.hidden_layers:
+            h, J = layer.forward_with_jacobian(h, J)
+        return self.fc2(h), torch.matmul(self.fc2.weight, J)
+
 
 class Expanding_HNN(torch.nn.Module):
     """
@@ -81,7 +139,7 @@ class Expanding_HNN(torch.nn.Module):
     ):
         super(Expanding_HNN, self).__init__()
 
-        self.resblocks = [
+        self.resblocks = torch.nn.ModuleList(
             MLP(
                 input_dim=output_dim,
                 hidden_dim=hidden_dim,
@@ -90,7 +148,7 @@ class Expanding_HNN(torch.nn.Module):
                 activation=activation_res,
             )
             for _ in range(num_blocks)
-        ]
+        )
 
         self.mlp = MLP(
             input_dim=input_dim,
@@ -112,6 +170,19 @@ class Expanding_HNN(torch.nn.Module):
 
         return y
 
+    def forward_with_jacobian(self, x):
+        """
+        Same as forward() but also returns the Jacobian dy/dx
+        """
+        y, J = self.mlp.forward_with_jacobian(x)
+
+        for i in self.resblock_list:
+            r, J_r = self.resblocks[i].forward_with_jacobian(y)
+            y = r + y
+            J = torch.matmul(J_r, J) + J
+
+        return y, J
+
     def make_params_small(self):
         with torch.no_grad():
             for i in range(len(self.resblocks)):
@@ -140,7 +211,7 @@ class Interp_HNN(torch.nn.Module):
     ):
         super(Interp_HNN, self).__init__()
 
-        self.resblocks = [
+        self.resblocks = torch.nn.ModuleList(
             MLP(
                 input_dim=input_dim,
                 hidden_dim=hidden_dim,
@@ -149,7 +220,7 @@ class Interp_HNN(torch.nn.Module):
                 activation=activation_res,
             )
             for _ in range(num_blocks)
-        ]
+        )
 
         self.mlp = MLP(
             input_dim=input_dim,
@@ -172,6 +243,23 @@ class Interp_HNN(torch.nn.Module):
         y = self.mlp(y)
         return y
 
+    def forward_with_jacobian(self, x):
+        """
+        Same as forward() but also returns the Jacobian dy/dx
+        """
+        y = x
+        J = torch.eye(x.shape[-1], device=x.device, dtype=x.dtype).expand(
+            *x.shape, x.shape[-1]
+        )
+
+        for i in self.resblock_list:
+            r, J_r = self.resblocks[i].forward_with_jacobian(y)
+            y = r * self.alpha + y
+            J = torch.matmul(J_r, J) * self.alpha + J
+
+        y, J_mlp = self.mlp.forward_with_jacobian(y)
+        return y, torch.matmul(J_mlp, J)
+
     def init_new_resblocks_two(self, i, j):
         # i and j are the new resblocks to be initialised
         # in our simple case we introduce reblocks 1 and 2 between resblocks 0 and 3
@@ -220,7 +308,7 @@ class Expanding_wide_HNN(torch.nn.Module):
     ):
         super(Expanding_wide_HNN, self).__init__()
 
-        self.resblocks = [
+        self.resblocks = torch.nn.ModuleList(
             MLP(
                 input_dim=input_dim,
                 hidden_dim=hidden_dim,
@@ -229,7 +317,7 @@ class Expanding_wide_HNN(torch.nn.Module):
                 activation=activation_res,
             )
             for _ in range(num_blocks)
-        ]
+        )
 
         self.mlp = MLP(
             input_dim=input_dim,
@@ -251,8 +339,123 @@ class Expanding_wide_HNN(torch.nn.Module):
         y = self.mlp(y)
         return y
 
+    def forward_with_jacobian(self, x):
+        """
+        Same as forward() but also returns the Jacobian dy/dx
+        """
+        y = x
+        J = torch.eye(x.shape[-1], device=x.device, dtype=x.dtype).expand(
+            *x.shape, x.shape[-1]
+        )
+
+        for i in self.resblock_list:
+            r, J_r = self.resblocks[i].forward_with_jacobian(y)
+            y = r + y
+            J = torch.matmul(J_r, J) + J
+
+        y, J_mlp = self.mlp.forward_with_jacobian(y)
+        return y, torch.matmul(J_mlp, J)
+
     def make_params_small(self):
         with torch.no_grad():
             for i in range(len(self.resblocks)):
                 for param in self.resblocks[i].parameters():
                     param.copy_(param / 1000)
+
+
+""" DISSIPATION """
+
+
+class Dissipation_Net(torch.nn.Module):
+    """
+    Learned positive semi-definite dissipation matrix R(x) = L(x) L(x)^T on the
+    momenta, dp/dt = -dH/dq - R(x) dH/dp. The dof*(dof+1)/2 entries of the lower
+    triangular L are given by an MLP of the state, by constant parameters
+    (state_dependent=False) or, with fused, by the outputs 1: of H_net (which then
+    has output_dim = 1 + num_entries) so that they come out of the same pass as
+    the gradient of H (the models zero them at initialization, see
+    init_fused_outputs()). R starts at init * identity.
+    """
+
+    def __init__(
+        self,
+        dof=1,
+        input_dim=2,
+        hidden_dim=32,
+        nb_hidden_layers=1,
+        state_dependent=True,
+        fused=False,
+        init=1e-5,
+        activation="tanh",
+    ):
+        super(Dissipation_Net, self).__init__()
+        self.dof = dof
+        self.fused = fused
+        self.num_entries = dof * (dof + 1) // 2
+        rows, cols = torch.tril_indices(dof, dof)
+        self.register_buffer("rows", rows)
+        self.register_buffer("cols", cols)
+        # entries of L at initialization
+        self.register_buffer("L0", (rows == cols).float() * init**0.5)
+
+        self.net = None
+        self.L_entries = None
+        if fused:
+            pass
+        elif state_dependent:
+            self.net = MLP(input_dim, hidden_dim, nb_hidden_layers, self.num_entries, activation)
+            with torch.no_grad():
+                self.net.fc2.weight.zero_()
+                self.net.fc2.bias.zero_()
+        else:
+            self.L_entries = torch.nn.Parameter(torch.zeros(self.num_entries))
+
+    def init_fused_outputs(self, H_net):
+        """
+        Zero initialization of the outputs 1: of H_net (weights and bias of the
+        layers that produce them) when the net is fused, so that the entries of L
+        start at L0 and R at init * identity as with the other modes
+        """
+        if isinstance(H_net, MLP):
+            layers = [H_net.fc2]
+        elif hasattr(H_net, "mlp"):
+            layers = [H_net.mlp.fc2]
+            if isinstance(H_net, Expanding_HNN):
+                # residual blocks applied after the mlp, on the outputs
+                layers += [block.fc2 for block in H_net.resblocks]
+        else:
+            raise ValueError("unknown H_net {}, cannot find its output layer".format(type(H_net)))
+        for layer in layers:
+            if layer.out_features != 1 + self.num_entries:
+                raise ValueError(
+                    "a fused Dissipation_Net needs an H_net with output_dim = 1 + {}".format(
+                        self.num_entries
+                    )
+                )
+            with torch.no_grad():
+                layer.weight[1:].zero_()
+                layer.bias[1:].zero_()
+
+    def cholesky_factor(self, x, entries=None):
+        # L(x) [batch_size, dof, dof], entries are the outputs 1: of H_net when fused
+        if self.fused:
+            raw = entries
+        elif self.net is not None:
+            raw = self.net(x)
+        else:
+            raw = self.L_entries.expand(x.shape[0], -1)
+        L = x.new_zeros(x.shape[0], self.dof, self.dof)
+        L[:, self.rows, self.cols] = self.L0 + raw
+        return L
+
+    def matrix(self, x, entries=None):
+        L = self.cholesky_factor(x, entries)
+        return torch.matmul(L, L.transpose(-1, -2))
+
+    def forward(self, x, dHdp, entries=None):
+        """
+        R(x) dH/dp [batch_size, dof], as L (L^T dH/dp) without forming R
+        """
+        L = self.cholesky_factor(x, entries)
+        v = torch.matmul(L.transpose(-1, -2), dHdp.unsqueeze(dim=-1))
+        return torch.matmul(L, v).squeeze(dim=-1)
@@ -88,11 +88,14 @@ def train_test_loss_plot(
 ):
     """
     Description:
-
+        plot of the train and test loss per epoch, with arrows at the epochs where
+        the horizon changed
     Inputs:
-
+        - horizons (list) : horizon trained before each switch
+        - horizon_steps (list) : epochs at which the horizon changed, for example
+                                 logs["horizon_switch_epochs"] returned by Training.train()
     Outpus:
-
+        None
     """
     fig, ax = plt.subplots(figsize=(10, 4))
 
@@ -107,7 +110,7 @@ def train_test_loss_plot(
     plt.legend()
     plt.title(title)
 
-    if horizons:
+    if horizons and horizon_steps:
         for i, epoch_num in enumerate(horizon_steps[:-1]):
             ax.annotate(
                 "horizon = %d" % horizons[i],
@@ -1,18 +1,17 @@
-from asyncio import wait_for
 import torch
-import time
-
-from torchdiffeq import odeint as odeint
 
 from .dynamics import *
 from .data import *
+from .engine import *
+from .evaluation import Validator
 from .models_main import *
 from .models_sub import *
-from .plots import *
-from .train import *
 from .train_helpers import *
 from .utils import *
 
+# batches are (x, t_eval) with x [batch_size, time_steps, (q,p)]
+PENDULUM_SYSTEM = SystemSpec("simple_pendulum", state_dim=2, coordinates=("q", "p"))
+
 
 class Training:
     """
@@ -45,6 +44,13 @@ class Training:
         shuffle=False,
         coord_type="hamiltonian",
         save_suffix="",
+        horizon_controller=None,
+        phase_timer=None,
+        profile_window=None,
+        validator=None,
+        grad_clip=None,
+        alternating=False,
+        callbacks=None,
     ):
 
         self.device = device
@@ -54,11 +60,30 @@ class Training:
         self.horizon_type = horizon_type
         self.horizon_list = horizon_list
         self.switch_steps = switch_steps
+        self.horizon_controller = horizon_controller
+        if horizon_type == "adaptive" and horizon_controller is None:
+            # switch_steps becomes the maximum number of epochs per horizon
+            self.horizon_controller = AdaptiveHorizon(
+                horizon_list, max_epochs=switch_steps
+            )
         self.loss_type = loss_type
         self.lr = lr
         self.weight_decay = weight_decay
         self.test_every = test_every
         self.print_every = print_every
+        # whole test split in a few batched rollouts, built from the test loader
+        # in train() if None, see Validator
+        self.validator = validator
+        # options of the training engine : maximum gradient norm, alternating
+        # G_net / H_net updates and extra callbacks, see TrainingEngine
+        self.grad_clip = grad_clip
+        self.alternating = alternating
+        self.callbacks = callbacks or []
+
+        # per phase timing of every epoch and optional torch.profiler window,
+        # see PhaseTimer and ProfilerWindow
+        self.phase_timer = phase_timer if phase_timer is not None else PhaseTimer(device)
+        self.profile_window = profile_window
 
         self.model_name = model_name
         (
@@ -164,16 +189,14 @@ class Training:
                 activation_res="x+sin(x)^2",
                 activation_mlp="x+sin(x)^2",
             )
-            num_params = 0
-            for block in H_net.resblocks:
-                block.to(self.device)
-                num_params += count_parameters(block)
+            num_params = sum(count_parameters(block) for block in H_net.resblocks)
 
             self.model = Input_HNN(
                 u_func=self.u_func, G_net=self.g_func, H_net=H_net, device=self.device
             )
             self.model.to(self.device)
-            num_params1 = count_parameters(self.model)
+            # the resblocks are part of the model (ModuleList)
+            num_params1 = count_parameters(self.model) - num_params
             num_params2 = count_parameters(self.model.H_net.resblocks[0])
             num_params += num_params1
             print("mlp number of parameters :", num_params1)
@@ -192,16 +215,14 @@ class Training:
                 activation_res="x+sin(x)^2",
                 activation_mlp="x+sin(x)^2",
             )
-            num_params = 0
-            for block in H_net.resblocks:
-                block.to(self.device)
-                num_params += count_parameters(block)
+            num_params = sum(count_parameters(block) for block in H_net.resblocks)
 
             self.model = Input_HNN(
                 u_func=self.u_func, G_net=self.g_func, H_net=H_net, device=self.device
             )
             self.model.to(self.device)
-            num_params1 = count_parameters(self.model)
+            # the resblocks are part of the model (ModuleList)
+            num_params1 = count_parameters(self.model) - num_params
             num_params2 = count_parameters(self.model.H_net.resblocks[0])
             num_params += num_params1
             print("mlp number of parameters :", num_params1)
@@ -220,16 +241,14 @@ class Training:
                 activation_res="x+sin(x)^2",
                 activation_mlp="x+sin(x)^2",
             )
-            num_params = 0
-            for block in H_net.resblocks:
-                block.to(self.device)
-                num_params += count_parameters(block)
+            num_params = sum(count_parameters(block) for block in H_net.resblocks)
 
             self.model = Input_HNN(
                 u_func=self.u_func, G_net=self.g_func, H_net=H_net, device=self.device
             )
             self.model.to(self.device)
-            num_params1 = count_parameters(self.model)
+            # the resblocks are part of the model (ModuleList)
+            num_params1 = count_parameters(self.model) - num_params
             num_params2 = count_parameters(self.model.H_net.resblocks[0])
             num_params += num_params1
             print("mlp number of parameters :", num_params1)
@@ -249,16 +268,14 @@ class Training:
                 activation_mlp="x+sin(x)^2",
             )
 
-            num_params = 0
-            for block in H_net.resblocks:
-                block.to(self.device)
-                num_params += count_parameters(block)
+            num_params = sum(count_parameters(block) for block in H_net.resblocks)
 
             self.model = Input_HNN(
                 u_func=self.u_func, G_net=self.g_func, H_net=H_net, device=self.device
             )
             self.model.to(self.device)
-            num_params1 = count_parameters(self.model)
+            # the resblocks are part of the model (ModuleList)
+            num_params1 = count_parameters(self.model) - num_params
             num_params2 = count_parameters(self.model.H_net.resblocks[0])
             num_params += num_params1
             print("mlp number of parameters :", num_params1)
@@ -277,69 +294,42 @@ class Training:
         """
 
         if step % self.print_every == 0 or step == self.epoch_num - 1:
-            if step % self.test_every == 0:
+            if test_loss is not None:
                 print(
                     "[%3d/%3d]\t train loss: %4e, t_train: %2.2f, test loss: %4e, t_test: %2.2f"
                     % (step, self.epoch_num, train_loss, train_time, test_loss, test_time)
                 )
-                self.test_epochs.append(step)
             else:
                 print(
                     "[%3d/%3d]\t train loss: %4e, t_train: %2.2f"
                     % (step, self.epoch_num, train_loss, train_time)
                 )
 
-    def _train_step(self, train_loss, x, t_eval):
+    def _loss(self, x_nom, x_hat, mask, horizon):
         """
-        basic training step of the model
+        loss of a batch, x_nom [batch_size, time_steps, (q,p)] and x_hat
+        [time_steps, batch_size, (q,p)]
         """
-
-        # x is [batch_size,(q1,p1,q2,p1),time_steps]
-        t_eval = t_eval[0, : self.horizon]
-
-        train_x_hat = odeint(
-            self.model, x[:, 0, :], t_eval, method="rk4", options=dict(step_size=self.Ts)
-        )
-        # train_x_hat is [time_steps, batch_size, (q1,p1,q2,p1)]
-
-        train_loss_mini = L2_loss(
-            torch.permute(x[:, : self.horizon, :], (1, 0, 2)),
-            train_x_hat[: self.horizon, :, :],
+        return L2_loss(
+            x_nom,
+            x_hat,
             self.w,
             param=self.loss_type,
+            mask=mask,
+            u_layout="batch_first",
         )
-        # after permute x is [time_steps, batch_size, (q1,p1,q2,p1),]
-
-        train_loss = train_loss + train_loss_mini.item()
-
-        train_loss_mini.backward()
-        self.optim.step()
-        self.optim.zero_grad()
 
-        return train_loss
-
-    def _test_step(self, test_loss, x, t_eval):
+    def _test_step(self, model, horizon):
         """
-        basic training step of the model
+        validation on the whole test split, see Validator
         """
-
-        # run test data
-        t_eval = t_eval[0, : self.horizon]
-
-        test_x_hat = odeint(
-            self.model, x[:, 0, :], t_eval, method="rk4", options=dict(step_size=self.Ts)
+        if self.validator is None:
+            self.validator = Validator(self.test_loader.dataset, self.Ts)
+        return self.validator(
+            model,
+            horizon,
+            w=self.w if self.loss_type == "L2weighted" else None,
         )
-        # test_loss_mini = L2_loss(torch.permute(x[:, :, :horizon], (2,0,1)) , test_x_hat[:horizon,:,:],w)
-        test_loss_mini = L2_loss(
-            torch.permute(x[:, : self.horizon, :], (1, 0, 2)),
-            test_x_hat[: self.horizon, :, :],
-            self.w,
-            param=self.loss_type,
-        )
-
-        test_loss = test_loss + test_loss_mini.item()
-
-        return test_loss
 
     def train(self):
         """
@@ -351,55 +341,61 @@ class Training:
             self.model.parameters(), self.lr, weight_decay=self.weight_decay
         )  # Adam
 
-        logs = {"train_loss": [], "test_loss": []}
-
-        self.test_epochs = []
-
-        for step in range(self.epoch_num):
-
-            test_loss = 0
-            train_loss = 0
-
-            t1 = time.time()
-
-            if self.horizon_type == "auto":
-                self.horizon = select_horizon_list(
-                    step, self.horizon_list, self.switch_steps
-                )
-
-            # increase the model size and initialise the new parameters
-            if self.resnet_config:
-                self.model = multilevel_strategy_update(
-                    self.device, step, self.model, self.resnet_config, self.switch_steps
-                )
-
-            self.model.train()
-
-            for x, t_eval in iter(self.train_loader):
-                train_loss = self._train_step(train_loss, x, t_eval)
-
-            logs["train_loss"].append(train_loss)
-
-            t2 = time.time()
-            train_time = t2 - t1
-
-            self.model.eval()
+        self.growth_scheduler = None
+        if self.resnet_config:
+            self.growth_scheduler = MultilevelScheduler.from_resnet_config(
+                self.resnet_config,
+                self.switch_steps,
+                len(self.model.H_net.resblocks),
+                self.device,
+            )
 
-            if self.test_loader:
-                with torch.no_grad():  # we won't need gradients for testing
-                    if step % self.test_every == 0:  # run validation every 10 steps
-                        for x, t_eval in iter(self.test_loader):
-                            test_loss = self._test_step(test_loss, x, t_eval)
+        if self.horizon_type == "auto":
+            curriculum = ScheduledHorizon(self.horizon_list, self.switch_steps)
+        elif self.horizon_type == "adaptive":
+            curriculum = self.horizon_controller
+        else:
+            curriculum = ConstantHorizon(self.horizon)
+
+        engine = TrainingEngine(
+            self.model,
+            PENDULUM_SYSTEM,
+            self.train_loader,
+            self.Ts,
+            self._loss,
+            optimizer=self.optim,
+            curriculum=curriculum,
+            validate=self._test_step if self.test_loader else None,
+            validate_every=self.test_every,
+            growth_scheduler=self.growth_scheduler,
+            grad_clip=self.grad_clip,
+            alternating=self.alternating,
+            callbacks=[_TrainingStats(self)] + self.callbacks,
+            phase_timer=self.phase_timer,
+            profile_window=self.profile_window,
+        )
+        logs = engine.run(self.epoch_num)
+        self.model = engine.model
+        self.horizon = engine.horizon
+        self.test_epochs = logs["test_epochs"]
 
-                        logs["test_loss"].append(test_loss)
+        self.logs = logs
+        return logs
 
-            test_time = time.time() - t2
 
-            self._output_training_stats(
-                step, train_loss, test_loss, train_time, test_time
-            )
+class _TrainingStats(Callback):
+    """
+    Prints the stats of the epochs with Training._output_training_stats()
+    """
 
-        logs["test_epochs"] = self.test_epochs
+    def __init__(self, training):
+        self.training = training
 
-        self.logs = logs
-        return logs
+    def on_epoch_end(self, engine, step, epoch):
+        self.training._output_training_stats(
+            step,
+            epoch["train_loss"],
+            epoch["test_loss"],
+            epoch["train_time"],
+            epoch["test_time"],
+        )
@@ -1,3 +1,4 @@
+import bisect
 import torch
 from .data import *
 from .trajectories import *
@@ -33,16 +34,93 @@ def create_paths(PATH, save_suffix, model_name):
     return model_path, plot_path  # , train_loader_path, test_loader_path # stats_path,
 
 
-def L2_loss(u, v, w=False, dim=(0, 1), param="L2"):
+def trajectory_loss(
+    u, v, w=None, time_weights=None, mask=None, u_layout="time_first"
+):
+    """
+    Weighted mean squared error, the weighting, time step weights and mask are
+    applied in place on the squared error and reduced in one einsum (the only
+    [time_steps, batch_size, (q,p)] temporaries are the difference and its square)
+    u nominal [time_steps, batch_size, (q,p)], or [batch_size, time_steps, (q,p)]
+      with u_layout='batch_first' (read through a transposed view, not copied)
+    v approximate [time_steps, batch_size, (q,p)]
+    w (optional) : weight of each coordinate
+    time_weights (optional) : weight of each time step [time_steps]
+    mask (optional) : [time_steps, batch_size], 1 inside the horizon of each trajectory
+    """
+    if u_layout == "batch_first":
+        u = u.transpose(0, 1)  # view, no copy
+    elif u_layout != "time_first":
+        raise ValueError("u_layout must be 'time_first' or 'batch_first'")
+
+    sq = (u - v).square()
+    if w is not None:
+        sq.mul_(w.pow(2))
+
+    if time_weights is None and mask is None:
+        # mean only over time steps and batch_size
+        return sq.sum() / (sq.shape[0] * sq.shape[1])
+
+    step_weights = torch.ones(sq.shape[:2], device=sq.device, dtype=sq.dtype)
+    if time_weights is not None:
+        step_weights = step_weights * time_weights.to(sq.dtype).unsqueeze(dim=1)
+    if mask is not None:
+        step_weights = step_weights * mask.to(sq.dtype)
+    return torch.einsum("tbc,tb->", sq, step_weights) / step_weights.sum()
+
+
+def L2_loss(
+    u, v, w=False, dim=(0, 1), param="L2", mask=None, time_weights=None, u_layout="time_first"
+):
     # u nominal
     # v approximate
     # u and v expected with shape : [time_steps, batch_size , (q1,p1)]
-    if param == "L2":
-        # mean only over time steps and batch_size
-        loss = (((u - v)).pow(2)).mean(dim=dim).sum()
-    elif param == "L2weighted":
-        loss = (((u - v).mul(w)).pow(2)).mean(dim=dim).sum()
-    return loss  # ((u-v)*w).pow(2).mean()
+    # (u is [batch_size, time_steps, (q1,p1)] with u_layout='batch_first')
+    # mask (optional) : [time_steps, batch_size], 1 inside the horizon of each
+    # trajectory, the mean is then only taken over the masked in terms
+    # time_weights (optional) : weight of each time step, see trajectory_loss()
+    if tuple(dim) != (0, 1):
+        diff = u - v
+        if param == "L2weighted":
+            diff = diff.mul(w)
+        return diff.pow(2).mean(dim=dim).sum()
+    return trajectory_loss(
+        u,
+        v,
+        w=w if param == "L2weighted" else None,
+        time_weights=time_weights,
+        mask=mask,
+        u_layout=u_layout,
+    )  # ((u-v)*w).pow(2).mean()
+
+
+class StreamingLoss:
+    """
+    trajectory_loss() accumulated one time step at a time (update(u_t, v_t,
+    step_weight) with u_t, v_t [batch_size, (q,p)]), so that the loss can be
+    computed during the integration without storing the rollout
+    """
+
+    def __init__(self, w=None):
+        self.w = w
+        self.total = 0.0
+        self.normalizer = 0.0
+
+    def update(self, u_t, v_t, step_weight=None):
+        sq = (u_t - v_t).square()
+        if self.w is not None:
+            sq.mul_(self.w.pow(2))
+        if step_weight is None:
+            self.total = self.total + sq.sum()
+            self.normalizer = self.normalizer + sq.shape[0]
+        else:
+            step_weight = torch.as_tensor(step_weight, device=sq.device, dtype=sq.dtype)
+            step_weight = step_weight.expand(sq.shape[0])
+            self.total = self.total + torch.einsum("bc,b->", sq, step_weight)
+            self.normalizer = self.normalizer + step_weight.sum()
+
+    def result(self):
+        return self.total / self.normalizer
 
 
 def load_data_device(
@@ -62,8 +140,14 @@ def load_data_device(
     u_func,
     g_func,
     coord_type="hamiltonian",
+    method="rk4",
+    rtol=1e-7,
+    atol=1e-9,
+    backend="torch",
 ):
-    # create trajectories
+    # create trajectories, method is the integrator of the ground truth
+    # ('rk4' or adaptive step 'dopri5' with tolerances rtol and atol),
+    # backend is 'torch' or 'numpy' (see multiple_trajectories())
     q, p, t_eval, _, _ = multiple_trajectories(
         time_steps=time_steps,
         num_trajectories=num_trajectories,
@@ -78,6 +162,10 @@ def load_data_device(
         u_func=u_func,
         g_func=g_func,
         coord_type=coord_type,
+        method=method,
+        rtol=rtol,
+        atol=atol,
+        backend=backend,
     )
 
     # dataloader to load data in batches
@@ -121,94 +209,248 @@ def select_horizon_list(
     return horizon
 
 
-def multilevel_strategy_update(device, step, model, resnet_config, switch_steps):
-    """ """
-    # resnet strategy 1 :
-    if resnet_config == 1 or resnet_config == 3:
-        if step < sum(switch_steps[:1]):
-            if step == 0:
-                print("Model size increased")
-            model.H_net.resblock_list = [0]
-        elif step == sum(switch_steps[:1]) and len(model.H_net.resblocks) >= 2:
-            print("Model size increased")
-            model.H_net.resblock_list = [0, 1]
-        elif step == sum(switch_steps[:2]) and len(model.H_net.resblocks) >= 3:
-            print("Model size increased")
-            model.H_net.resblock_list = [0, 1, 2]
-        elif step == sum(switch_steps[:3]) and len(model.H_net.resblocks) >= 4:
-            print("Model size increased")
-            model.H_net.resblock_list = [0, 1, 2, 3]
-        elif step == sum(switch_steps[:4]) and len(model.H_net.resblocks) >= 5:
-            print("Model size increased")
-            model.H_net.resblock_list = [0, 1, 2, 3, 4]
-        elif step == sum(switch_steps[:5]) and len(model.H_net.resblocks) >= 6:
-            print("Model size increased")
-            model.H_net.resblock_list = [0, 1, 2, 3, 4, 5]
-
-    # resnet strategy 2 :
-    if resnet_config == 2:
-        if step < sum(switch_steps[:1]):  # init : [0,1,2,3,4,5,6,7,8,9,10,11]
-            if step == 0:
-                print("Model size increased")
-            model.H_net.resblock_list = [0, 16]
-            model.H_net.alpha = torch.tensor(
-                [1 / len(model.H_net.resblock_list)], device=device
-            )
-        elif step == sum(switch_steps[:1]) and len(model.H_net.resblocks) >= 4:
-            print("Model size increased")
-            model.H_net.init_new_resblocks(0, 8, 16)
-            model.H_net.resblock_list = [0, 8, 16]
-            model.H_net.alpha = torch.tensor(
-                [1 / len(model.H_net.resblock_list)], device=device
-            )
-        elif step == sum(switch_steps[:2]) and len(model.H_net.resblocks) >= 6:
-            print("Model size increased")
-            model.H_net.init_new_resblocks(0, 4, 8)
-            model.H_net.init_new_resblocks(8, 12, 16)
-            model.H_net.resblock_list = [0, 4, 8, 12, 16]
-            model.H_net.alpha = torch.tensor(
-                [1 / len(model.H_net.resblock_list)], device=device
-            )
-        elif step == sum(switch_steps[:3]) and len(model.H_net.resblocks) >= 8:
-            print("Model size increased")
-            model.H_net.init_new_resblocks(0, 2, 4)
-            model.H_net.init_new_resblocks(4, 6, 8)
-            model.H_net.init_new_resblocks(8, 10, 12)
-            model.H_net.init_new_resblocks(12, 14, 16)
-            model.H_net.resblock_list = [0, 2, 4, 6, 8, 10, 12, 14, 16]
-            model.H_net.alpha = torch.tensor(
-                [1 / len(model.H_net.resblock_list)], device=device
-            )
-        elif step == sum(switch_steps[:4]) and len(model.H_net.resblocks) >= 10:
-            print("Model size increased")
-            model.H_net.init_new_resblocks(0, 1, 2)
-            model.H_net.init_new_resblocks(2, 3, 4)
-            model.H_net.init_new_resblocks(4, 5, 6)
-            model.H_net.init_new_resblocks(8, 9, 10)
-            model.H_net.init_new_resblocks(10, 11, 12)
-            model.H_net.init_new_resblocks(11, 12, 13)
-            model.H_net.init_new_resblocks(12, 13, 14)
-            model.H_net.init_new_resblocks(14, 15, 16)
-            model.H_net.resblock_list = [
-                0,
-                1,
-                2,
-                3,
-                4,
-                5,
-                6,
-                7,
-                8,
-                9,
-                10,
-                11,
-                12,
-                13,
-                14,
-                15,
-                16,
-            ]
-            model.H_net.alpha = torch.tensor(
-                [1 / len(model.H_net.resblock_list)], device=device
+class AdaptiveHorizon:
+    """
+    Curriculum on the training horizon driven by the loss instead of fixed switch_steps:
+    the loss is smoothed with an exponential moving average and the next horizon of
+    horizon_list is used once it stopped improving by more than tol for patience
+    epochs, with min_epochs and max_epochs (int or list) per horizon.
+    monitor is 'train' or 'test'. select(step) is called at the start of an epoch,
+    observe(step, train_loss, test_loss) at its end. The epochs at which the horizon
+    changed are kept in switch_epochs.
+    """
+
+    def __init__(
+        self,
+        horizon_list=[50, 100, 150, 200, 250, 300],
+        min_epochs=20,
+        max_epochs=200,
+        smoothing=0.9,
+        tol=1e-3,
+        patience=10,
+        monitor="train",
+        stop_when_converged=True,
+    ):
+        num_stages = len(horizon_list)
+        if isinstance(min_epochs, int):
+            min_epochs = [min_epochs] * num_stages
+        if isinstance(max_epochs, int):
+            max_epochs = [max_epochs] * num_stages
+        assert (
+            len(min_epochs) == num_stages and len(max_epochs) == num_stages
+        ), " horizon_list, min_epochs and max_epochs must have same length"
+
+        self.horizon_list = horizon_list
+        self.min_epochs = min_epochs
+        self.max_epochs = max_epochs
+        self.smoothing = smoothing
+        self.tol = tol
+        self.patience = patience
+        self.monitor = monitor
+        self.stop_when_converged = stop_when_converged
+
+        self.stage = 0
+        self.finished = False
+        self.switch_epochs = []  # epochs at which a new horizon was started
+        self.horizons = [horizon_list[0]]  # horizon started at each switch
+        self._updated = True
+        self._reset_stage(0)
+
+    @property
+    def horizon(self):
+        return self.horizon_list[self.stage]
+
+    def _reset_stage(self, step):
+        self.stage_start = step
+        self.smoothed_loss = None
+        self.best_loss = float("inf")
+        self.bad_epochs = 0
+
+    def select(self, step):
+        """
+        Returns (horizon_updated, horizon) for epoch step
+        """
+        horizon_updated = int(self._updated)
+        if self._updated:
+            print("horizon length :", self.horizon)
+            self._updated = False
+        return horizon_updated, self.horizon
+
+    def observe(self, step, train_loss, test_loss=None):
+        """
+        Updates the smoothed loss and moves to the next horizon if it converged,
+        returns True if the horizon changed
+        """
+        loss = train_loss if self.monitor == "train" else test_loss
+        if loss is not None:
+            if self.smoothed_loss is None:
+                self.smoothed_loss = loss
+            else:
+                self.smoothed_loss = (
+                    self.smoothing * self.smoothed_loss + (1 - self.smoothing) * loss
+                )
+            if self.smoothed_loss < self.best_loss * (1 - self.tol):
+                self.best_loss = self.smoothed_loss
+                self.bad_epochs = 0
+            else:
+                self.bad_epochs += 1
+
+        epochs_in_stage = step + 1 - self.stage_start
+        converged = (
+            epochs_in_stage >= self.min_epochs[self.stage]
+            and self.bad_epochs >= self.patience
+        )
+        if not (converged or epochs_in_stage >= self.max_epochs[self.stage]):
+            return False
+
+        if self.stage == len(self.horizon_list) - 1:
+            self.finished = self.stop_when_converged and converged
+            return False
+
+        self.stage += 1
+        self.switch_epochs.append(step + 1)
+        self.horizons.append(self.horizon)
+        self._updated = True
+        self._reset_stage(step + 1)
+        return True
+
+
+class MultilevelScheduler:
+    """
+    Growth scheduler for the multilevel models (Expanding_* and Interp_HNN H_nets),
+    built from a growth plan containing one dict per stage :
+        {"blocks": [0, 8, 16], "epochs": 200, "init": "interpolate", "alpha": "inverse"}
+    "init" is how the newly active resblocks are initialised : None, 'small'
+    (parameters divided by 1000), 'interpolate' (average of the closest active
+    resblocks before and after) or 'copy' (closest active resblock).
+    "alpha" is None, 'inverse' (1/number of active resblocks) or a float.
+    The epoch at which each stage starts is computed once, so update() is a single
+    dict lookup per epoch.
+    """
+
+    def __init__(self, plan, device=None):
+        self.plan = plan
+        self.device = device
+        self.stage = None  # stage currently applied to the model
+
+        # epoch at which each stage starts, and the reverse lookup
+        self.stage_starts = []
+        start = 0
+        for stage in plan:
+            self.stage_starts.append(start)
+            start = start + stage["epochs"]
+        self.transitions = {epoch: i for i, epoch in enumerate(self.stage_starts)}
+
+    @classmethod
+    def from_resnet_config(cls, resnet_config, switch_steps, num_blocks, device=None):
+        """
+        Growth plan of resnet_config 1 or 3 (one resblock added per stage) and
+        resnet_config 2 (intervals between the active resblocks halved every stage)
+        """
+        if resnet_config == 1 or resnet_config == 3:
+            levels = [list(range(k + 1)) for k in range(num_blocks)]
+            init = None  # the resblocks were already made small at initialisation
+            alpha = None
+        elif resnet_config == 2:
+            levels = [list(range(num_blocks))]
+            while len(levels[-1]) > 2:
+                levels.append(levels[-1][::2])
+            levels = levels[::-1]
+            init = "interpolate"
+            alpha = "inverse"
+        else:
+            raise ValueError("resnet_config not recognized")
+
+        plan = [
+            {
+                "blocks": levels[min(k, len(levels) - 1)],
+                "epochs": epochs,
+                "init": init,
+                "alpha": alpha,
+            }
+            for k, epochs in enumerate(switch_steps)
+        ]
+        return cls(plan, device=device)
+
+    def stage_at(self, step):
+        """
+        Index of the stage that epoch step belongs to
+        """
+        return max(bisect.bisect_right(self.stage_starts, step) - 1, 0)
+
+    def update(self, step, model):
+        """
+        Called at the start of every epoch, grows the model if a stage starts at step
+        """
+        stage = self.transitions.get(step)
+        if stage is None and self.stage is None:
+            stage = self.stage_at(step)
+        if stage is not None:
+            model = self.apply_stage(model, stage)
+        return model
+
+    def apply_stage(self, model, stage):
+        """
+        Activates the resblocks of stage in model.H_net, initialises the new
+        resblocks and sets alpha
+        """
+        if stage == self.stage:
+            return model
+
+        H_net = model.H_net
+        blocks = list(self.plan[stage]["blocks"])
+        if max(blocks) >= len(H_net.resblocks):
+            raise ValueError(
+                "growth plan uses resblock {:d} but H_net only has {:d} resblocks".format(
+                    max(blocks), len(H_net.resblocks)
+                )
             )
-    return model
+
+        if self.stage is not None:  # the first stage only selects the resblocks
+            previous = list(H_net.resblock_list)
+            new = [i for i in blocks if i not in previous]
+            self._init_new_resblocks(H_net, previous, new, self.plan[stage]["init"])
+
+        H_net.resblock_list = blocks
+
+        alpha = self.plan[stage]["alpha"]
+        if alpha == "inverse":
+            H_net.alpha = torch.tensor([1 / len(blocks)], device=self.device)
+        elif alpha is not None:
+            H_net.alpha = torch.tensor([float(alpha)], device=self.device)
+
+        print("Model size increased")
+        self.stage = stage
+        return model
+
+    def _init_new_resblocks(self, H_net, previous, new, init):
+        """
+        Initialise the resblocks in new from the resblocks in previous
+        """
+        if init is None or not new:
+            return
+        if init not in ("small", "interpolate", "copy"):
+            raise ValueError("init rule not recognized")
+
+        with torch.no_grad():
+            for j in new:
+                if init == "small":
+                    for param in H_net.resblocks[j].parameters():
+                        param.copy_(param / 1000)
+                    continue
+
+                before = [i for i in previous if i < j]
+                after = [i for i in previous if i > j]
+                sources = []
+                if before:
+                    sources.append(H_net.resblocks[before[-1]])
+                if after and (init == "interpolate" or not before):
+                    sources.append(H_net.resblocks[after[0]])
+                if not sources:
+                    continue
+
+                for params in zip(
+                    H_net.resblocks[j].parameters(),
+                    *(block.parameters() for block in sources)
+                ):
+                    params[0].copy_(sum(params[1:]) / len(sources))
@@ -1,5 +1,6 @@
 import torch
 from .dynamics import *
+from .dynamics_numpy import *
 from torchdiffeq import odeint as odeint
 
 # Similar to https://github.com/Physics-aware-AI/Symplectic-ODENet/blob/master/experiment-single-force/data.py
@@ -52,14 +53,16 @@ class U_FUNC:
 
     """
 
-    def __init__(self, utype=None, params={}):
+    default_params = {"T": 2.0, "f0": 0, "f1": 1, "scale": 1}
+
+    def __init__(self, utype=None, params=None):
         super(U_FUNC).__init__()
         self.utype = utype
-        self.params = params  # dict containing params for the input function
-        self.params["T"] = 2.0
-        self.params["f0"] = 0
-        self.params["f1"] = 1
-        self.params["scale"] = 1
+        # dict containing params for the input function, copied so that the
+        # instances do not share it, the given params replace the defaults
+        self.params = dict(self.default_params)
+        if params is not None:
+            self.params.update(params)
 
     def forward(self, t):
         """time dependent input"""
@@ -90,11 +93,12 @@ class G_FUNC:
     Class that contains the input matrix functionss
     """
 
-    def __init__(self, device, gtype=None, params={}):
+    def __init__(self, device, gtype=None, params=None):
         super(G_FUNC).__init__()
         self.gtype = gtype
-        self.params = params  # dict containing params on
-        self.params["q_ref"] = torch.tensor([1.0], device=device)
+        self.params = {"q_ref": torch.tensor([1.0], device=device)}
+        if params is not None:
+            self.params.update(params)  # dict containing params on
 
     def forward(self, coords):
         """state dependent input"""
@@ -120,11 +124,168 @@ class G_FUNC:
         return g
 
 
+def rk4_step(func, t, x, dt):
+    """
+    One step of the fixed step Runge-Kutta 4 (3/8 rule) integrator, the same
+    scheme as odeint(method="rk4"), x is [batch_size, (q,p)]
+    """
+    k1 = func(t, x)
+    k2 = func(t + dt / 3, x + dt * k1 / 3)
+    k3 = func(t + dt * 2 / 3, x + dt * (k2 - k1 / 3))
+    k4 = func(t + dt, x + dt * (k1 - k2 + k3))
+    return x + dt * (k1 + 3 * (k2 + k3) + k4) / 8
+
+
+# Dormand-Prince 5(4) tableau, the stages and the 5th order solution are the
+# ones of odeint(method="dopri5")
+DOPRI5_C = [0.0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1.0, 1.0]
+DOPRI5_A = [
+    [],
+    [1 / 5],
+    [3 / 40, 9 / 40],
+    [44 / 45, -56 / 15, 32 / 9],
+    [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+    [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+    [35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84],
+]
+# difference between the 5th and 4th order solutions, gives the error estimate.
+# The 4th order weights are the ones of torchdiffeq (Shampine), not the classic
+# ones, but the error norm and the step size controller of dopri5_solve() differ
+# from odeint, so the accepted steps and the nfe can differ
+DOPRI5_E = [
+    35 / 384 - 1951 / 21600,
+    0.0,
+    500 / 1113 - 22642 / 50085,
+    125 / 192 - 451 / 720,
+    -2187 / 6784 + 12231 / 42400,
+    11 / 84 - 649 / 6300,
+    -1 / 60,
+]
+
+
+def _error_norm(x):
+    """
+    RMS norm over the coordinates, worst trajectory of the batch
+    """
+    if x.dim() > 1:
+        return x.pow(2).mean(dim=-1).sqrt().max()
+    return x.pow(2).mean().sqrt()
+
+
+def dopri5_step(func, t, x, dt, k1):
+    """
+    One Dormand-Prince 5(4) step from (t, x) with k1 = func(t, x), returns the
+    5th order solution at t + dt, its local error estimate and func(t + dt, x_new)
+    """
+    k = [k1]
+    for i in range(1, 7):
+        x_i = x + dt * sum(a * k_j for a, k_j in zip(DOPRI5_A[i], k) if a != 0.0)
+        t_i = torch.tensor(t + DOPRI5_C[i] * dt, device=x.device, dtype=x.dtype)
+        k.append(func(t_i, x_i))
+    # the 7th stage is evaluated at the 5th order solution
+    x_new = x_i
+    error = dt * sum(e * k_j for e, k_j in zip(DOPRI5_E, k) if e != 0.0)
+    return x_new, error, k[6]
+
+
+def dopri5_solve(
+    func,
+    x0,
+    t_eval,
+    rtol=1e-7,
+    atol=1e-9,
+    first_step=None,
+    safety=0.9,
+    max_steps=1000000,
+    solver_stats=None,
+):
+    """
+    Adaptive step Dormand-Prince 5(4) integration of func from x0 at t_eval[0],
+    the local error is kept below atol + rtol*|x| and the steps are shortened to
+    land exactly on the points of t_eval. If solver_stats (dict) is given, the
+    number of accepted and rejected steps and of function evaluations are added
+    to it. Returns the solution at t_eval [len(t_eval), *x0.shape]
+    """
+    times = t_eval.tolist()
+    t = times[0]
+    x = x0
+    k1 = func(t_eval[0], x)
+    nfe = 1
+    accepted = 0
+    rejected = 0
+
+    if first_step is None:
+        # Hairer's initial step size heuristic
+        scale = atol + rtol * x.abs()
+        d0 = _error_norm(x / scale).item()
+        d1 = _error_norm(k1 / scale).item()
+        h = 0.01 * d0 / d1 if d0 > 1e-5 and d1 > 1e-5 else 1e-6
+    else:
+        h = first_step
+    if len(times) > 1:
+        h = min(h, times[-1] - times[0])
+
+    solution = [x0]
+    for t_next in times[1:]:
+        while t < t_next:
+            if accepted + rejected >= max_steps:
+                raise RuntimeError("dopri5_solve : max_steps reached at t = " + str(t))
+
+            # shorten the step to land on the next output time
+            landing = t_next - t <= h
+            dt = t_next - t if landing else h
+
+            x_new, error, k7 = dopri5_step(func, t, x, dt, k1)
+            nfe += 6
+
+            scale = atol + rtol * torch.maximum(x.abs(), x_new.abs())
+            error_norm = _error_norm(error / scale).item()
+
+            if error_norm <= 1.0:
+                accepted += 1
+                t = t_next if landing else t + dt
+                x = x_new
+                k1 = k7
+                factor = 10.0 if error_norm == 0 else safety * error_norm ** (-1 / 5)
+                factor = min(10.0, max(0.2, factor))
+                # a step shortened to land on t_next does not shrink h
+                h = max(h, dt * factor) if landing else dt * factor
+            else:
+                rejected += 1
+                h = dt * max(0.2, safety * error_norm ** (-1 / 5))
+
+        solution.append(x)
+
+    if solver_stats is not None:
+        solver_stats["accepted"] = solver_stats.get("accepted", 0) + accepted
+        solver_stats["rejected"] = solver_stats.get("rejected", 0) + rejected
+        solver_stats["nfe"] = solver_stats.get("nfe", 0) + nfe
+    return torch.stack(solution, dim=0)
+
+
 def get_trajectory_pend(
-    device, time_steps, Ts, y0, noise_std, C, m, g, l, u_func, g_func
+    device,
+    time_steps,
+    Ts,
+    y0,
+    noise_std,
+    C,
+    m,
+    g,
+    l,
+    u_func,
+    g_func,
+    nfe_counter=None,
+    method="rk4",
+    rtol=1e-7,
+    atol=1e-9,
+    solver_stats=None,
 ):
     """
     Similar to SymODEN repository
+    nfe_counter (NFECounter or None) counts the evaluations of the dynamics
+    method is 'rk4' (fixed step Ts) or 'dopri5' (adaptive step with tolerances
+    rtol and atol, see dopri5_solve(), accepted/rejected steps in solver_stats)
     """
     # evaluated times vector
     t_eval = torch.linspace(1, time_steps, time_steps, device=device) * Ts
@@ -134,13 +295,19 @@ def get_trajectory_pend(
         y0 = torch.rand(2) * 4.0 - 2  # uniform law [-2,2]
         y0[1] = 0
 
-    q_p = odeint(
-        func=lambda t, coords: dynamics_fn_pend(t, coords, C, m, g, l, u_func, g_func),
-        y0=y0,
-        t=t_eval,
-        method="rk4",
-        options=dict(step_size=Ts),
+    func = lambda t, coords: dynamics_fn_pend(
+        t, coords, C, m, g, l, u_func, g_func, nfe_counter
     )
+    if method == "rk4":
+        q_p = odeint(
+            func=func, y0=y0, t=t_eval, method="rk4", options=dict(step_size=Ts)
+        )
+    elif method == "dopri5":
+        q_p = dopri5_solve(
+            func, y0, t_eval, rtol=rtol, atol=atol, solver_stats=solver_stats
+        )
+    else:
+        raise ValueError("method must be 'rk4' or 'dopri5'")
 
     q, p = torch.chunk(q_p, 2, 1)
 
@@ -207,14 +374,56 @@ def multiple_trajectories(
     u_func,
     g_func,
     coord_type="hamiltonian",
+    method="rk4",
+    rtol=1e-7,
+    atol=1e-9,
+    solver_stats=None,
+    backend="torch",
 ):
     """
-    Generates the trajectories (all generalized coordinates and energy)
+    Generates the trajectories (all generalized coordinates and energy),
+    method, rtol, atol and solver_stats are passed to get_trajectory_pend().
+    backend="numpy" simulates all the trajectories at once without autograd
+    (see multiple_trajectories_numpy(), only method="rk4")
     """
+    if backend == "numpy":
+        if method != "rk4":
+            raise ValueError("the numpy backend only supports method='rk4'")
+        return multiple_trajectories_numpy(
+            time_steps,
+            num_trajectories,
+            device,
+            Ts,
+            y0,
+            noise_std,
+            C,
+            m,
+            g,
+            l,
+            u_func,
+            g_func,
+            coord_type,
+        )
+    elif backend != "torch":
+        raise ValueError("backend must be 'torch' or 'numpy'")
 
     # the first trajectory
     q, p, t_eval = get_trajectory_pend(
-        device, time_steps, Ts, y0, noise_std, C, m, g, l, u_func, g_func
+        device,
+        time_steps,
+        Ts,
+        y0,
+        noise_std,
+        C,
+        m,
+        g,
+        l,
+        u_func,
+        g_func,
+        method=method,
+        rtol=rtol,
+        atol=atol,
+        solver_stats=solver_stats,
     )
     energy, derivatives = get_energy_pendulum(t_eval, u_func, g_func, q, p, C, m, g, l)
     energy = energy.squeeze()
@@ -229,7 +438,21 @@ def multiple_trajectories(
     for _ in range(num_trajectories - 1):
         # the trajectories 2 to num_trajectories
         q_n, p_n, _ = get_trajectory_pend(
-            device, time_steps, Ts, y0, noise_std, C, m, g, l, u_func, g_func
+            device,
+            time_steps,
+            Ts,
+            y0,
+            noise_std,
+            C,
+            m,
+            g,
+            l,
+            u_func,
+            g_func,
+            method=method,
+            rtol=rtol,
+            atol=atol,
+            solver_stats=solver_stats,
         )
         energy_n, derivatives_n = get_energy_pendulum(
             t_eval, u_func, g_func, q_n, p_n, C, m, g, l
@@ -253,3 +476,63 @@ def multiple_trajectories(
         p = p.unsqueeze(dim=0)
         energy = energy.unsqueeze(dim=0)
     return q.t(), p.t(), t_eval, energy.t(), torch.permute(derivatives, (1, 0, 2))
+
+
+def multiple_trajectories_numpy(
+    time_steps,
+    num_trajectories,
+    device,
+    Ts,
+    y0,
+    noise_std,
+    C,
+    m,
+    g,
+    l,
+    u_func,
+    g_func,
+    coord_type="hamiltonian",
+):
+    """
+    Same outputs as multiple_trajectories() but all the trajectories are simulated
+    at once in float64 NumPy with pendulum_dynamics_numpy() and rk4_numpy()
+    """
+    t_eval = torch.linspace(1, time_steps, time_steps, device=device) * Ts
+
+    # initial states as in get_trajectory_pend()
+    if y0 is None:
+        x0 = torch.rand(num_trajectories, 2) * 4.0 - 2  # uniform law [-2,2]
+        x0[:, 1] = 0
+    else:
+        x0 = y0.reshape(1, 2).expand(num_trajectories, 2)
+    x0 = x0.detach().cpu().double().numpy()
+
+    # input at every rk4 stage, the first time step is t_eval[0] = Ts
+    steps = time_steps - 1
+    stage_times = Ts + Ts * (
+        np.arange(steps)[:, None] + np.array([0.0, 1 / 3, 2 / 3, 1.0])[None, :]
+    )
+    U_G = tabulate_input(u_func, g_func, stage_times.reshape(-1))
+    U_G = U_G.reshape((steps, 4) + U_G.shape[1:])
+
+    x = rk4_numpy(
+        lambda x, u_g: pendulum_dynamics_numpy(x, u_g, C, m, g, l), x0, Ts, steps, U_G
+    )
+    # x is [time_steps, num_trajectories, (q,p)]
+
+    x = torch.tensor(x, dtype=torch.float32, device=device)
+    q = x[..., 0] + torch.randn(x[..., 0].shape, device=device) * noise_std
+    p = x[..., 1] + torch.randn(x[..., 1].shape, device=device) * noise_std
+
+    # derivatives and energy at t_eval, as in get_energy_pendulum()
+    U_G = tabulate_input(u_func, g_func, t_eval.detach().cpu().double().numpy())
+    coords = torch.stack((q, p), dim=-1).detach().cpu().double().numpy()
+    derivatives = pendulum_dynamics_numpy(coords, U_G, C, m, g, l)
+    derivatives = torch.tensor(derivatives, dtype=torch.float32, device=device)
+    energy = energy_pendulum(derivatives[..., 0], q, m, g, l)
+
+    if coord_type == "newtonian":
+        p = derivatives[..., 0]
+
+    # [time_steps, num_trajectories] as multiple_trajectories()
+    return q, p, t_eval, energy, derivatives
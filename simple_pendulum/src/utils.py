@@ -1,8 +1,10 @@
 import numpy as np
 import random
+import time
 import torch
 import json
-import dill as pickle  # dill used because pickle does not support lambda functions
+
+from contextlib import contextmanager
 
 
 def count_parameters(model):
@@ -68,9 +70,11 @@ def pickle_save(file, path):
     Save any python object to a .pkl file, use .pkl at
     the end of the path.
 
-    Make sure dill is loaded as pickle like in the top of this
-    file so that lambda functions can also be saved.
+    dill is used instead of pickle so that lambda functions can also be
+    saved, it is only imported here.
     """
+    import dill as pickle
+
     with open(path, "wb") as handle:
         pickle.dump(file, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
@@ -79,6 +83,117 @@ def pickle_load(path):
     """
     Load python object from pickle file
     """
+    import dill as pickle
+
     with open(path, "rb") as handle:
         file = pickle.load(handle)
     return file
+
+
+class PhaseTimer:
+    """
+    Accumulates the wall clock time spent in named phases of the training loop
+    and named counters (for example the number of function evaluations).
+    Use phase(name) as a context manager, or start(name)/stop(name),
+    count(name, n) for the counters and summary() to read and reset them.
+    With synchronize=True on cuda, cuda is synchronized at every phase boundary
+    """
+
+    def __init__(self, device=None, synchronize=False):
+        self.synchronize = (
+            synchronize and device is not None and torch.device(device).type == "cuda"
+        )
+        self.reset()
+
+    def reset(self):
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+        self._started = {}
+
+    def _sync(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+
+    def start(self, name):
+        self._sync()
+        self._started[name] = time.perf_counter()
+
+    def stop(self, name):
+        if name not in self._started:
+            return
+        self._sync()
+        elapsed = time.perf_counter() - self._started.pop(name)
+        self.times[name] = self.times.get(name, 0.0) + elapsed
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    @contextmanager
+    def phase(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self, reset=True):
+        summary = {
+            "times": dict(self.times),
+            "calls": dict(self.calls),
+            "counters": dict(self.counters),
+        }
+        if reset:
+            self.reset()
+        return summary
+
+
+class ProfilerWindow:
+    """
+    Runs torch.profiler for num_steps training steps starting at step start
+    (counted over all the epochs). Call step() at the beginning of every training
+    step and stop() at the end of training, the summary table is then in
+    self.table and the chrome trace is saved to trace_path if it is given
+    """
+
+    def __init__(
+        self,
+        start=10,
+        num_steps=5,
+        trace_path=None,
+        sort_by="self_cpu_time_total",
+        row_limit=20,
+    ):
+        self.start = start
+        self.num_steps = num_steps
+        self.trace_path = trace_path
+        self.sort_by = sort_by
+        self.row_limit = row_limit
+        self.step_num = 0
+        self.profiler = None
+        self.table = None
+
+    def step(self):
+        if self.step_num == self.start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(
+                activities=activities, record_shapes=True
+            )
+            self.profiler.start()
+        elif self.step_num == self.start + self.num_steps:
+            self.stop()
+        self.step_num += 1
+
+    def stop(self):
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        if self.trace_path is not None:
+            self.profiler.export_chrome_trace(self.trace_path)
+        self.table = self.profiler.key_averages().table(
+            sort_by=self.sort_by, row_limit=self.row_limit
+        )
+        self.profiler = None